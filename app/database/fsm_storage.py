@@ -0,0 +1,278 @@
+import os
+import json
+import time
+import asyncio
+import dbm
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from app.database.requests import get_db_connection, storage_queries, DictCursor
+
+# Состояния FSM (QuestionLinkState, AnsweringQuestions, SetPriceState, AddQuestions) хранятся вне процесса,
+# чтобы переживать перезапуск и быть общими для нескольких процессов бота
+
+@asynccontextmanager
+async def storage_connection():
+    """Подключение для запросов хранилища: они учитываются отдельно и не входят в бюджет обработчика."""
+    with storage_queries():
+        async with get_db_connection() as connection:
+            yield connection
+
+
+def make_key(key: StorageKey):
+    """Компактный строковый ключ: bot:chat:user:thread:destiny."""
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+
+def dump_data(data):
+    """Компактная сериализация данных FSM."""
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=str)
+
+
+def load_data(raw):
+    return json.loads(raw) if raw else {}
+
+
+def state_name(state):
+    return getattr(state, "state", state)
+
+
+class MySQLStorage(BaseStorage):
+    """Хранилище FSM в таблице fsm_storage с TTL на ключ.
+    По умолчанию (flush_interval = 0) каждое изменение сразу пишется в БД, и все процессы бота видят
+    одно и то же состояние. При flush_interval > 0 записи копятся в памяти не дольше flush_interval секунд
+    и пишутся пачкой (один многострочный INSERT ... ON DUPLICATE KEY UPDATE): меньше запросов, но другой
+    процесс в это время может прочитать устаревшее состояние — подходит только для одного процесса
+    или при привязке пользователя к процессу на балансировщике."""
+
+    def __init__(self, ttl=86400, flush_interval=0, cleanup_interval=600):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.cleanup_interval = cleanup_interval
+        self._pending = {}  # ключ -> {"state": ..., "data": ...} (только измененные поля)
+        self._flushing = {}  # изменения, которые прямо сейчас пишутся в БД
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._closed = False
+        self._last_cleanup = time.monotonic()
+
+    def _expires_at(self):
+        return datetime.now() + timedelta(seconds=self.ttl)
+
+    def _change(self, raw_key):
+        """Еще не записанные в БД изменения ключа (более новые поверх записываемых)."""
+        return {**self._flushing.get(raw_key, {}), **self._pending.get(raw_key, {})}
+
+    async def _load(self, keys):
+        """Читает записи сразу для нескольких ключей одним запросом."""
+        if not keys:
+            return {}
+        placeholders = ", ".join(["%s"] * len(keys))
+        async with storage_connection() as connection:
+            async with connection.cursor(DictCursor) as cursor:
+                await cursor.execute(
+                    f"""
+                    SELECT storage_key, state, data FROM fsm_storage
+                    WHERE storage_key IN ({placeholders}) AND expires_at > NOW()
+                    """,
+                    tuple(keys)
+                )
+                return {row['storage_key']: row for row in await cursor.fetchall()}
+
+    async def set_state(self, key: StorageKey, state=None):
+        self._pending.setdefault(make_key(key), {})["state"] = state_name(state)
+        await self._schedule()
+
+    async def get_state(self, key: StorageKey):
+        raw_key = make_key(key)
+        change = self._change(raw_key)
+        if "state" in change:
+            return change["state"]
+        row = (await self._load([raw_key])).get(raw_key)
+        return row['state'] if row else None
+
+    async def set_data(self, key: StorageKey, data):
+        self._pending.setdefault(make_key(key), {})["data"] = dict(data)
+        await self._schedule()
+
+    async def get_data(self, key: StorageKey):
+        raw_key = make_key(key)
+        change = self._change(raw_key)
+        if "data" in change:
+            return dict(change["data"])
+        row = (await self._load([raw_key])).get(raw_key)
+        return load_data(row['data']) if row else {}
+
+    async def _schedule(self):
+        if self.flush_interval <= 0 or self._closed:
+            await self.flush()
+            if not self._closed and time.monotonic() - self._last_cleanup > self.cleanup_interval:
+                await self.delete_expired()
+            return
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        if len(self._pending) >= 100:
+            self._wakeup.set()
+
+    async def _run(self):
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                if time.monotonic() - self._last_cleanup > self.cleanup_interval:
+                    await self.delete_expired()
+            except Exception as e:
+                print(f"Ошибка при записи состояний FSM: {e}")
+
+    async def flush(self):
+        """Записывает накопленные изменения пачкой."""
+        async with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            self._flushing = pending
+            expires_at = self._expires_at()
+            full, state_only, data_only, deleted = [], [], [], []
+            maybe_empty = []  # Ключи, у которых после записи могут остаться state = NULL и пустые данные
+            for raw_key, change in pending.items():
+                if "state" in change and "data" in change:
+                    if change["state"] is None and not change["data"]:
+                        deleted.append((raw_key,))  # state.clear() — запись больше не нужна
+                    else:
+                        full.append((raw_key, change["state"], dump_data(change["data"]), expires_at))
+                elif "state" in change:
+                    state_only.append((raw_key, change["state"], '{}', expires_at))
+                    if change["state"] is None:
+                        maybe_empty.append(raw_key)
+                else:
+                    data_only.append((raw_key, None, dump_data(change["data"]), expires_at))
+                    if not change["data"]:
+                        maybe_empty.append(raw_key)
+
+            try:
+                async with storage_connection() as connection:
+                    async with connection.cursor() as cursor:
+                        if full:
+                            await cursor.executemany(
+                                """
+                                INSERT INTO fsm_storage (storage_key, state, data, expires_at) VALUES (%s, %s, %s, %s)
+                                ON DUPLICATE KEY UPDATE state = VALUES(state), data = VALUES(data),
+                                                        expires_at = VALUES(expires_at)
+                                """,
+                                full
+                            )
+                        if state_only:
+                            await cursor.executemany(
+                                """
+                                INSERT INTO fsm_storage (storage_key, state, data, expires_at) VALUES (%s, %s, %s, %s)
+                                ON DUPLICATE KEY UPDATE state = VALUES(state), expires_at = VALUES(expires_at)
+                                """,
+                                state_only
+                            )
+                        if data_only:
+                            await cursor.executemany(
+                                """
+                                INSERT INTO fsm_storage (storage_key, state, data, expires_at) VALUES (%s, %s, %s, %s)
+                                ON DUPLICATE KEY UPDATE data = VALUES(data), expires_at = VALUES(expires_at)
+                                """,
+                                data_only
+                            )
+                        if deleted:
+                            await cursor.executemany("DELETE FROM fsm_storage WHERE storage_key = %s", deleted)
+                        if maybe_empty:
+                            # Без отложенной записи state.clear() приходит двумя изменениями (set_state(None),
+                            # затем set_data({})) — пустую запись удаляем по ее итоговому содержимому
+                            placeholders = ", ".join(["%s"] * len(maybe_empty))
+                            await cursor.execute(
+                                f"""
+                                DELETE FROM fsm_storage
+                                WHERE storage_key IN ({placeholders}) AND state IS NULL AND data = '{{}}'
+                                """,
+                                tuple(maybe_empty)
+                            )
+            except Exception:
+                # Возвращаем изменения в очередь, не затирая более новые
+                for raw_key, change in pending.items():
+                    self._pending[raw_key] = {**change, **self._pending.get(raw_key, {})}
+                raise
+            finally:
+                self._flushing = {}
+
+    async def delete_expired(self):
+        """Удаляет просроченные записи."""
+        self._last_cleanup = time.monotonic()
+        async with storage_connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute("DELETE FROM fsm_storage WHERE expires_at < NOW() LIMIT 10000")
+                return cursor.rowcount
+
+    async def close(self):
+        self._closed = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+
+
+class FileStorage(BaseStorage):
+    """Хранилище FSM в локальном key-value файле (dbm) с TTL на ключ — для тестов и одиночного запуска."""
+
+    def __init__(self, path, ttl=86400):
+        self.ttl = ttl
+        self._db = dbm.open(path, 'c')
+
+    def _read(self, raw_key):
+        raw = self._db.get(raw_key)
+        if raw is None:
+            return None, {}
+        record = json.loads(raw)
+        if record["expires_at"] < time.time():
+            del self._db[raw_key]
+            return None, {}
+        return record["state"], record["data"]
+
+    def _write(self, raw_key, state, data):
+        if state is None and not data:
+            if raw_key in self._db:
+                del self._db[raw_key]
+            return
+        self._db[raw_key] = dump_data({"state": state, "data": data, "expires_at": time.time() + self.ttl})
+
+    async def set_state(self, key: StorageKey, state=None):
+        raw_key = make_key(key)
+        _, data = self._read(raw_key)
+        self._write(raw_key, state_name(state), data)
+
+    async def get_state(self, key: StorageKey):
+        return self._read(make_key(key))[0]
+
+    async def set_data(self, key: StorageKey, data):
+        raw_key = make_key(key)
+        state, _ = self._read(raw_key)
+        self._write(raw_key, state, dict(data))
+
+    async def get_data(self, key: StorageKey):
+        return dict(self._read(make_key(key))[1])
+
+    async def close(self):
+        self._db.close()
+
+
+def create_fsm_storage():
+    """Создает хранилище FSM по переменной окружения FSM_STORAGE: mysql (по умолчанию), file или memory."""
+    backend = os.getenv('FSM_STORAGE', 'mysql')
+    ttl = int(os.getenv('FSM_TTL', 86400))
+    if backend == 'memory':
+        return MemoryStorage()
+    if backend == 'file':
+        return FileStorage(os.getenv('FSM_STORAGE_PATH', 'fsm_storage.db'), ttl=ttl)
+    return MySQLStorage(ttl=ttl, flush_interval=float(os.getenv('FSM_FLUSH_INTERVAL', 0)))
@@ -0,0 +1,311 @@
+from app.database.requests import get_db_connection
+
+# Версионированные миграции схемы. Каждая миграция — (версия, описание, шаги);
+# шаг — SQL-строка или async-функция (cursor). Примененные версии хранятся в schema_migrations.
+# DDL в MySQL фиксируется неявно, поэтому шаги пишутся идемпотентными (IF NOT EXISTS, проверка индексов).
+
+MIGRATIONS_LOCK = 'ratebot_migrations'
+
+
+def index(table, name, columns, unique=False):
+    """Шаг миграции: создает индекс, если индекса с таким именем еще нет."""
+    async def step(cursor):
+        await cursor.execute(
+            """
+            SELECT 1 FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+            LIMIT 1
+            """,
+            (table, name)
+        )
+        if not await cursor.fetchone():
+            await cursor.execute(
+                f"ALTER TABLE {table} ADD {'UNIQUE ' if unique else ''}INDEX {name} ({columns})"
+            )
+    return step
+
+
+def column(table, name, definition):
+    """Шаг миграции: добавляет столбец, если его еще нет (таблицы могли быть созданы до миграций)."""
+    async def step(cursor):
+        await cursor.execute(
+            """
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+            LIMIT 1
+            """,
+            (table, name)
+        )
+        if not await cursor.fetchone():
+            await cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+    return step
+
+
+def drop_index(table, name):
+    """Шаг миграции: удаляет индекс, если он есть."""
+    async def step(cursor):
+        await cursor.execute(
+            """
+            SELECT 1 FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+            LIMIT 1
+            """,
+            (table, name)
+        )
+        if await cursor.fetchone():
+            await cursor.execute(f"ALTER TABLE {table} DROP INDEX {name}")
+    return step
+
+
+async def create_rating_rollups(cursor):
+    """Создает таблицу агрегатов оценок и заполняет ее по существующим оценкам."""
+    await cursor.execute("SHOW TABLES LIKE 'rating_rollups'")
+    if await cursor.fetchone():
+        return  # Таблица уже создана и заполнена до появления миграций
+    await cursor.execute(
+        """
+        CREATE TABLE rating_rollups (
+            rated_user_id BIGINT NOT NULL,
+            bucket ENUM('hour', 'day') NOT NULL,
+            bucket_start DATETIME NOT NULL,
+            score_sum BIGINT NOT NULL DEFAULT 0,
+            ratings_count INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (rated_user_id, bucket, bucket_start)
+        )
+        """
+    )
+    for bucket, bucket_format in (('hour', '%Y-%m-%d %H:00:00'), ('day', '%Y-%m-%d 00:00:00')):
+        await cursor.execute(
+            f"""
+            INSERT INTO rating_rollups (rated_user_id, bucket, bucket_start, score_sum, ratings_count)
+            SELECT rated_user_id, '{bucket}', DATE_FORMAT(created_at, '{bucket_format}'), SUM(score), COUNT(id)
+            FROM ratings
+            GROUP BY rated_user_id, DATE_FORMAT(created_at, '{bucket_format}')
+            """
+        )
+
+
+MIGRATIONS = [
+    (1, "Базовые таблицы", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            tg_id BIGINT NOT NULL,
+            first_name VARCHAR(255),
+            username VARCHAR(255),
+            link_token VARCHAR(32),
+            link_created_at DATETIME,
+            is_admin BOOLEAN NOT NULL DEFAULT FALSE,
+            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE KEY uq_users_tg_id (tg_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS ratings (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            rated_user_id BIGINT NOT NULL,
+            rater_user_id BIGINT NOT NULL,
+            score TINYINT NOT NULL,
+            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS questions (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            text VARCHAR(255) NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS question_links (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            token VARCHAR(32) NOT NULL,
+            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS question_link_items (
+            link_id INT NOT NULL,
+            question_id INT NOT NULL,
+            PRIMARY KEY (link_id, question_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS question_ratings (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            token VARCHAR(32) NOT NULL,
+            question_id INT NOT NULL,
+            rater_id BIGINT NOT NULL,
+            score TINYINT NOT NULL,
+            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS payments (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            amount DECIMAL(10, 2) NOT NULL,
+            transaction_id VARCHAR(64) NOT NULL,
+            payment_url TEXT,
+            access_start DATETIME,
+            access_end DATETIME,
+            period VARCHAR(32),
+            is_vip BOOLEAN NOT NULL DEFAULT FALSE,
+            status VARCHAR(16) NOT NULL DEFAULT 'pending',
+            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS subscription_prices (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            period VARCHAR(32) NOT NULL,
+            price DECIMAL(10, 2) NOT NULL,
+            is_vip BOOLEAN NOT NULL DEFAULT FALSE
+        )
+        """,
+    ]),
+    (2, "Индексы для горячих запросов", [
+        index("users", "uq_users_link_token", "link_token", unique=True),
+        index("question_links", "uq_question_links_token", "token", unique=True),
+        index("question_links", "idx_question_links_user", "user_id"),
+        index("question_ratings", "idx_question_ratings_token_rater", "token, rater_id"),
+        index("ratings", "idx_ratings_rater_rated", "rater_user_id, rated_user_id"),
+        index("ratings", "idx_ratings_rated_created", "rated_user_id, created_at"),
+        index("payments", "uq_payments_transaction", "transaction_id", unique=True),
+        index("payments", "idx_payments_user_status_end", "user_id, status, access_end"),
+        index("payments", "idx_payments_status_created", "status, created_at"),
+        index("subscription_prices", "idx_subscription_prices_period", "period, is_vip"),
+    ]),
+    (3, "Агрегаты оценок по часам и дням", [
+        create_rating_rollups,
+    ]),
+    (4, "Хранилище состояний FSM", [
+        """
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            storage_key VARCHAR(191) PRIMARY KEY,
+            state VARCHAR(255),
+            data MEDIUMTEXT NOT NULL,
+            expires_at DATETIME NOT NULL,
+            KEY idx_fsm_storage_expires (expires_at)
+        )
+        """,
+    ]),
+    (5, "Рассылки администратора", [
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            admin_id BIGINT NOT NULL,
+            text TEXT NOT NULL,
+            status VARCHAR(16) NOT NULL DEFAULT 'running',
+            last_user_id INT NOT NULL DEFAULT 0,
+            total INT NOT NULL DEFAULT 0,
+            delivered INT NOT NULL DEFAULT 0,
+            failed INT NOT NULL DEFAULT 0,
+            progress_message_id BIGINT,
+            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            KEY idx_broadcasts_status (status)
+        )
+        """,
+    ]),
+    (6, "Архив оплаченных платежей", [
+        """
+        CREATE TABLE IF NOT EXISTS payments_archive (
+            id INT PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            amount DECIMAL(10, 2) NOT NULL,
+            transaction_id VARCHAR(64) NOT NULL,
+            payment_url TEXT,
+            access_start DATETIME,
+            access_end DATETIME,
+            period VARCHAR(32),
+            is_vip BOOLEAN NOT NULL DEFAULT FALSE,
+            status VARCHAR(16) NOT NULL,
+            created_at DATETIME NOT NULL,
+            archived_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            KEY idx_payments_archive_user (user_id)
+        )
+        """,
+        index("payments", "idx_payments_status_end", "status, access_end"),
+    ]),
+    (7, "Счетчики панели администратора", [
+        """
+        CREATE TABLE IF NOT EXISTS dashboard_counters (
+            period ENUM('total', 'day') NOT NULL,
+            bucket_start DATE NOT NULL,
+            metric VARCHAR(32) NOT NULL,
+            value DECIMAL(14, 2) NOT NULL DEFAULT 0,
+            PRIMARY KEY (period, bucket_start, metric)
+        )
+        """,
+        # Первичное заполнение делает reconcile_dashboard при запуске бота
+    ]),
+    (8, "Одна цена на период и версия каталога цен", [
+        # Прежний update_subscription_price мог оставить дубликаты — оставляем последнюю запись
+        """
+        DELETE older FROM subscription_prices older
+        JOIN subscription_prices newer
+          ON newer.period = older.period AND newer.is_vip = older.is_vip AND newer.id > older.id
+        """,
+        index("subscription_prices", "uq_subscription_prices_period", "period, is_vip", unique=True),
+        # Уникальный индекс покрывает те же столбцы — прежний индекс из миграции 2 больше не нужен
+        drop_index("subscription_prices", "idx_subscription_prices_period"),
+        """
+        CREATE TABLE IF NOT EXISTS catalog_versions (
+            name VARCHAR(32) PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0
+        )
+        """,
+        "INSERT IGNORE INTO catalog_versions (name, version) VALUES ('prices', 1)",
+    ]),
+    (9, "Столбцы created_at в таблицах, созданных до миграций", [
+        # CREATE TABLE IF NOT EXISTS из миграции 1 не меняет существующие таблицы; у старых строк
+        # будет время применения миграции (срок ссылок отсчитывается с этого момента)
+        column("users", "created_at", "DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP"),
+        column("question_links", "created_at", "DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP"),
+        column("question_ratings", "created_at", "DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP"),
+    ]),
+]
+
+
+async def run_migrations():
+    """Применяет все еще не примененные миграции. Возвращает список примененных версий."""
+    applied_now = []
+    async with get_db_connection() as connection:
+        async with connection.cursor() as cursor:
+            # Блокировка, чтобы несколько процессов бота не применяли миграции одновременно
+            await cursor.execute("SELECT GET_LOCK(%s, 60)", (MIGRATIONS_LOCK,))
+            if not (await cursor.fetchone())[0]:
+                raise RuntimeError("Не удалось получить блокировку для миграций")
+            try:
+                await cursor.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INT PRIMARY KEY,
+                        description VARCHAR(255) NOT NULL,
+                        applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    )
+                    """
+                )
+                await cursor.execute("SELECT version FROM schema_migrations")
+                applied = {row[0] for row in await cursor.fetchall()}
+
+                for version, description, steps in MIGRATIONS:
+                    if version in applied:
+                        continue
+                    for step in steps:
+                        if callable(step):
+                            await step(cursor)
+                        else:
+                            await cursor.execute(step)
+                    await cursor.execute(
+                        "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                        (version, description)
+                    )
+                    await connection.commit()
+                    applied_now.append(version)
+                    print(f"Применена миграция {version}: {description}")
+            finally:
+                await cursor.execute("SELECT RELEASE_LOCK(%s)", (MIGRATIONS_LOCK,))
+                await cursor.fetchone()
+    return applied_now
@@ -0,0 +1,152 @@
+"""Проверка планов запросов из app/database/requests.py.
+
+Запросы берутся прямо из исходного кода requests.py: каждый вызов cursor.execute(...) с SQL-строкой.
+Для каждого выполняется EXPLAIN с тестовыми параметрами; проверка падает, если какой-либо запрос
+читает таблицу целиком (type = ALL). SQL, собираемый f-строкой, разобрать заранее нельзя — такие
+запросы перечислены в DYNAMIC_QUERIES, и функция без записи там считается непроверенной.
+
+Запускать на базе с данными, близкими к боевым: на пустых таблицах MySQL может выбрать
+полный просмотр независимо от индексов.
+
+Запуск: python -m app.database.query_plans
+"""
+import re
+import ast
+import sys
+import asyncio
+from datetime import datetime
+
+import aiomysql
+
+import app.database.requests as rq
+
+NOW = datetime.now()
+
+# Запросы, которые EXPLAIN не анализирует (блокировки, вставка значений)
+SKIPPED = re.compile(r"^\s*(SELECT\s+(GET_LOCK|RELEASE_LOCK)|INSERT\s+(?!.*\bSELECT\b))", re.IGNORECASE | re.DOTALL)
+# Столбцы с датой: тестовое значение для них — текущее время
+DATE_COLUMN = re.compile(r"(\w*_at|bucket_start|access_end|access_start)\s*(>=|<=|<|>|=)\s*$", re.IGNORECASE)
+
+
+def collect_queries(path=rq.__file__):
+    """Возвращает (статические, динамические): [(функция, SQL)] и множество функций с SQL из f-строк."""
+    tree = ast.parse(open(path, encoding='utf-8').read())
+    static, dynamic = [], set()
+
+    def visit(node, scope):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                visit(child, scope + [child.name])
+                continue
+            if (isinstance(child, ast.Call) and isinstance(child.func, ast.Attribute)
+                    and child.func.attr in ('execute', 'executemany') and child.args):
+                name = '.'.join(scope)
+                sql = child.args[0]
+                if isinstance(sql, ast.Constant) and isinstance(sql.value, str):
+                    if not SKIPPED.match(sql.value):
+                        static.append((name, sql.value))
+                elif isinstance(sql, ast.JoinedStr):
+                    dynamic.add(name)
+            visit(child, scope)
+
+    visit(tree, [])
+    return static, dynamic
+
+
+def sample_params(query):
+    """Тестовые параметры по порядку %s: дата для столбцов-дат, 1 для LIMIT и INTERVAL, иначе '1'
+    (строка подходит и для числовых, и для строковых столбцов и не мешает использовать индекс)."""
+    params = []
+    parts = query.split('%s')
+    for before in parts[:-1]:
+        tail = before.rstrip()
+        if DATE_COLUMN.search(tail):
+            params.append(NOW)
+        elif re.search(r"\b(LIMIT|INTERVAL)$", tail, re.IGNORECASE):
+            params.append(1)
+        else:
+            params.append('1')
+    return tuple(params)
+
+
+# Запросы, которые requests.py собирает f-строкой: (функция, пример запроса, параметры)
+DYNAMIC_QUERIES = [
+    ("update_payments_status_bulk", """
+        SELECT transaction_id, user_id, amount, is_vip, created_at FROM payments
+        WHERE transaction_id IN (%s, %s) AND status = 'pending'
+        FOR UPDATE""", ("label1", "label2")),
+    ("update_payments_status_bulk", "UPDATE payments SET status = %s WHERE transaction_id IN (%s, %s)",
+        ("success", "label1", "label2")),
+    ("reconcile_dashboard", f"""
+        INSERT INTO dashboard_counters (period, bucket_start, metric, value)
+        SELECT 'day', DATE(created_at), CONCAT('revenue_', IF(is_vip, 'vip', 'normal')), SUM(amount)
+        FROM ({rq.PAID_PAYMENTS}) paid WHERE created_at >= %s GROUP BY DATE(created_at), is_vip""", (NOW,)),
+    ("sweep_expired_payments", """
+        SELECT id, user_id FROM payments
+        WHERE status = 'pending' AND created_at < NOW() - INTERVAL %s MINUTE ORDER BY id LIMIT %s FOR UPDATE""", (5, 500)),
+    ("sweep_expired_payments", """
+        SELECT id, user_id FROM payments
+        WHERE status = 'success' AND access_end < NOW() ORDER BY id LIMIT %s FOR UPDATE""", (500,)),
+    ("sweep_expired_payments", f"""
+        INSERT IGNORE INTO payments_archive ({rq.PAYMENT_COLUMNS}, archived_at)
+        SELECT {rq.PAYMENT_COLUMNS}, NOW() FROM payments WHERE id IN (%s, %s)""", (1, 2)),
+    ("sweep_expired_payments", "DELETE FROM payments WHERE id IN (%s, %s)", (1, 2)),
+    ("sweep_expired_payments", """
+        SELECT COUNT(*) FROM users WHERE tg_id IN (%s, %s)
+        AND NOT EXISTS(SELECT 1 FROM payments WHERE payments.user_id = users.tg_id)
+        AND NOT EXISTS(SELECT 1 FROM payments_archive WHERE payments_archive.user_id = users.tg_id)""", (1, 2)),
+]
+
+# Функции, которым полный просмотр нужен по смыслу (весь справочник или агрегаты по всей таблице)
+ALLOWED_FULL_SCANS = {
+    "QuestionCatalog.ensure_loaded",  # Каталог вопросов читается целиком
+    "PriceCatalog.load",  # Каталог цен (несколько строк) — при запуске и смене версии
+    "reconcile_dashboard",  # Итоги пересчитываются по всем платежам раз в час
+    "create_broadcast",  # Число получателей — COUNT(*) по users один раз на рассылку
+    "get_running_broadcasts",  # Таблица рассылок крошечная
+}
+
+
+def query_list():
+    """Все проверяемые запросы: [(функция, SQL, параметры)] и функции с SQL из f-строк без примера."""
+    static, dynamic = collect_queries()
+    queries = [(name, query, sample_params(query)) for name, query in static]
+    queries += DYNAMIC_QUERIES
+    unchecked = sorted(dynamic - {name for name, _, _ in DYNAMIC_QUERIES})
+    return queries, unchecked
+
+
+async def check_query_plans(queries):
+    """Возвращает список (функция, таблица) для запросов с полным просмотром таблицы."""
+    problems = []
+    async with rq.get_db_connection() as connection:
+        async with connection.cursor(aiomysql.DictCursor) as cursor:
+            for name, query, params in queries:
+                if name in ALLOWED_FULL_SCANS:
+                    continue
+                await cursor.execute("EXPLAIN " + query, params)
+                for row in await cursor.fetchall():
+                    if row.get('type') == 'ALL':
+                        problems.append((name, row.get('table')))
+    return problems
+
+
+async def main():
+    queries, unchecked = query_list()
+    await rq.create_db_pool()
+    try:
+        problems = await check_query_plans(queries)
+    finally:
+        await rq.close_db_pool()
+
+    for name in unchecked:
+        print(f"Не проверен запрос из f-строки в {name}: добавьте пример в DYNAMIC_QUERIES")
+    for name, table in problems:
+        print(f"Полный просмотр таблицы {table} в запросе {name}")
+    if problems or unchecked:
+        sys.exit(1)
+    print(f"Проверено запросов: {len(queries)}, полных просмотров нет.")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,9 +1,17 @@
 import aiomysql
+import asyncio
 from datetime import timedelta, datetime
 import os
 from dotenv import load_dotenv
-import random
-import string
+import time
+from collections import OrderedDict
+from decimal import Decimal
+from contextlib import contextmanager, asynccontextmanager
+from contextvars import ContextVar
+
+from app.database.write_buffer import WriteBehindBuffer
+from app.utils.tokens import execute_with_unique_token
+from app.utils.metrics import track_query, TimedAcquire
 
 # Загружаем переменные окружения из файла .env
 load_dotenv()
@@ -17,95 +25,483 @@ db_config = {
     'port': 3306  # Порт MySQL
 }
 
-# Функция для подключения к базе данных
-async def get_db_connection():
-    """Возвращает асинхронное подключение к базе данных."""
+# Настройки пула подключений
+pool_config = {
+    'minsize': int(os.getenv('DB_POOL_MIN_SIZE', 1)),  # Минимальное число подключений в пуле
+    'maxsize': int(os.getenv('DB_POOL_SIZE', 10)),  # Максимальное число подключений в пуле
+    'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 3600)),  # Время жизни подключения в секундах
+}
+
+# Трассировка запросов: число SQL-выражений на обновление и журнал медленных запросов
+query_trace_config = {
+    'slow_query_ms': float(os.getenv('SLOW_QUERY_MS', 200)),  # Порог медленного запроса в миллисекундах
+    'budget_mode': os.getenv('QUERY_BUDGET_MODE', 'warn'),  # off, warn или raise (для тестов)
+}
+SLOW_QUERY_LOG_LIMIT = 1000  # Сколько символов SQL и параметров писать в журнал
+
+
+class QueryBudgetExceeded(Exception):
+    """Обработчик выполнил больше SQL-выражений, чем объявлено в его флаге query_budget."""
+
+
+class QueryTrace:
+    """SQL-выражения, выполненные внутри trace_queries() (вложенные трассировки учитываются и во внешних).
+    Выражения хранилища FSM (storage_queries()) считаются отдельно и в count не входят."""
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.active = True
+        self.statements = []  # (sql, время выполнения в секундах)
+        self.storage_statements = []  # То же для хранилища FSM
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    @property
+    def elapsed(self):
+        return sum(elapsed for _, elapsed in self.statements)
+
+
+current_trace = ContextVar('current_trace', default=None)
+in_storage = ContextVar('in_storage', default=False)
+
+@contextmanager
+def trace_queries():
+    """Считает SQL-выражения текущей задачи: with trace_queries() as trace: ...; trace.count."""
+    trace = QueryTrace(current_trace.get())
+    token = current_trace.set(trace)
     try:
-        connection = await aiomysql.connect(**db_config)
-        return connection
-    except Exception as e:
-        raise
+        yield trace
+    finally:
+        # Фоновые задачи, созданные внутри обработчика, наследуют контекст — после выхода они не учитываются
+        trace.active = False
+        current_trace.reset(token)
+
+@contextmanager
+def storage_queries():
+    """Помечает выражения хранилища FSM: их число зависит от хранилища (в памяти — ноль),
+    а не от обработчика, поэтому в бюджет query_budget они не входят."""
+    token = in_storage.set(True)
+    try:
+        yield
+    finally:
+        in_storage.reset(token)
+
+def record_statement(query, args, elapsed):
+    """Учитывает выполненное выражение в трассировках и пишет в журнал медленные запросы."""
+    storage = in_storage.get()
+    trace = current_trace.get()
+    while trace is not None:
+        if trace.active:
+            (trace.storage_statements if storage else trace.statements).append((query, elapsed))
+        trace = trace.parent
+    if elapsed * 1000 >= query_trace_config['slow_query_ms']:
+        sql = " ".join(str(query).split())[:SLOW_QUERY_LOG_LIMIT]
+        params = repr(args)[:SLOW_QUERY_LOG_LIMIT]
+        print(f"Медленный запрос ({elapsed * 1000:.0f} мс): {sql} | параметры: {params}")
+
+
+class TracedCursorMixin:
+    """Замеряет каждое обращение к серверу (executemany с многострочной вставкой — одно выражение)."""
+
+    async def execute(self, query, args=None):
+        started = time.perf_counter()
+        try:
+            return await super().execute(query, args)
+        finally:
+            record_statement(query, args, time.perf_counter() - started)
+
+
+class Cursor(TracedCursorMixin, aiomysql.Cursor):
+    pass
+
+
+class DictCursor(TracedCursorMixin, aiomysql.DictCursor):
+    pass
+
+
+class SSDictCursor(TracedCursorMixin, aiomysql.SSDictCursor):
+    pass
+
+
+# Общий пул подключений процесса (создается в main.py при запуске)
+pool = None
+
+async def create_db_pool():
+    """Создает общий пул подключений к базе данных."""
+    global pool
+    if pool is None:
+        pool = await aiomysql.create_pool(autocommit=True, cursorclass=Cursor, **pool_config, **db_config)
+    return pool
+
+async def close_db_pool():
+    """Закрывает общий пул подключений."""
+    global pool
+    if pool is not None:
+        pool.close()
+        await pool.wait_closed()
+        pool = None
+
+# Функция для подключения к базе данных
+def get_db_connection():
+    """Возвращает подключение из пула (использовать как async with get_db_connection() as conn)."""
+    if pool is None:
+        raise RuntimeError("Пул подключений к базе данных не инициализирован")
+    return TimedAcquire(pool.acquire())
+
+# Буферы отложенной записи оценок (запускаются в main.py, сбрасываются при остановке)
+rating_buffer_config = {
+    'max_batch': int(os.getenv('RATING_BUFFER_SIZE', 100)),  # Сбрасывать при накоплении N строк
+    'flush_interval': float(os.getenv('RATING_FLUSH_INTERVAL', 1.0)),  # ...или раз в N секунд
+    'max_size': int(os.getenv('RATING_BUFFER_MAX_SIZE', 10000)),  # Больше строк не держим: оценка не принимается
+}
+# queued — подтверждать оценку после постановки в буфер, persisted — после записи в БД
+RATING_WRITE_MODE = os.getenv('RATING_WRITE_MODE', 'queued')
+# Допустимые оценки и длина токена ссылки (столбцы token/link_token — VARCHAR(32))
+RATING_SCORES = range(1, 6)
+MAX_TOKEN_LENGTH = 32
+
+# Агрегаты оценок по часам и дням (таблица rating_rollups): сумма и количество на каждого оцениваемого пользователя
+def rating_buckets(created_at):
+    """Возвращает начала часового и дневного интервалов для момента оценки."""
+    hour_start = created_at.replace(minute=0, second=0, microsecond=0)
+    return hour_start, hour_start.replace(hour=0)
+
+async def update_rating_rollups(cursor, rows):
+    """Добавляет пачку оценок (rated_user_id, rater_user_id, score, created_at) в агрегаты."""
+    totals = {}
+    for rated_user_id, _, score, created_at in rows:
+        hour_start, day_start = rating_buckets(created_at)
+        for key in ((rated_user_id, 'hour', hour_start), (rated_user_id, 'day', day_start)):
+            score_sum, ratings_count = totals.get(key, (0, 0))
+            totals[key] = (score_sum + score, ratings_count + 1)
+    await cursor.executemany(
+        """
+        INSERT INTO rating_rollups (rated_user_id, bucket, bucket_start, score_sum, ratings_count)
+        VALUES (%s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            score_sum = score_sum + VALUES(score_sum),
+            ratings_count = ratings_count + VALUES(ratings_count)
+        """,
+        [(*key, score_sum, ratings_count) for key, (score_sum, ratings_count) in totals.items()]
+    )
+
+rating_buffer = WriteBehindBuffer(
+    "ratings",
+    "INSERT INTO ratings (rated_user_id, rater_user_id, score, created_at) VALUES (%s, %s, %s, %s)",
+    get_db_connection,
+    key=lambda row: (row[1], row[0]),  # (rater_user_id, rated_user_id)
+    after_write=update_rating_rollups,
+    **rating_buffer_config
+)
+question_rating_buffer = WriteBehindBuffer(
+    "question_ratings",
+    "INSERT INTO question_ratings (token, question_id, rater_id, score) VALUES (%s, %s, %s, %s)",
+    get_db_connection,
+    key=lambda row: (row[0], row[2]),  # (token, rater_id)
+    **rating_buffer_config
+)
+
+def start_rating_buffers():
+    """Запускает фоновый сброс буферов оценок."""
+    rating_buffer.start()
+    question_rating_buffer.start()
+
+async def close_rating_buffers():
+    """Записывает в БД все оценки, оставшиеся в буферах."""
+    await rating_buffer.close()
+    await question_rating_buffer.close()
+
+# Кэш прав доступа (подписка, VIP, оплата, админ) по tg_id
+ENTITLEMENT_TTL = float(os.getenv('ENTITLEMENT_CACHE_TTL', 60))  # Время жизни записи в секундах
+ENTITLEMENT_CACHE_SIZE = int(os.getenv('ENTITLEMENT_CACHE_SIZE', 10000))  # Максимум записей (LRU)
+entitlement_cache = OrderedDict()  # tg_id -> (время истечения, права)
 
-def generate_token(length=16):
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+@track_query
+async def get_entitlements(tg_id):
+    """Возвращает все права пользователя одним запросом (с кэшированием на ENTITLEMENT_TTL секунд)."""
+    cached = entitlement_cache.get(tg_id)
+    if cached and cached[0] > time.monotonic():
+        entitlement_cache.move_to_end(tg_id)
+        return cached[1]
 
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
+            await cursor.execute(
+                """
+                SELECT
+                    EXISTS(SELECT 1 FROM users WHERE tg_id = %s AND is_admin = TRUE) AS is_admin,
+                    EXISTS(SELECT 1 FROM payments WHERE user_id = %s AND status = 'success') AS has_successful_payment,
+                    (SELECT MAX(access_end) FROM payments
+                     WHERE user_id = %s AND status = 'success' AND access_end > NOW()) AS access_end,
+                    (SELECT MAX(access_end) FROM payments
+                     WHERE user_id = %s AND status = 'success' AND is_vip = TRUE AND access_end > NOW()) AS vip_access_end
+                """,
+                (tg_id, tg_id, tg_id, tg_id)
+            )
+            row = await cursor.fetchone()
+
+    entitlements = {
+        'is_admin': bool(row['is_admin']),
+        'has_successful_payment': bool(row['has_successful_payment']),
+        'has_active_access': row['access_end'] is not None,
+        'is_vip': row['vip_access_end'] is not None,
+    }
+
+    # Запись не должна пережить окончание подписки
+    ttl = ENTITLEMENT_TTL
+    for access_end in (row['access_end'], row['vip_access_end']):
+        if access_end is not None:
+            ttl = min(ttl, max((access_end - datetime.now()).total_seconds(), 0))
+
+    entitlement_cache[tg_id] = (time.monotonic() + ttl, entitlements)
+    entitlement_cache.move_to_end(tg_id)
+    while len(entitlement_cache) > ENTITLEMENT_CACHE_SIZE:
+        entitlement_cache.popitem(last=False)
+    return entitlements
+
+def invalidate_entitlements(*tg_ids):
+    """Сбрасывает кэш прав для указанных пользователей (без аргументов — для всех)."""
+    if not tg_ids:
+        entitlement_cache.clear()
+        return
+    for tg_id in tg_ids:
+        entitlement_cache.pop(tg_id, None)
+
+# Каталог вопросов в памяти: id -> вопрос и нормализованный текст -> id.
+# Загружается одним запросом и перечитывается через QUESTION_CATALOG_TTL секунд
+# (чтобы увидеть вопросы, добавленные другими процессами); update_questions_list обновляет его сразу
+QUESTION_CATALOG_TTL = float(os.getenv('QUESTION_CATALOG_TTL', 300))
+QUESTION_PAGE_SIZE = int(os.getenv('QUESTION_PAGE_SIZE', 10))  # Вопросов на странице выбора
+
+def normalize_question(text):
+    """Ключ для поиска дубликатов: без учета регистра и лишних пробелов."""
+    return " ".join(text.casefold().split())
+
+
+class QuestionCatalog:
+    def __init__(self, ttl=QUESTION_CATALOG_TTL):
+        self.ttl = ttl
+        self.by_id = {}  # id -> {"id", "text"}
+        self.by_text = {}  # нормализованный текст -> id
+        self.expires_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def ensure_loaded(self):
+        if self.expires_at > time.monotonic():
+            return
+        async with self._lock:
+            if self.expires_at > time.monotonic():
+                return  # Каталог загрузил другой обработчик, пока мы ждали
+            async with get_db_connection() as conn:
+                async with conn.cursor(DictCursor) as cur:
+                    await cur.execute("SELECT id, text FROM questions ORDER BY id")
+                    rows = await cur.fetchall()
+            self.by_id = {row['id']: row for row in rows}
+            self.by_text = {normalize_question(row['text']): row['id'] for row in rows}
+            self.expires_at = time.monotonic() + self.ttl
+
+    def add(self, question_id, text):
+        row = {'id': question_id, 'text': text}
+        self.by_id[question_id] = row
+        self.by_text[normalize_question(text)] = question_id
+
+    def invalidate(self):
+        self.expires_at = 0.0
+
+
+question_catalog = QuestionCatalog()
+
+@track_query
 async def get_all_questions():
-    async with await get_db_connection() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute("SELECT * FROM questions")
-            return await cur.fetchall()
+    """Все вопросы по порядку id (из каталога в памяти)."""
+    await question_catalog.ensure_loaded()
+    return list(question_catalog.by_id.values())
 
+@track_query
+async def get_questions_page(page, page_size=QUESTION_PAGE_SIZE):
+    """Страница вопросов для клавиатуры выбора. Возвращает (вопросы, номер страницы, число страниц)."""
+    await question_catalog.ensure_loaded()
+    questions = list(question_catalog.by_id.values())
+    pages = max((len(questions) + page_size - 1) // page_size, 1)
+    page = min(max(page, 0), pages - 1)
+    return questions[page * page_size:(page + 1) * page_size], page, pages
+
+@track_query
 async def create_question_link(user_id, question_ids):
-    token = generate_token()
-    async with await get_db_connection() as conn:
+    async with get_db_connection() as conn:
         async with conn.cursor() as cur:
-            await cur.execute("INSERT INTO question_links (user_id, token) VALUES (%s, %s)", (user_id, token))
-            link_id = cur.lastrowid
-            for qid in question_ids:
-                await cur.execute("INSERT INTO question_link_items (link_id, question_id) VALUES (%s, %s)", (link_id, qid))
-            await conn.commit()
+            try:
+                await conn.begin()
+                # Уникальность токена гарантирует индекс question_links.token
+                token = await execute_with_unique_token(
+                    cur,
+                    "INSERT INTO question_links (user_id, token) VALUES (%s, %s)",
+                    lambda token: (user_id, token)
+                )
+                link_id = cur.lastrowid
+                await cur.executemany(
+                    "INSERT INTO question_link_items (link_id, question_id) VALUES (%s, %s)",
+                    [(link_id, qid) for qid in question_ids]
+                )
+                await conn.commit()
+            except Exception as e:
+                await conn.rollback()
+                raise
     return f"https://t.me/RatePPBot?start=rate_{token}"
 
-async def get_questions_by_token(token):
-    async with await get_db_connection() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute("""
-                SELECT q.id, q.text FROM questions q
-                JOIN question_link_items qi ON qi.question_id = q.id
-                JOIN question_links l ON qi.link_id = l.id
+# Реестр токенов ссылок: персональные ссылки (users.link_token) и опросы (question_links.token)
+# разрешаются одним запросом. Метаданные опросов неизменяемы и кэшируются без срока жизни,
+# персональные ссылки — на LINK_CACHE_TTL секунд (пользователь может перевыпустить ссылку)
+LINK_CACHE_SIZE = int(os.getenv('LINK_CACHE_SIZE', 10000))  # Максимум записей (LRU)
+LINK_CACHE_TTL = float(os.getenv('LINK_CACHE_TTL', 60))  # Время жизни записи персональной ссылки в секундах
+LINK_TTL_DAYS = int(os.getenv('LINK_TTL_DAYS', 0))  # Срок действия ссылок в днях (0 — бессрочно)
+link_cache = OrderedDict()  # token -> (время истечения записи, метаданные)
+
+def cache_link(token, link):
+    expires = float('inf') if link['kind'] == 'questions' else time.monotonic() + LINK_CACHE_TTL
+    link_cache[token] = (expires, link)
+    link_cache.move_to_end(token)
+    while len(link_cache) > LINK_CACHE_SIZE:
+        link_cache.popitem(last=False)
+
+def invalidate_user_links(owner_id):
+    """Сбрасывает кэшированные персональные ссылки пользователя (после выпуска новой)."""
+    for token in [t for t, (_, link) in link_cache.items() if link['kind'] == 'user' and link['owner_id'] == owner_id]:
+        del link_cache[token]
+
+def link_from_rows(rows):
+    """Метаданные ссылки из строк resolve_link_token (для опроса — по строке на вопрос)."""
+    first = rows[0]
+    link = {
+        'kind': first['kind'],
+        'owner_id': first['owner_id'],
+        'first_name': first['first_name'],
+        'questions': [{'id': row['question_id'], 'text': row['question_text']} for row in rows if row['question_id']],
+        'expires_at': first['created_at'] + timedelta(days=LINK_TTL_DAYS) if LINK_TTL_DAYS and first['created_at'] else None,
+    }
+    return link
+
+@track_query
+async def resolve_link_token(token, rater_id):
+    """Разрешает токен из /start rate_<token>: тип ссылки (user или questions), владелец, вопросы,
+    срок действия и флаг already_rated для rater_id. Один запрос к БД (при попадании в кэш — только флаг).
+    Возвращает None, если токен не найден."""
+    cached = link_cache.get(token)
+    if cached and cached[0] > time.monotonic():
+        link_cache.move_to_end(token)
+        link = dict(cached[1])
+        if link['kind'] == 'user':
+            link['already_rated'] = await get_existing_rating(rater_id, link['owner_id']) is not None
+        else:
+            link['already_rated'] = await has_rated_token(token, rater_id)
+        return link
+
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
+            await cursor.execute(
+                """
+                SELECT 'user' AS kind, u.tg_id AS owner_id, u.first_name, u.link_created_at AS created_at,
+                       EXISTS(SELECT 1 FROM ratings r
+                              WHERE r.rater_user_id = %s AND r.rated_user_id = u.tg_id) AS already_rated,
+                       NULL AS question_id, NULL AS question_text
+                FROM users u
+                WHERE u.link_token = %s
+                UNION ALL
+                SELECT 'questions', l.user_id, NULL, l.created_at,
+                       EXISTS(SELECT 1 FROM question_ratings qr
+                              WHERE qr.token = l.token AND qr.rater_id = %s),
+                       q.id, q.text
+                FROM question_links l
+                JOIN question_link_items qi ON qi.link_id = l.id
+                JOIN questions q ON q.id = qi.question_id
                 WHERE l.token = %s
-            """, (token,))
-            return await cur.fetchall()
+                ORDER BY question_id
+                """,
+                (rater_id, token, rater_id, token)
+            )
+            rows = await cursor.fetchall()
+    if not rows:
+        return None
+
+    # Персональная ссылка имеет приоритет, как и раньше в start_command
+    kind = 'user' if any(row['kind'] == 'user' for row in rows) else 'questions'
+    rows = [row for row in rows if row['kind'] == kind]
+    link = link_from_rows(rows)
+    cache_link(token, link)
+    link = dict(link)
+    if link['kind'] == 'user':
+        link['already_rated'] = bool(rows[0]['already_rated']) or rating_buffer.contains((rater_id, link['owner_id']))
+    else:
+        link['already_rated'] = bool(rows[0]['already_rated']) or question_rating_buffer.contains((token, rater_id))
+    return link
 
+@track_query
 async def save_question_rating(token, question_id, rater_id, score):
-    async with await get_db_connection() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute("""
-                INSERT INTO question_ratings (token, question_id, rater_id, score)
-                VALUES (%s, %s, %s, %s)
-            """, (token, question_id, rater_id, score))
-            await conn.commit()
+    """Ставит оценку вопроса в буфер записи (при RATING_WRITE_MODE=persisted — ждет записи в БД)."""
+    await question_rating_buffer.add(
+        (token, question_id, rater_id, score),
+        wait=RATING_WRITE_MODE == 'persisted'
+    )
 
+@track_query
 async def update_questions_list(question):
     try:
-        async with await get_db_connection() as conn:
+        async with get_db_connection() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
                     "INSERT INTO questions (text) VALUES (%s)",
-                    (question)
+                    (question,)
                 )
                 await conn.commit()
+                if question_catalog.expires_at:
+                    question_catalog.add(cur.lastrowid, question)
                 return True
     except Exception as e:
         print(f"Ошибка при добавлении вопроса: {e}")
         return False
 
+@track_query
 async def question_exists(question_text: str) -> bool:
-    """Проверяет, существует ли вопрос в таблице questions."""
-    async with await get_db_connection() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute(
-                """
-                SELECT EXISTS(
-                    SELECT 1 FROM questions 
-                    WHERE LOWER(text) = LOWER(%s)
-                    LIMIT 1
-                )
-                """,
-                (question_text,)
-            )
-            result = await cur.fetchone()
-            return bool(result[0])
-        
-async def get_token_owner(token):
-    async with await get_db_connection() as conn:
+    """Проверяет, существует ли вопрос (без учета регистра и лишних пробелов) — по каталогу в памяти."""
+    await question_catalog.ensure_loaded()
+    return normalize_question(question_text) in question_catalog.by_text
+
+@track_query
+async def import_questions(questions):
+    """Добавляет вопросы пачкой: дубликаты (среди существующих и внутри пачки) отбрасываются по каталогу,
+    остальные вставляются одним executemany в одной транзакции. Возвращает (добавлено, пропущено)."""
+    await question_catalog.ensure_loaded()
+    new_questions, seen, skipped = [], set(question_catalog.by_text), 0
+    for question in questions:
+        key = normalize_question(question)
+        if key in seen:
+            skipped += 1
+            continue
+        seen.add(key)
+        new_questions.append((question,))
+    if not new_questions:
+        return 0, skipped
+
+    async with get_db_connection() as conn:
         async with conn.cursor() as cur:
-            await cur.execute("SELECT user_id FROM question_links WHERE token = %s", (token,))
-            row = await cur.fetchone()
-            return row[0] if row else None
+            try:
+                await conn.begin()
+                await cur.executemany("INSERT INTO questions (text) VALUES (%s)", new_questions)
+                await conn.commit()
+            except Exception as e:
+                await conn.rollback()
+                raise e
+    # Длинная пачка может уйти несколькими выражениями, поэтому id не угадываем — перечитаем каталог
+    question_catalog.invalidate()
+    return len(new_questions), skipped
 
+@track_query
 async def has_rated_token(token, user_id):
-    async with await get_db_connection() as conn:
+    if question_rating_buffer.contains((token, user_id)):
+        return True
+    async with get_db_connection() as conn:
         async with conn.cursor() as cur:
             await cur.execute("""
                 SELECT COUNT(*) FROM question_ratings 
@@ -114,73 +510,66 @@ async def has_rated_token(token, user_id):
             row = await cur.fetchone()
             return row[0] > 0
         
+@track_query
 async def get_poll_results(user_id, detailed=False):
     if not detailed:
         # Возвращает: [{"text": "Вопрос", "avg": 4.2}]
-        async with await get_db_connection() as conn:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
+        async with get_db_connection() as conn:
+            async with conn.cursor(DictCursor) as cur:
                 await cur.execute("""
                     SELECT q.text, AVG(r.score) as avg
                     FROM question_ratings r
                     JOIN question_links l ON r.token = l.token
-                    JOIN question_link_items qi ON qi.link_id = l.id
                     JOIN questions q ON r.question_id = q.id
                     WHERE l.user_id = %s
-                    GROUP BY q.id
+                    GROUP BY q.id, q.text
+                    ORDER BY q.id
                 """, (user_id,))
                 return await cur.fetchall()
 
     else:
         # Возвращает: [{"username": ..., "questions": [{"text": ..., "avg_score": ...}, ...]}]
-        async with await get_db_connection() as conn:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                # Получаем список всех уникальных вопросов пользователя с средними оценками
-                await cur.execute("""
-                    SELECT q.id, q.text, AVG(r.score) as avg_score
-                    FROM question_ratings r
-                    JOIN question_links l ON r.token = l.token
-                    JOIN question_link_items qi ON qi.link_id = l.id
-                    JOIN questions q ON r.question_id = q.id
-                    WHERE l.user_id = %s
-                    GROUP BY q.id
-                    ORDER BY q.id
-                """, (user_id,))
-                questions = await cur.fetchall()
-                
-                # Получаем всех оценивающих пользователей
-                await cur.execute("""
-                    SELECT DISTINCT r.rater_id, u.username
-                    FROM question_ratings r
-                    JOIN question_links l ON r.token = l.token
-                    LEFT JOIN users u ON u.tg_id = r.rater_id
-                    WHERE l.user_id = %s
-                """, (user_id,))
-                raters = await cur.fetchall()
-
-        # Создаем результат
-        result = []
-        for rater in raters:
-            rater_data = {
-                "username": rater["username"],
-                "questions": []
-            }
-            
-            # Для каждого вопроса добавляем среднюю оценку
-            for question in questions:
-                rater_data["questions"].append({
-                    "text": question["text"],
-                    "avg_score": question["avg_score"]
-                })
-            
-            result.append(rater_data)
-
-        return result
+        return [rater async for rater in iter_poll_results_detailed(user_id)]
+
+@track_query
+async def iter_poll_results_detailed(user_id):
+    """Построчно отдает оценки каждого голосовавшего по каждому вопросу (один сгруппированный запрос,
+    серверный курсор): {"rater_id": ..., "username": ..., "questions": [{"text": ..., "avg_score": ...}]}."""
+    async with get_db_connection() as conn:
+        async with conn.cursor(SSDictCursor) as cur:
+            await cur.execute("""
+                SELECT r.rater_id, MAX(u.username) AS username, q.id AS question_id,
+                       MAX(q.text) AS text, AVG(r.score) AS avg_score
+                FROM question_ratings r
+                JOIN question_links l ON r.token = l.token
+                JOIN questions q ON r.question_id = q.id
+                LEFT JOIN users u ON u.tg_id = r.rater_id
+                WHERE l.user_id = %s
+                GROUP BY r.rater_id, q.id
+                ORDER BY r.rater_id, q.id
+            """, (user_id,))
+
+            rater = None
+            while True:
+                row = await cur.fetchone()
+                if row is None:
+                    break
+                if rater is None or rater["rater_id"] != row["rater_id"]:
+                    if rater is not None:
+                        yield rater
+                    rater = {"rater_id": row["rater_id"], "username": row["username"], "questions": []}
+                rater["questions"].append({"text": row["text"], "avg_score": row["avg_score"]})
+            if rater is not None:
+                yield rater
 
 # Функция для создания или получения пользователя
+@track_query
 async def set_user(user_id, first_name, username=None):
     """Создает или обновляет пользователя в базе данных."""
-    async with await get_db_connection() as connection:
-        async with connection.cursor(aiomysql.DictCursor) as cursor:
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
+            # Пул работает в autocommit: без begin() вставка зафиксировалась бы отдельно от счетчика панели
+            await connection.begin()
             try:
                 await cursor.execute(
                     """
@@ -192,6 +581,9 @@ async def set_user(user_id, first_name, username=None):
                     """,
                     (user_id, first_name, username)
                 )
+                if cursor.rowcount == 1:
+                    # Вставлена новая строка (при обновлении rowcount равен 0 или 2)
+                    await bump_dashboard(cursor, {'users': 1})
                 await connection.commit()
                 return True
             except Exception as e:
@@ -199,158 +591,163 @@ async def set_user(user_id, first_name, username=None):
                 raise
 
 # Функция для получения пользователя по токену
+@track_query
 async def get_user_by_token(token):
     """Возвращает пользователя по токену."""
-    connection = await get_db_connection()
-    cursor = await connection.cursor(aiomysql.DictCursor)
-
-    try:
-        await cursor.execute("SELECT * FROM users WHERE link_token = %s", (token,))
-        user = await cursor.fetchone()
-        return user
-    except Exception as e:
-        raise
-    finally:
-        await cursor.close()
-        connection.close()
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
+            await cursor.execute("SELECT * FROM users WHERE link_token = %s", (token,))
+            user = await cursor.fetchone()
+            return user
 
 # Функция для сохранения рейтинга
+@track_query
 async def save_rating(rater_user_id, rated_user_id, score):
-    """Сохраняет оценку, которую один пользователь поставил другому."""
-    connection = await get_db_connection()
-    cursor = await connection.cursor(aiomysql.DictCursor)
+    """Сохраняет оценку, которую один пользователь поставил другому (через буфер записи)."""
+    # Проверяем, существует ли уже такая оценка (в буфере или в БД)
+    if await get_existing_rating(rater_user_id, rated_user_id):
+        return False
 
-    try:
-        # Проверяем, существует ли уже такая оценка
-        await cursor.execute(
-            "SELECT * FROM ratings WHERE rater_user_id = %s AND rated_user_id = %s",
-            (rater_user_id, rated_user_id)
-        )
-        existing_rating = await cursor.fetchone()
-
-        if existing_rating:
-            return False
-
-        # Сохраняем новую оценку
-        await cursor.execute(
-            "INSERT INTO ratings (rated_user_id, rater_user_id, score) VALUES (%s, %s, %s)",
-            (rated_user_id, rater_user_id, score)
-        )
-        await connection.commit()
-        return True
-    except Exception as e:
-        await connection.rollback()
-        raise
-    finally:
-        await cursor.close()
-        connection.close()
+    # Сохраняем новую оценку
+    await rating_buffer.add(
+        (rated_user_id, rater_user_id, score, datetime.now()),
+        wait=RATING_WRITE_MODE == 'persisted'
+    )
+    return True
 
 # Функция для получения всех рейтингов для пользователя
+@track_query
 async def get_ratings_for_user(user_id):
     """Возвращает все оценки, которые получил пользователь."""
-    connection = await get_db_connection()
-    cursor = await connection.cursor(aiomysql.DictCursor)
-
-    try:
-        await cursor.execute("SELECT * FROM ratings WHERE rated_user_id = %s", (user_id,))
-        ratings = await cursor.fetchall()
-        return ratings
-    except Exception as e:
-        raise
-    finally:
-        await cursor.close()
-        connection.close()
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
+            await cursor.execute("SELECT * FROM ratings WHERE rated_user_id = %s", (user_id,))
+            ratings = await cursor.fetchall()
+            return ratings
 
 # Проверка на повторную оценку
+@track_query
 async def get_existing_rating(rater_user_id, rated_user_id):
     """Проверяет, существует ли уже оценка от одного пользователя другому."""
-    connection = await get_db_connection()
-    cursor = await connection.cursor(aiomysql.DictCursor)
-
-    try:
-        await cursor.execute(
-            "SELECT * FROM ratings WHERE rater_user_id = %s AND rated_user_id = %s",
-            (rater_user_id, rated_user_id)
-        )
-        existing_rating = await cursor.fetchone()
-        return existing_rating
-    except Exception as e:
-        raise
-    finally:
-        await cursor.close()
-        connection.close()
+    if rating_buffer.contains((rater_user_id, rated_user_id)):
+        return {'rater_user_id': rater_user_id, 'rated_user_id': rated_user_id}
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
+            await cursor.execute(
+                "SELECT * FROM ratings WHERE rater_user_id = %s AND rated_user_id = %s",
+                (rater_user_id, rated_user_id)
+            )
+            existing_rating = await cursor.fetchone()
+            return existing_rating
 
 # Функция для получения статистики (средний балл и количество оценок) за указанный период
+@track_query
 async def get_statistics(user_id, period):
-    """Возвращает средний балл и количество оценок за указанный период."""
-    connection = await get_db_connection()
-    cursor = await connection.cursor()
+    """Возвращает средний балл и количество оценок за указанный период.
+    Считается по агрегатам rating_rollups: полные дни + полные часы по краям окна,
+    и только неполный первый час добирается из ratings."""
+    # Определяем временной интервал
+    now = datetime.now()
+    if period == "day":
+        start_time = now - timedelta(days=1)
+    elif period == "week":
+        start_time = now - timedelta(weeks=1)
+    elif period == "month":
+        start_time = now - timedelta(days=30)
+    else:
+        raise ValueError("Некорректный период")
 
-    try:
-        # Определяем временной интервал
-        now = datetime.now()
-        if period == "day":
-            start_time = now - timedelta(days=1)
-        elif period == "week":
-            start_time = now - timedelta(weeks=1)
-        elif period == "month":
-            start_time = now - timedelta(days=30)
-        else:
-            raise ValueError("Некорректный период")
-
-        # Запрашиваем статистику
-        await cursor.execute(
-            "SELECT AVG(score), COUNT(id) FROM ratings WHERE rated_user_id = %s AND created_at >= %s",
-            (user_id, start_time)
-        )
-        stats = await cursor.fetchone()
-        return stats
-    except Exception as e:
-        raise
-    finally:
-        await cursor.close()
-        connection.close()
+    # Границы: [start_time, first_hour) — сырые оценки, [first_hour, first_day) — часы,
+    # [first_day, today) — дни, [today, ...) — часы текущего дня
+    first_hour = start_time.replace(minute=0, second=0, microsecond=0)
+    if first_hour < start_time:
+        first_hour += timedelta(hours=1)
+    first_day = first_hour.replace(hour=0)
+    if first_day < first_hour:
+        first_day += timedelta(days=1)
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    async with get_db_connection() as connection:
+        async with connection.cursor() as cursor:
+            # Запрашиваем статистику
+            await cursor.execute(
+                """
+                SELECT SUM(score_sum) / NULLIF(SUM(ratings_count), 0), COALESCE(SUM(ratings_count), 0)
+                FROM (
+                    SELECT score_sum, ratings_count FROM rating_rollups
+                    WHERE rated_user_id = %s AND bucket = 'day'
+                      AND bucket_start >= %s AND bucket_start < %s
+                    UNION ALL
+                    SELECT score_sum, ratings_count FROM rating_rollups
+                    WHERE rated_user_id = %s AND bucket = 'hour'
+                      AND bucket_start >= %s AND bucket_start < %s
+                    UNION ALL
+                    SELECT score_sum, ratings_count FROM rating_rollups
+                    WHERE rated_user_id = %s AND bucket = 'hour' AND bucket_start >= %s
+                    UNION ALL
+                    SELECT SUM(score), COUNT(id) FROM ratings
+                    WHERE rated_user_id = %s AND created_at >= %s AND created_at < %s
+                ) buckets
+                """,
+                (user_id, first_day, today,
+                 user_id, first_hour, min(first_day, today),
+                 user_id, max(first_day, today),
+                 user_id, start_time, first_hour)
+            )
+            stats = await cursor.fetchone()
+            return stats
 
 # Проверка, действителен ли токен (срок действия токена — 1 неделя)
+@track_query
 async def is_token_valid(user_id):
     """Проверяет, действителен ли токен пользователя."""
-    connection = await get_db_connection()
-    cursor = await connection.cursor(aiomysql.DictCursor)
-
-    try:
-        # Извлекаем пользователя по tg_id
-        await cursor.execute("SELECT link_token, link_created_at FROM users WHERE tg_id = %s", (user_id,))
-        user = await cursor.fetchone()
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
+            try:
+                # Извлекаем пользователя по tg_id
+                await cursor.execute("SELECT link_token, link_created_at FROM users WHERE tg_id = %s", (user_id,))
+                user = await cursor.fetchone()
 
-        if user and user['link_token']:  # Обращаемся по имени поля
-            # Рассчитываем время окончания действия токена
-            expiration_time = user['link_created_at'] + timedelta(weeks=1)  # Обращаемся по имени поля
+                if user and user['link_token']:  # Обращаемся по имени поля
+                    # Рассчитываем время окончания действия токена
+                    expiration_time = user['link_created_at'] + timedelta(weeks=1)  # Обращаемся по имени поля
 
-            # Сравниваем с текущим временем
-            if expiration_time > datetime.now():
-                return True  # Токен действителен
-            else:
-                # Если токен истек, очищаем его и дату создания
-                await cursor.execute(
-                    "UPDATE users SET link_token = NULL, link_created_at = NULL WHERE tg_id = %s",
-                    (user_id,)
-                )
-                await connection.commit()
-                return False  # Токен просрочен
-        return False  # Если пользователь не найден или токен отсутствует
-    except Exception as e:
-        await connection.rollback()
-        raise
-    finally:
-        await cursor.close()
-        connection.close()
+                    # Сравниваем с текущим временем
+                    if expiration_time > datetime.now():
+                        return True  # Токен действителен
+                    else:
+                        # Если токен истек, очищаем его и дату создания
+                        await cursor.execute(
+                            "UPDATE users SET link_token = NULL, link_created_at = NULL WHERE tg_id = %s",
+                            (user_id,)
+                        )
+                        await connection.commit()
+                        return False  # Токен просрочен
+                return False  # Если пользователь не найден или токен отсутствует
+            except Exception as e:
+                await connection.rollback()
+                raise
 
 # Функция для сохранения платежа
+@track_query
 async def save_payment(user_id, amount, transaction_id, payment_url, access_start, access_end, period, is_vip=False):
     """Сохраняет информацию о платеже."""
-    async with await get_db_connection() as connection:
-        async with connection.cursor(aiomysql.DictCursor) as cursor:
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
+            await connection.begin()
             try:
+                # Плательщик — пользователь с хотя бы одной строкой в payments или payments_archive
+                # (так же считает reconcile_dashboard). Блокировка строки пользователя не дает двум
+                # одновременным первым платежам обоим увидеть «строк нет» и дважды увеличить счетчик
+                await cursor.execute("SELECT tg_id FROM users WHERE tg_id = %s FOR UPDATE", (user_id,))
+                await cursor.execute(
+                    """
+                    SELECT EXISTS(SELECT 1 FROM payments WHERE user_id = %s)
+                        OR EXISTS(SELECT 1 FROM payments_archive WHERE user_id = %s) AS has_payments
+                    """,
+                    (user_id, user_id)
+                )
+                first_payment = not (await cursor.fetchone())['has_payments']
                 await cursor.execute(
                     """
                     INSERT INTO payments (user_id, amount, transaction_id, payment_url, access_start, access_end, period, is_vip, status, created_at)
@@ -358,209 +755,401 @@ async def save_payment(user_id, amount, transaction_id, payment_url, access_star
                     """,
                     (user_id, amount, transaction_id, payment_url, access_start, access_end, period, is_vip)
                 )
+                if first_payment:
+                    await bump_dashboard(cursor, {'payers': 1})
                 await connection.commit()
+                invalidate_entitlements(user_id)
                 return True
             except Exception as e:
                 await connection.rollback()
                 raise
 
 # Функция для получения ссылки на оплату
+@track_query
 async def get_payment_url(user_id):
     """Возвращает ссылку на оплату для пользователя."""
-    connection = await get_db_connection()
-    cursor = await connection.cursor(aiomysql.DictCursor)
-
-    try:
-        await cursor.execute(
-            "SELECT payment_url FROM payments WHERE user_id = %s ORDER BY id DESC LIMIT 1",
-            (user_id,)
-        )
-        payment = await cursor.fetchone()
-        return payment[0] if payment else None
-    except Exception as e:
-        raise
-    finally:
-        await cursor.close()
-        connection.close()
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
+            await cursor.execute(
+                "SELECT payment_url FROM payments WHERE user_id = %s ORDER BY id DESC LIMIT 1",
+                (user_id,)
+            )
+            payment = await cursor.fetchone()
+            return payment[0] if payment else None
 
 # Функция для получения последнего платежа пользователя
+@track_query
 async def get_last_payment(user_id):
     """Возвращает последний платеж пользователя."""
-    connection = await get_db_connection()
-    cursor = await connection.cursor(aiomysql.DictCursor)
-
-    try:
-        await cursor.execute(
-            "SELECT * FROM payments WHERE user_id = %s ORDER BY id DESC LIMIT 1",
-            (user_id,)
-        )
-        payment = await cursor.fetchone()
-        return payment
-    except Exception as e:
-        raise
-    finally:
-        await cursor.close()
-        connection.close()
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
+            await cursor.execute(
+                "SELECT * FROM payments WHERE user_id = %s ORDER BY id DESC LIMIT 1",
+                (user_id,)
+            )
+            payment = await cursor.fetchone()
+            return payment
 
+@track_query
 async def has_active_access(user_id: int) -> bool:
     """Проверяет, есть ли у пользователя активная подписка."""
-    connection = await get_db_connection()
-    cursor = await connection.cursor(aiomysql.DictCursor)
-
-    try:
-        await cursor.execute(
-            """
-            SELECT * FROM payments 
-            WHERE user_id = %s 
-              AND access_end > NOW() 
-              AND status = 'success' 
-            ORDER BY access_end DESC 
-            LIMIT 1
-            """,
-            (user_id,)
-        )
-        active_payment = await cursor.fetchone()
-        return active_payment is not None
-    except Exception as e:
-        raise
-    finally:
-        await cursor.close()
-        connection.close()
+    entitlements = await get_entitlements(user_id)
+    return entitlements['has_active_access']
 
+@track_query
 async def get_subscription_time_left(user_id):
     """Возвращает оставшееся время подписки в днях, часах и минутах."""
-    connection = await get_db_connection()
-    cursor = await connection.cursor(aiomysql.DictCursor)
-    try:
-        # Получаем самую позднюю активную подписку
-        await cursor.execute(
-            "SELECT access_end FROM payments WHERE user_id = %s AND access_end > NOW() ORDER BY access_end DESC LIMIT 1",
-            (user_id,)
-        )
-        subscription = await cursor.fetchone()
-
-        if subscription:
-            access_end = subscription['access_end']  # Дата окончания подписки
-            now = datetime.now()
-            time_left = access_end - now  # Оставшееся время
-
-            # Преобразуем время в дни, часы и минуты
-            days_left = time_left.days
-            hours_left, remainder = divmod(time_left.seconds, 3600)
-            minutes_left, _ = divmod(remainder, 60)
-
-            return {
-                "days": days_left,
-                "hours": hours_left,
-                "minutes": minutes_left
-            }
-        else:
-            return None  # Если активной подписки нет
-    except Exception as e:
-        raise
-    finally:
-        await cursor.close()
-        connection.close()
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
+            # Получаем самую позднюю активную подписку
+            await cursor.execute(
+                "SELECT access_end FROM payments WHERE user_id = %s AND access_end > NOW() ORDER BY access_end DESC LIMIT 1",
+                (user_id,)
+            )
+            subscription = await cursor.fetchone()
+
+            if subscription:
+                access_end = subscription['access_end']  # Дата окончания подписки
+                now = datetime.now()
+                time_left = access_end - now  # Оставшееся время
 
+                # Преобразуем время в дни, часы и минуты
+                days_left = time_left.days
+                hours_left, remainder = divmod(time_left.seconds, 3600)
+                minutes_left, _ = divmod(remainder, 60)
+
+                return {
+                    "days": days_left,
+                    "hours": hours_left,
+                    "minutes": minutes_left
+                }
+            else:
+                return None  # Если активной подписки нет
+
+@track_query
 async def update_payment_status(transaction_id, new_status):
     """Обновляет статус платежа."""
-    connection = await get_db_connection()
-    cursor = await connection.cursor(aiomysql.DictCursor)
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
+            await connection.begin()
+            try:
+                await cursor.execute(
+                    "SELECT user_id, amount, is_vip, status, created_at FROM payments WHERE transaction_id = %s FOR UPDATE",
+                    (transaction_id,)
+                )
+                payment = await cursor.fetchone()
+                await cursor.execute(
+                    "UPDATE payments SET status = %s WHERE transaction_id = %s",
+                    (new_status, transaction_id)
+                )
+                if payment and new_status == 'success' and payment['status'] != 'success':
+                    await bump_dashboard(cursor, paid_deltas([payment]), payment['created_at'])
+                await connection.commit()
+                if payment:
+                    invalidate_entitlements(payment['user_id'])
+                return True
+            except Exception as e:
+                await connection.rollback()
+                raise
 
-    try:
-        await cursor.execute(
-            "UPDATE payments SET status = %s WHERE transaction_id = %s",
-            (new_status, transaction_id)
-        )
-        await connection.commit()
-        return True
-    except Exception as e:
-        await connection.rollback()
-        raise
-    finally:
-        await cursor.close()
-        connection.close()
+@track_query
+async def get_pending_payments():
+    """Возвращает все ожидающие оплаты платежи (для фоновой сверки)."""
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
+            await cursor.execute(
+                """
+                SELECT user_id, transaction_id, amount, period, is_vip, created_at
+                FROM payments
+                WHERE status = 'pending'
+                ORDER BY created_at
+                """
+            )
+            return await cursor.fetchall()
 
+@track_query
+async def update_payments_status_bulk(transaction_ids, new_status):
+    """Обновляет статус сразу у нескольких ожидающих платежей одним запросом.
+    Возвращает только те платежи, которые этот вызов перевел из 'pending' (другой процесс мог успеть раньше)."""
+    if not transaction_ids:
+        return []
+    placeholders = ", ".join(["%s"] * len(transaction_ids))
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
+            await connection.begin()
+            try:
+                await cursor.execute(
+                    f"""
+                    SELECT transaction_id, user_id, amount, is_vip, created_at FROM payments
+                    WHERE transaction_id IN ({placeholders}) AND status = 'pending'
+                    FOR UPDATE
+                    """,
+                    tuple(transaction_ids)
+                )
+                payments = await cursor.fetchall()
+                if not payments:
+                    await connection.commit()
+                    return []
+                # Строки заблокированы FOR UPDATE, поэтому обновятся ровно выбранные платежи
+                locked = [payment['transaction_id'] for payment in payments]
+                await cursor.execute(
+                    f"UPDATE payments SET status = %s WHERE transaction_id IN ({', '.join(['%s'] * len(locked))})",
+                    (new_status, *locked)
+                )
+                if new_status == 'success':
+                    by_day = {}
+                    for payment in payments:
+                        by_day.setdefault(payment['created_at'].date(), []).append(payment)
+                    for day_payments in by_day.values():
+                        await bump_dashboard(cursor, paid_deltas(day_payments), day_payments[0]['created_at'])
+                await connection.commit()
+                invalidate_entitlements(*{payment['user_id'] for payment in payments})
+                return list(payments)
+            except Exception as e:
+                await connection.rollback()
+                raise
+
+@track_query
 async def is_payment_successful(user_id: int) -> bool:
     """Проверяет, есть ли у пользователя успешный платеж."""
-    connection = await get_db_connection()
-    cursor = await connection.cursor(aiomysql.DictCursor)
-
     try:
-        await cursor.execute(
-            """
-            SELECT status FROM payments 
-            WHERE user_id = %s AND status = 'success' 
-            ORDER BY id DESC 
-            LIMIT 1
-            """,
-            (user_id,)
-        )
-        payment = await cursor.fetchone()
-        return payment is not None  # Возвращает True, если есть успешный платеж
+        entitlements = await get_entitlements(user_id)
+        return entitlements['has_successful_payment']  # Возвращает True, если есть успешный платеж
     except Exception as e:
         print(f"Ошибка при проверке статуса платежа: {e}")
         raise
-    finally:
-        await cursor.close()
-        connection.close()
 
+@track_query
 async def is_payment_expired(transaction_id: str) -> bool:
     """Проверяет, истекло ли время жизни платежа."""
-    connection = await get_db_connection()
-    cursor = await connection.cursor(aiomysql.DictCursor)
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
+            await cursor.execute(
+                """
+                SELECT created_at, status FROM payments 
+                WHERE transaction_id = %s
+                """,
+                (transaction_id,)
+            )
+            payment = await cursor.fetchone()
+
+            if payment:
+                created_at = payment['created_at']
+                status = payment['status']
+
+                # Если платеж не оплачен и создан более 10 минут назад
+                if status == 'pending' and datetime.now() - created_at > timedelta(minutes=10):
+                    return True  # Платеж истек
+            return False  # Платеж не истек
 
-    try:
-        await cursor.execute(
-            """
-            SELECT created_at, status FROM payments 
-            WHERE transaction_id = %s
-            """,
-            (transaction_id,)
-        )
-        payment = await cursor.fetchone()
-
-        if payment:
-            created_at = payment['created_at']
-            status = payment['status']
-
-            # Если платеж не оплачен и создан более 10 минут назад
-            if status == 'pending' and datetime.now() - created_at > timedelta(minutes=10):
-                return True  # Платеж истек
-        return False  # Платеж не истек
-    except Exception as e:
-        raise
-    finally:
-        await cursor.close()
-        connection.close()
 
+# Счетчики панели администратора (таблица dashboard_counters): итоги и значения по дням.
+# Обновляются вместе с изменениями (set_user, save_payment, смена статуса платежа)
+# и периодически пересчитываются по исходным таблицам (reconcile_dashboard)
+TOTAL_BUCKET = datetime(1970, 1, 1).date()  # bucket_start для итоговых значений
+DASHBOARD_LOCK = 'ratebot_dashboard'
+# Оплаченные платежи: текущие и перенесенные в архив
+PAID_PAYMENTS = """
+    SELECT is_vip, amount, created_at FROM payments WHERE status = 'success'
+    UNION ALL
+    SELECT is_vip, amount, created_at FROM payments_archive
+"""
 
-async def delete_expired_payments(interval_minutes: int = 5) -> int:
-    """Удаляет платежи, которые не были оплачены в течение указанного интервала,
-    а также платежи, у которых закончилась подписка.
-    Возвращает количество удаленных записей."""
-    async with await get_db_connection() as connection:
-        async with connection.cursor(aiomysql.DictCursor) as cursor:
+def paid_deltas(payments):
+    """Приращения счетчиков для платежей, перешедших в статус success."""
+    deltas = {}
+    for payment in payments:
+        kind = 'vip' if payment['is_vip'] else 'normal'
+        deltas[f'payments_{kind}'] = deltas.get(f'payments_{kind}', 0) + 1
+        deltas[f'revenue_{kind}'] = deltas.get(f'revenue_{kind}', 0) + payment['amount']
+    return deltas
+
+async def bump_dashboard(cursor, deltas, at=None):
+    """Прибавляет значения к итогам и к дневному интервалу момента at (в той же транзакции, что и изменение)."""
+    day = (at or datetime.now()).date()
+    rows = []
+    for metric, value in deltas.items():
+        rows.append(('total', TOTAL_BUCKET, metric, value))
+        rows.append(('day', day, metric, value))
+    await cursor.executemany(
+        """
+        INSERT INTO dashboard_counters (period, bucket_start, metric, value) VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE value = value + VALUES(value)
+        """,
+        rows
+    )
+
+@track_query
+async def get_dashboard(days=7):
+    """Итоги и значения по дням за последние days дней одним запросом к dashboard_counters."""
+    since = (datetime.now() - timedelta(days=days - 1)).date()
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
+            await cursor.execute(
+                """
+                SELECT period, bucket_start, metric, value FROM dashboard_counters
+                WHERE period = 'total' OR (period = 'day' AND bucket_start >= %s)
+                """,
+                (since,)
+            )
+            rows = await cursor.fetchall()
+    totals = {}
+    series = {since + timedelta(days=i): {} for i in range(days)}
+    for row in rows:
+        if row['period'] == 'total':
+            totals[row['metric']] = row['value']
+        elif row['bucket_start'] in series:
+            series[row['bucket_start']][row['metric']] = row['value']
+    return {'totals': totals, 'days': sorted(series.items())}
+
+@track_query
+async def reconcile_dashboard(days=30):
+    """Пересчитывает итоги и последние days дней по исходным таблицам (исправляет накопленные расхождения)."""
+    since = (datetime.now() - timedelta(days=days - 1)).date()
+    async with get_db_connection() as connection:
+        async with connection.cursor() as cursor:
+            await cursor.execute("SELECT GET_LOCK(%s, 0)", (DASHBOARD_LOCK,))
+            if not (await cursor.fetchone())[0]:
+                return False  # Пересчет уже выполняет другой процесс
             try:
-                # Удаляем платежи, которые не были оплачены в течение указанного интервала
-                # ИЛИ у которых закончилась подписка
-                await cursor.execute(
-                    """
-                    DELETE FROM payments 
-                    WHERE (status = 'pending' AND created_at < NOW() - INTERVAL %s MINUTE)
-                       OR (access_end < NOW())
-                    """,
-                    (interval_minutes,)
-                )
-                await connection.commit()
-            except Exception as e:
-                await connection.rollback()
-                return 0
-            
+                await connection.begin()
+                try:
+                    await cursor.execute(
+                        "DELETE FROM dashboard_counters WHERE period = 'total' OR (period = 'day' AND bucket_start >= %s)",
+                        (since,)
+                    )
+                    await cursor.execute(
+                        f"""
+                        INSERT INTO dashboard_counters (period, bucket_start, metric, value)
+                        SELECT 'total', %s, 'users', COUNT(*) FROM users
+                        UNION ALL
+                        SELECT 'total', %s, 'payers', COUNT(*) FROM (
+                            SELECT user_id FROM payments UNION SELECT user_id FROM payments_archive
+                        ) payers
+                        UNION ALL
+                        SELECT 'total', %s, CONCAT('payments_', IF(is_vip, 'vip', 'normal')), COUNT(*)
+                        FROM ({PAID_PAYMENTS}) paid GROUP BY is_vip
+                        UNION ALL
+                        SELECT 'total', %s, CONCAT('revenue_', IF(is_vip, 'vip', 'normal')), SUM(amount)
+                        FROM ({PAID_PAYMENTS}) paid GROUP BY is_vip
+                        """,
+                        (TOTAL_BUCKET,) * 4
+                    )
+                    await cursor.execute(
+                        f"""
+                        INSERT INTO dashboard_counters (period, bucket_start, metric, value)
+                        SELECT 'day', DATE(created_at), 'users', COUNT(*) FROM users
+                        WHERE created_at >= %s GROUP BY DATE(created_at)
+                        UNION ALL
+                        SELECT 'day', DATE(created_at), CONCAT('payments_', IF(is_vip, 'vip', 'normal')), COUNT(*)
+                        FROM ({PAID_PAYMENTS}) paid WHERE created_at >= %s GROUP BY DATE(created_at), is_vip
+                        UNION ALL
+                        SELECT 'day', DATE(created_at), CONCAT('revenue_', IF(is_vip, 'vip', 'normal')), SUM(amount)
+                        FROM ({PAID_PAYMENTS}) paid WHERE created_at >= %s GROUP BY DATE(created_at), is_vip
+                        """,
+                        (since, since, since)
+                    )
+                    await connection.commit()
+                except Exception:
+                    await connection.rollback()
+                    raise
+            finally:
+                await cursor.execute("SELECT RELEASE_LOCK(%s)", (DASHBOARD_LOCK,))
+                await cursor.fetchone()
+    return True
+
+# Очистка платежей небольшими пачками по первичному ключу, чтобы не блокировать таблицу надолго
+sweeper_config = {
+    'batch_size': int(os.getenv('PAYMENT_SWEEP_BATCH', 500)),  # Строк в одной пачке
+    'pause': float(os.getenv('PAYMENT_SWEEP_PAUSE', 0.1)),  # Пауза между пачками в секундах
+}
+SWEEPER_LOCK = 'ratebot_payment_sweeper'
+PAYMENT_COLUMNS = "id, user_id, amount, transaction_id, payment_url, access_start, access_end, period, is_vip, status, created_at"
+
+@track_query
+async def sweep_expired_payments(interval_minutes: int = 5):
+    """Удаляет неоплаченные за interval_minutes платежи и переносит оплаченные платежи с истекшим доступом
+    в payments_archive (история нужна для статистики расходов). Работает пачками по id с паузами;
+    одновременно выполняется только в одном процессе (GET_LOCK). Возвращает счетчики или None,
+    если очистку уже выполняет другой процесс."""
+    started = time.perf_counter()
+    result = {'deleted': 0, 'archived': 0, 'batches': 0}
+    async with get_db_connection() as connection:
+        async with connection.cursor() as cursor:
+            await cursor.execute("SELECT GET_LOCK(%s, 0)", (SWEEPER_LOCK,))
+            if not (await cursor.fetchone())[0]:
+                return None
+            try:
+                # Неоплаченные платежи удаляются, оплаченные с истекшим доступом — переносятся в архив,
+                # прочие (не оплаченные, но с истекшим доступом) — удаляются
+                sweeps = [
+                    ('deleted', "status = 'pending' AND created_at < NOW() - INTERVAL %s MINUTE", (interval_minutes,)),
+                    ('archived', "status = 'success' AND access_end < NOW()", ()),
+                    ('deleted', "status NOT IN ('pending', 'success') AND access_end < NOW()", ()),
+                ]
+                for counter, condition, params in sweeps:
+                    while True:
+                        # Пачка блокируется FOR UPDATE в той же транзакции, что и удаление: сверка платежей
+                        # не сможет перевести платеж в success между выборкой и удалением
+                        await connection.begin()
+                        try:
+                            await cursor.execute(
+                                f"SELECT id, user_id FROM payments WHERE {condition} ORDER BY id LIMIT %s FOR UPDATE",
+                                (*params, sweeper_config['batch_size'])
+                            )
+                            rows = await cursor.fetchall()
+                            if not rows:
+                                await connection.commit()
+                                break
+                            ids = [row[0] for row in rows]
+                            placeholders = ", ".join(["%s"] * len(ids))
+                            if counter == 'archived':
+                                await cursor.execute(
+                                    f"""
+                                    INSERT IGNORE INTO payments_archive ({PAYMENT_COLUMNS}, archived_at)
+                                    SELECT {PAYMENT_COLUMNS}, NOW() FROM payments WHERE id IN ({placeholders})
+                                    """,
+                                    ids
+                                )
+                            await cursor.execute(f"DELETE FROM payments WHERE id IN ({placeholders})", ids)
+                            if counter == 'deleted':
+                                # У пользователя удалена последняя строка платежа — он больше не плательщик
+                                # по определению reconcile_dashboard (payments UNION payments_archive)
+                                users = list({row[1] for row in rows})
+                                user_placeholders = ", ".join(["%s"] * len(users))
+                                await cursor.execute(
+                                    f"""
+                                    SELECT COUNT(*) FROM users WHERE tg_id IN ({user_placeholders})
+                                    AND NOT EXISTS(SELECT 1 FROM payments WHERE payments.user_id = users.tg_id)
+                                    AND NOT EXISTS(SELECT 1 FROM payments_archive
+                                                   WHERE payments_archive.user_id = users.tg_id)
+                                    """,
+                                    users
+                                )
+                                gone = (await cursor.fetchone())[0]
+                                if gone:
+                                    await bump_dashboard(cursor, {'payers': -gone})
+                            await connection.commit()
+                        except Exception:
+                            await connection.rollback()
+                            raise
+                        invalidate_entitlements(*{row[1] for row in rows})
+                        result[counter] += len(ids)
+                        result['batches'] += 1
+                        if len(ids) < sweeper_config['batch_size']:
+                            break
+                        await asyncio.sleep(sweeper_config['pause'])
+            finally:
+                await cursor.execute("SELECT RELEASE_LOCK(%s)", (SWEEPER_LOCK,))
+                await cursor.fetchone()
+    result['seconds'] = round(time.perf_counter() - started, 3)
+    return result
+
+@track_query
 async def get_active_payment(user_id):
     """Получает активный платеж пользователя, если он существует."""
-    async with await get_db_connection() as connection:
-        async with connection.cursor(aiomysql.DictCursor) as cursor:
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
             await cursor.execute(
                 """
                 SELECT payment_url FROM payments 
@@ -572,10 +1161,11 @@ async def get_active_payment(user_id):
             )
             return await cursor.fetchone()
         
+@track_query
 async def delete_active_payment(user_id):
     """Удаляет активный платеж пользователя."""
-    async with await get_db_connection() as connection:
-        async with connection.cursor(aiomysql.DictCursor) as cursor:
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
             try:
                 await cursor.execute(
                     """
@@ -586,15 +1176,17 @@ async def delete_active_payment(user_id):
                     (user_id,)
                 )
                 await connection.commit()
+                invalidate_entitlements(user_id)
                 return True
             except Exception as e:
                 await connection.rollback()
                 raise
 
+@track_query
 async def get_voters(user_id):
     """Возвращает список пользователей, которые оценили текущего пользователя, и их оценки."""
-    async with await get_db_connection() as connection:
-        async with connection.cursor(aiomysql.DictCursor) as cursor:
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
             await cursor.execute(
                 """
                 SELECT u.first_name, u.username, r.score 
@@ -605,168 +1197,240 @@ async def get_voters(user_id):
                 (user_id,)
             )
             return await cursor.fetchall()
-        
+
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 1000))  # Строк выгрузки, читаемых за один раз
+
+@track_query
+async def iter_ratings_export(user_id, chunk_size=EXPORT_CHUNK_SIZE):
+    """Отдает пачками по chunk_size строк все оценки пользователя: оценки профиля и ответы на его вопросы.
+    Серверный курсор не загружает результат целиком, поэтому память не зависит от числа оценок."""
+    async with get_db_connection() as conn:
+        async with conn.cursor(SSDictCursor) as cur:
+            await cur.execute("""
+                SELECT 'profile' AS kind, r.created_at, r.rater_user_id AS rater_id, u.username, u.first_name,
+                       NULL AS question, r.score
+                FROM ratings r
+                LEFT JOIN users u ON u.tg_id = r.rater_user_id
+                WHERE r.rated_user_id = %s
+                UNION ALL
+                SELECT 'question', qr.created_at, qr.rater_id, u.username, u.first_name, q.text, qr.score
+                FROM question_ratings qr
+                JOIN question_links l ON qr.token = l.token
+                JOIN questions q ON q.id = qr.question_id
+                LEFT JOIN users u ON u.tg_id = qr.rater_id
+                WHERE l.user_id = %s
+            """, (user_id, user_id))
+            while True:
+                rows = await cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+
+@track_query
 async def check_vip_status(user_id):
     """Проверяет, есть ли у пользователя активная VIP-подписка."""
-    async with await get_db_connection() as connection:
-        async with connection.cursor(aiomysql.DictCursor) as cursor:
-            try:
+    try:
+        entitlements = await get_entitlements(user_id)
+        return entitlements['is_vip']  # Возвращаем True, если есть активная VIP-подписка
+    except Exception as e:
+        return False
+
+@track_query
+async def is_admin(tg_id):
+    entitlements = await get_entitlements(tg_id)
+    return entitlements['is_admin']
+        
+# Каталог цен в памяти: таблица subscription_prices крошечная и меняется редко.
+# Изменения увеличивают catalog_versions.version; другие процессы сверяют версию
+# не чаще раза в PRICE_VERSION_CHECK секунд в фоне, не задерживая оформление оплаты
+PRICE_VERSION_CHECK = float(os.getenv('PRICE_VERSION_CHECK', 30))
+
+
+class PriceCatalog:
+    def __init__(self, check_interval=PRICE_VERSION_CHECK):
+        self.check_interval = check_interval
+        self.prices = {}  # (период, is_vip) -> цена
+        self.version = None  # None — каталог еще не загружен
+        self.checked_at = 0.0
+        self._refresh_task = None
+
+    async def load(self):
+        """Загружает все цены и версию каталога одним запросом."""
+        async with get_db_connection() as connection:
+            async with connection.cursor(DictCursor) as cursor:
                 await cursor.execute(
                     """
-                    SELECT id FROM payments 
-                    WHERE user_id = %s 
-                    AND is_vip = TRUE 
-                    AND access_end > NOW() 
-                    AND status = 'success'
-                    LIMIT 1
-                    """,
-                    (user_id,)
+                    SELECT v.version, p.period, p.price, p.is_vip
+                    FROM catalog_versions v
+                    LEFT JOIN subscription_prices p ON TRUE
+                    WHERE v.name = 'prices'
+                    """
                 )
-                result = await cursor.fetchone()
-                return bool(result)  # Возвращаем True, если есть активная VIP-подписка
-            except Exception as e:
-                return False
-
-async def get_total_users():
-    """Возвращает общее количество пользователей, зашедших в бота."""
-    async with await get_db_connection() as connection:
-        async with connection.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("SELECT COUNT(*) as total FROM users")
-            result = await cursor.fetchone()
-            return result.get('total', 0)
-
-async def get_users_with_links():
-    """Возвращает количество пользователей, сгенерировавших ссылку."""
-    async with await get_db_connection() as connection:
-        async with connection.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("SELECT COUNT(DISTINCT user_id) as total FROM payments")
-            result = await cursor.fetchone()
-            return result.get('total', 0)
-
-async def get_payment_stats():
-    """Возвращает статистику по оплаченным тарифам."""
-    async with await get_db_connection() as connection:
-        async with connection.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute(
-                """
-                SELECT 
-                    SUM(CASE WHEN is_vip = FALSE AND status = 'success' THEN 1 ELSE 0 END) as normal_payments,
-                    SUM(CASE WHEN is_vip = TRUE AND status = 'success' THEN 1 ELSE 0 END) as vip_payments
-                FROM payments
-                """
-            )
-            result = await cursor.fetchone()
-            return result
-        
-async def is_admin(tg_id):
-    async with await get_db_connection() as connection:
-        async with connection.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute(
-                """
-                SELECT id from users
-                WHERE tg_id = %s
-                AND is_admin = TRUE
-                """,
-                (tg_id,)
-            )
-            result = await cursor.fetchone()
-            return result
-        
+                rows = await cursor.fetchall()
+        self.prices = {(row['period'], bool(row['is_vip'])): row['price'] for row in rows if row['period'] is not None}
+        self.version = rows[0]['version'] if rows else 0
+        self.checked_at = time.monotonic()
+
+    async def refresh(self):
+        """Перечитывает каталог, если другой процесс изменил цены."""
+        try:
+            async with get_db_connection() as connection:
+                async with connection.cursor() as cursor:
+                    await cursor.execute("SELECT version FROM catalog_versions WHERE name = 'prices'")
+                    row = await cursor.fetchone()
+            if row and row[0] != self.version:
+                await self.load()
+            self.checked_at = time.monotonic()
+        except Exception as e:
+            print(f"Ошибка при проверке версии цен: {e}")
+        finally:
+            self._refresh_task = None
+
+    async def ensure_fresh(self):
+        if self.version is None:
+            await self.load()
+        elif time.monotonic() - self.checked_at > self.check_interval and self._refresh_task is None:
+            # Отдаем текущие цены, а версию проверяем в фоне
+            self._refresh_task = asyncio.create_task(self.refresh())
+
+
+price_catalog = PriceCatalog()
+
+async def load_price_catalog():
+    """Загружает каталог цен (вызывается при запуске бота)."""
+    await price_catalog.load()
+
+@track_query
 async def get_subscription_price(period, is_vip=False):
     """Возвращает цену подписки для указанного периода и типа (VIP или обычный)."""
-    async with await get_db_connection() as connection:
-        async with connection.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute(
-                "SELECT price FROM subscription_prices WHERE period = %s AND is_vip = %s",
-                (period, is_vip)
-            )
-            result = await cursor.fetchone()
-            return result['price'] if result else None
+    await price_catalog.ensure_fresh()
+    return price_catalog.prices.get((period, bool(is_vip)))
+
+@track_query
+async def get_all_prices():
+    """Возвращает все цены: [{'period', 'price', 'is_vip'}, ...]."""
+    await price_catalog.ensure_fresh()
+    return [
+        {'period': period, 'price': price, 'is_vip': is_vip}
+        for (period, is_vip), price in sorted(price_catalog.prices.items(), key=lambda item: (item[0][1], item[1]))
+    ]
 
+@track_query
 async def update_subscription_price(period, price, is_vip=False):
-    """Обновляет цену на подписку для указанного периода и удаляет старые записи."""
-    async with await get_db_connection() as connection:
-        async with connection.cursor(aiomysql.DictCursor) as cursor:
+    """Устанавливает цену подписки (одна строка на период и тип) и обновляет каталог в памяти."""
+    price = Decimal(str(price)).quantize(Decimal('0.01'))
+    async with get_db_connection() as connection:
+        async with connection.cursor() as cursor:
             try:
-                # Начало транзакции
                 await connection.begin()
-
-                # Проверка существования записи
                 await cursor.execute(
-                    "SELECT price FROM subscription_prices WHERE period = %s AND is_vip = %s",
-                    (period, is_vip)
+                    """
+                    INSERT INTO subscription_prices (period, price, is_vip) VALUES (%s, %s, %s)
+                    ON DUPLICATE KEY UPDATE price = VALUES(price)
+                    """,
+                    (period, price, is_vip)
                 )
-                existing_record = await cursor.fetchone()
-
-                if existing_record:
-                    existing_price = existing_record['price']
-                    if existing_price != price:
-                        # Если цена отличается, обновляем запись и удаляем старые
-                        await cursor.execute(
-                            """
-                            UPDATE subscription_prices
-                            SET price = %s
-                            WHERE period = %s AND is_vip = %s
-                            """,
-                            (price, period, is_vip)
-                        )
-                        await cursor.execute(
-                            """
-                            DELETE FROM subscription_prices
-                            WHERE period = %s AND is_vip = %s AND price != %s
-                            """,
-                            (period, is_vip, price)
-                        )
-                    else:
-                        # Если цена совпадает, ничего не делаем
-                        await connection.commit()
-                        return True
-                else:
-                    # Если записи не существует, создаем новую
-                    await cursor.execute(
-                        """
-                        INSERT INTO subscription_prices (period, price, is_vip)
-                        VALUES (%s, %s, %s)
-                        """,
-                        (period, price, is_vip)
-                    )
-
-                # Фиксация транзакции
+                # Новая версия каталога возвращается через LAST_INSERT_ID без отдельного SELECT
+                await cursor.execute(
+                    "UPDATE catalog_versions SET version = LAST_INSERT_ID(version + 1) WHERE name = 'prices'"
+                )
+                version = cursor.lastrowid
                 await connection.commit()
-                return True
             except Exception as e:
                 # Откат транзакции в случае ошибки
                 await connection.rollback()
                 raise e
-            
-async def get_total_spent_on_subscriptions():
-    """Возвращает общую сумму, потраченную на обычные и VIP-подписки (только успешные платежи)."""
-    async with await get_db_connection() as connection:
-        async with connection.cursor(aiomysql.DictCursor) as cursor:
-            # Сумма для обычных подписок (только успешные платежи)
+
+    # Запись сквозь кэш: этот процесс видит новую цену сразу
+    price_catalog.prices[(period, bool(is_vip))] = price
+    if price_catalog.version is not None and version == price_catalog.version + 1:
+        price_catalog.version = version
+    else:
+        price_catalog.checked_at = 0.0  # Пропущены изменения других процессов — перечитаем при следующем обращении
+    return True
+
+# Рассылки администратора: получатели читаются страницами по users.id (keyset), прогресс хранится в broadcasts
+@track_query
+async def create_broadcast(admin_id, text):
+    """Создает рассылку по всем пользователям и возвращает ее строку."""
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
             await cursor.execute(
-                """
-                SELECT SUM(amount) as total_normal 
-                FROM payments 
-                WHERE is_vip = FALSE AND status = 'success'
-                """
+                "INSERT INTO broadcasts (admin_id, text, total) SELECT %s, %s, COUNT(*) FROM users",
+                (admin_id, text)
             )
-            total_normal = await cursor.fetchone()
-            total_normal = total_normal.get('total_normal', 0) or 0
+            await cursor.execute("SELECT * FROM broadcasts WHERE id = %s", (cursor.lastrowid,))
+            return await cursor.fetchone()
 
-            # Сумма для VIP-подписок (только успешные платежи)
+@asynccontextmanager
+async def claim_broadcast(broadcast_id):
+    """Закрепляет рассылку за этим процессом на время выполнения (GET_LOCK на отдельном подключении).
+    Отдает актуальную строку рассылки или None, если ее уже выполняет другой процесс или она завершена."""
+    lock_name = f'ratebot_broadcast_{broadcast_id}'
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
+            await cursor.execute("SELECT GET_LOCK(%s, 0) AS locked", (lock_name,))
+            if not (await cursor.fetchone())['locked']:
+                yield None
+                return
+            try:
+                # Контрольная точка могла сдвинуться, пока рассылку выполнял другой процесс
+                await cursor.execute("SELECT * FROM broadcasts WHERE id = %s AND status = 'running'", (broadcast_id,))
+                yield await cursor.fetchone()
+            finally:
+                await cursor.execute("SELECT RELEASE_LOCK(%s)", (lock_name,))
+                await cursor.fetchone()
+
+@track_query
+async def get_running_broadcasts():
+    """Возвращает незавершенные рассылки (для продолжения после перезапуска)."""
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
+            await cursor.execute("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id")
+            return await cursor.fetchall()
+
+@track_query
+async def get_broadcast_recipients(after_id, limit):
+    """Следующая страница получателей после users.id = after_id (без OFFSET, по первичному ключу)."""
+    async with get_db_connection() as connection:
+        async with connection.cursor(DictCursor) as cursor:
+            await cursor.execute(
+                "SELECT id, tg_id FROM users WHERE id > %s ORDER BY id LIMIT %s",
+                (after_id, limit)
+            )
+            return await cursor.fetchall()
+
+@track_query
+async def save_broadcast_progress(broadcast_id, last_user_id, delivered, failed, status='running'):
+    """Сохраняет контрольную точку рассылки: последний обработанный users.id и счетчики."""
+    async with get_db_connection() as connection:
+        async with connection.cursor() as cursor:
             await cursor.execute(
                 """
-                SELECT SUM(amount) as total_vip 
-                FROM payments 
-                WHERE is_vip = TRUE AND status = 'success'
-                """
+                UPDATE broadcasts SET last_user_id = %s, delivered = %s, failed = %s, status = %s
+                WHERE id = %s AND status = 'running'
+                """,
+                (last_user_id, delivered, failed, status, broadcast_id)
+            )
+            return cursor.rowcount > 0
+
+@track_query
+async def set_broadcast_message(broadcast_id, message_id):
+    """Запоминает сообщение администратора, в котором показывается ход рассылки."""
+    async with get_db_connection() as connection:
+        async with connection.cursor() as cursor:
+            await cursor.execute(
+                "UPDATE broadcasts SET progress_message_id = %s WHERE id = %s",
+                (message_id, broadcast_id)
+            )
+
+@track_query
+async def cancel_broadcast(broadcast_id):
+    """Останавливает рассылку. Возвращает False, если она уже завершена."""
+    async with get_db_connection() as connection:
+        async with connection.cursor() as cursor:
+            await cursor.execute(
+                "UPDATE broadcasts SET status = 'cancelled' WHERE id = %s AND status = 'running'",
+                (broadcast_id,)
             )
-            total_vip = await cursor.fetchone()
-            total_vip = total_vip.get('total_vip', 0) or 0
-
-            return {
-                'total_normal': total_normal,
-                'total_vip': total_vip,
-                'total': total_normal + total_vip
-            }
\ No newline at end of file
+            return cursor.rowcount > 0
@@ -0,0 +1,178 @@
+import time
+import asyncio
+
+import aiomysql
+
+# Ошибки, в которых виновата сама строка (значение вне диапазона, слишком длинное, нарушение ограничения):
+# повтор такой пачки не поможет, ее нужно писать по одной строке
+DATA_ERRORS = (aiomysql.DataError, aiomysql.IntegrityError)
+
+
+class BufferFull(Exception):
+    """Буфер заполнен до max_size: БД не успевает или недоступна, новые строки не принимаются."""
+
+
+class WriteBehindBuffer:
+    """Буфер отложенной записи: копит строки и вставляет их пачкой (многострочный INSERT)
+    по достижении max_batch строк или раз в flush_interval секунд.
+    Если запись не удалась, строки остаются в буфере и записываются повторно с нарастающей паузой:
+    подтвержденные пользователю строки отбрасываются только при окончательном сбросе во время остановки.
+    Если БД отвергает саму пачку (DATA_ERRORS), строки пишутся по одной, а отвергнутые записываются в журнал
+    и отбрасываются. Больше max_size строк буфер не держит: add() бросает BufferFull."""
+
+    def __init__(self, name, insert_sql, connection_factory, key=None, after_write=None,
+                 max_batch=100, flush_interval=1.0, max_retries=3, max_backoff=60.0, max_size=10000):
+        self.name = name
+        self.insert_sql = insert_sql  # INSERT ... VALUES (%s, ...) — executemany склеит его в один запрос
+        self.connection_factory = connection_factory
+        self.key = key  # Функция ключа строки для проверки дублей среди еще не записанных строк
+        self.after_write = after_write  # async (cursor, rows) — доп. запросы в той же транзакции
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries  # После стольких неудач подряд ожидающие записи (wait=True) получают ошибку
+        self.max_backoff = max_backoff  # Максимальная пауза между повторами в секундах
+        self.max_size = max_size  # Максимум строк в буфере: дальше add() отказывает, а не копит память
+        self._rows = []  # Список (строка, future или None)
+        self._keys = {}  # Ключ -> количество ожидающих строк
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._closed = False
+        self._failures = 0  # Неудачных сбросов подряд
+        self._retry_at = 0.0  # До этого момента (time.monotonic) повторно не пишем
+
+    @property
+    def running(self):
+        return self._task is not None and not self._closed
+
+    def start(self):
+        """Запускает фоновую задачу сброса буфера."""
+        if self._task is None:
+            self._closed = False
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Перестает принимать строки и записывает все, что осталось в буфере."""
+        self._closed = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush(final=True)
+
+    def contains(self, key):
+        """Проверяет, есть ли строка с таким ключом среди еще не записанных."""
+        return key in self._keys
+
+    def __len__(self):
+        return len(self._rows)
+
+    async def add(self, row, wait=False):
+        """Добавляет строку в буфер. При wait=True ждет, пока строка будет записана в БД."""
+        if not self.running:
+            # Буфер не запущен (скрипты, тесты) — пишем сразу
+            await self._write([row])
+            return
+
+        if len(self._rows) >= self.max_size:
+            raise BufferFull(f"Буфер {self.name} заполнен ({len(self._rows)} строк)")
+        future = asyncio.get_running_loop().create_future() if wait else None
+        self._rows.append((row, future))
+        if self.key is not None:
+            key = self.key(row)
+            self._keys[key] = self._keys.get(key, 0) + 1
+        if len(self._rows) >= self.max_batch:
+            self._wakeup.set()
+        if wait:
+            await future
+
+    async def _run(self):
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self, final=False):
+        """Записывает накопленные строки пачками по max_batch."""
+        async with self._lock:
+            if not final and time.monotonic() < self._retry_at:
+                return  # БД недавно не ответила — ждем окончания паузы
+            while self._rows:
+                batch = self._rows[:self.max_batch]
+                try:
+                    try:
+                        await self._write([row for row, _ in batch])
+                        self._release(batch)
+                    except DATA_ERRORS as e:
+                        print(f"БД отвергла пачку буфера {self.name} ({len(batch)} строк), пишем по одной: {e}")
+                        await self._write_each(batch)
+                except Exception as e:
+                    self._failures += 1
+                    print(f"Ошибка при записи буфера {self.name} ({len(batch)} строк, "
+                          f"попытка {self._failures}, в буфере {len(self._rows)}): {e}")
+                    if final:
+                        # Остановка: повторять больше некому — сообщаем ожидающим и отбрасываем пачку
+                        # (при записи по одной часть пачки уже снята с буфера — берем то, что осталось)
+                        self._release(self._rows[:len(batch)], error=e)
+                        continue
+                    if self._failures >= self.max_retries:
+                        # Ожидающим записи (режим persisted) сообщаем об ошибке — им оценка еще не подтверждена;
+                        # подтвержденные строки остаются в буфере до успешной записи
+                        self._fail_waiters(e)
+                    delay = min(self.flush_interval * 2 ** self._failures, self.max_backoff)
+                    self._retry_at = time.monotonic() + delay
+                    return
+                self._failures = 0
+                self._retry_at = 0.0
+
+    async def _write_each(self, batch):
+        """Пишет пачку по одной строке, снимая каждую с начала буфера. Отвергнутые БД строки записываются
+        в журнал и отбрасываются; любая другая ошибка (нет соединения) прерывает запись — остаток пачки
+        остается в буфере."""
+        for row, future in batch:
+            try:
+                await self._write([row])
+            except DATA_ERRORS as e:
+                print(f"Строка буфера {self.name} отвергнута БД и отброшена: {row!r}: {e}")
+                self._release([(row, future)], error=e)
+            else:
+                self._release([(row, future)])
+
+    def _release(self, batch, error=None):
+        del self._rows[:len(batch)]
+        self._forget(batch, error)
+
+    def _fail_waiters(self, error):
+        waiting = [item for item in self._rows if item[1] is not None]
+        if waiting:
+            self._rows = [item for item in self._rows if item[1] is None]
+            self._forget(waiting, error)
+
+    def _forget(self, batch, error=None):
+        for row, future in batch:
+            if self.key is not None:
+                key = self.key(row)
+                self._keys[key] -= 1
+                if not self._keys[key]:
+                    del self._keys[key]
+            if future is not None and not future.done():
+                if error is None:
+                    future.set_result(True)
+                else:
+                    future.set_exception(error)
+
+    async def _write(self, rows):
+        async with self.connection_factory() as connection:
+            async with connection.cursor() as cursor:
+                try:
+                    await connection.begin()
+                    await cursor.executemany(self.insert_sql, rows)
+                    if self.after_write is not None:
+                        await self.after_write(cursor, rows)
+                    await connection.commit()
+                except Exception:
+                    await connection.rollback()
+                    raise
@@ -1,13 +1,12 @@
+from functools import lru_cache
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
-# Главная клавиатура
-def generate_main_menu():
-    return InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Меню", callback_data='back_to_menu')]
-        ]
-    )
+# Клавиатуры aiogram неизменяемы (frozen pydantic-модели), поэтому готовые разметки кэшируются:
+# статические — целиком, параметризованные — в LRU-кэше с ограниченным размером
+KEYBOARD_CACHE_SIZE = 1024
 
 # Клавиатура для меню с действиями
+@lru_cache(maxsize=None)
 def generate_main_menu(is_admin=False):
     """Генерирует главное меню."""
     buttons = [
@@ -20,23 +19,42 @@ def generate_main_menu(is_admin=False):
         buttons.append([InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")])
         buttons.append([InlineKeyboardButton(text="💰 Управление ценами", callback_data="manage_prices")])
         buttons.append([InlineKeyboardButton(text="➕ Добавить вопросы", callback_data="add_questions")])
+        buttons.append([InlineKeyboardButton(text="📢 Рассылка", callback_data="broadcast")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-def generate_question_selection_keyboard(questions):
-    buttons = [[InlineKeyboardButton(text=q['text'], callback_data=f"select_q_{q['id']}")] for q in questions]
+def generate_question_selection_keyboard(questions, page=0, pages=1):
+    return _question_selection_keyboard(tuple((q['id'], q['text']) for q in questions), page, pages)
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def _question_selection_keyboard(questions, page=0, pages=1):
+    buttons = [[InlineKeyboardButton(text=text, callback_data=f"select_q_{qid}")] for qid, text in questions]
+    if pages > 1:
+        # Листание страниц каталога вопросов
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton(text="◀️", callback_data=f"qpage_{page - 1}"))
+        navigation.append(InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="qpage_current"))
+        if page < pages - 1:
+            navigation.append(InlineKeyboardButton(text="▶️", callback_data=f"qpage_{page + 1}"))
+        buttons.append(navigation)
     buttons.append([InlineKeyboardButton(text="✅ Готово", callback_data="finalize_question_link")])
     buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 def generate_rate_keyboard_for_questions(token, questions):
+    return _rate_keyboard_for_questions(token, tuple(q['id'] for q in questions))
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def _rate_keyboard_for_questions(token, question_ids):
     keyboard = []
-    for q in questions:
-        row = [InlineKeyboardButton(text=f"{i}", callback_data=f"rateq_{q['id']}_{i}_{token}") for i in range(1, 6)]
+    for qid in question_ids:
+        row = [InlineKeyboardButton(text=f"{i}", callback_data=f"rateq_{qid}_{i}_{token}") for i in range(1, 6)]
         keyboard.append(row)
     keyboard.append([InlineKeyboardButton(text="Меню", callback_data="back_to_menu")])
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
 def generate_single_question_keyboard(token, question_id):
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -46,6 +64,7 @@ def generate_single_question_keyboard(token, question_id):
 
 
 # Клавиатура для статистики
+@lru_cache(maxsize=None)
 def generate_stats_menu(is_vip=False):
         buttons = [
             [InlineKeyboardButton(text='Статистика за этот день', callback_data='stat_day')],
@@ -55,11 +74,13 @@ def generate_stats_menu(is_vip=False):
         ]
         if is_vip:
             buttons.append([InlineKeyboardButton(text="Просмотреть голосовавших", callback_data="view_voters")])
+            buttons.append([InlineKeyboardButton(text="📄 Выгрузить оценки (CSV)", callback_data="export_ratings")])
         buttons.append([InlineKeyboardButton(text='Назад', callback_data='back_to_menu')])
         
         return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 # Генерация клавиатуры для оценки
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
 def generate_rate_keyboard(token: str):
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -68,22 +89,28 @@ def generate_rate_keyboard(token: str):
         ]
     )
 
-# Генерация клавиатуры для оплаты
+# Генерация клавиатуры для оплаты: ссылка на оплату у каждого платежа своя (кэш на ней только бы вытеснял
+# остальные клавиатуры), поэтому кэшируются лишь постоянные строки
 def generate_payment_keyboard(url,text):
     return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="Оплатить", url=url)],
-            [InlineKeyboardButton(text=text, callback_data='check_payment')],
-            [InlineKeyboardButton(text='Меню', callback_data='back_to_menu')]
-        ]
+        inline_keyboard=[[InlineKeyboardButton(text="Оплатить", url=url)], *_payment_keyboard_rows(text)]
+    )
+
+@lru_cache(maxsize=None)
+def _payment_keyboard_rows(text):
+    return (
+        [InlineKeyboardButton(text=text, callback_data='check_payment')],
+        [InlineKeyboardButton(text='Меню', callback_data='back_to_menu')]
     )
 
 # Генерация кнопки "Назад"
+@lru_cache(maxsize=None)
 def generate_back_button():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Назад", callback_data='back_to_menu')]
     ])
 # Генерация кнопки "Назад" в выборе стастистики
+@lru_cache(maxsize=None)
 def generate_back_results():
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -91,6 +118,7 @@ def generate_back_results():
         ]
     )
 
+@lru_cache(maxsize=None)
 def generate_vip_menu():
     """Генерирует клавиатуру для VIP-меню."""
     buttons = [
@@ -99,6 +127,7 @@ def generate_vip_menu():
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+@lru_cache(maxsize=None)
 def generate_payment_period_keyboard():
     """Генерирует клавиатуру для выбора периода оплаты."""
     buttons = [
@@ -110,6 +139,7 @@ def generate_payment_period_keyboard():
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
 def generate_confirm_new_payment_keyboard(period, is_vip=False):
     """Генерирует клавиатуру для подтверждения создания нового платежа."""
     buttons = [
@@ -118,6 +148,7 @@ def generate_confirm_new_payment_keyboard(period, is_vip=False):
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+@lru_cache(maxsize=None)
 def generate_manage_prices_keyboard():
     """Генерирует клавиатуру для управления ценами на подписки."""
     buttons = [
@@ -129,8 +160,16 @@ def generate_manage_prices_keyboard():
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+@lru_cache(maxsize=None)
 def generate_back_to_prices_button():
     """Генерирует кнопку для возврата к управлению ценами."""
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Назад к ценам", callback_data="manage_prices")]
-    ])
\ No newline at end of file
+    ])
+
+# Клавиатура хода рассылки
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def generate_broadcast_keyboard(broadcast_id):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⛔ Остановить рассылку", callback_data=f"broadcast_cancel_{broadcast_id}")]
+    ])
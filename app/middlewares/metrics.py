@@ -0,0 +1,62 @@
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+from app.utils.metrics import HANDLER_LATENCY, HANDLER_ERRORS, TELEGRAM_API_CALLS
+
+MAX_PREFIX_PARTS = 3
+
+
+def handler_label(event: TelegramObject):
+    """Метка обработчика: префикс callback_data без параметров (rateq_1_5_abc -> rateq,
+    rate_step_1_5_abc -> rate_step) или команда (/start -> start)."""
+    if isinstance(event, CallbackQuery):
+        parts = []
+        for part in (event.data or "").split("_"):
+            if not part or any(ch.isdigit() or ch == "=" for ch in part) or len(parts) == MAX_PREFIX_PARTS:
+                break
+            parts.append(part)
+        return "callback:" + ("_".join(parts) or "unknown")
+    if isinstance(event, Message):
+        text = event.text or ""
+        if text.startswith("/"):
+            return "command:" + text[1:].split(maxsplit=1)[0].split("@")[0]
+        return "message"
+    return type(event).__name__
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Гистограмма времени обработки по обработчикам. Регистрируется на dp.message и dp.callback_query."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        label = handler_label(event)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(label)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, label)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Счетчик вызовов Telegram Bot API по методам. Регистрируется через bot.session.middleware(...)."""
+
+    async def __call__(self, make_request, bot, method):
+        name = getattr(method, "__api_method__", type(method).__name__)
+        try:
+            response = await make_request(bot, method)
+        except Exception:
+            TELEGRAM_API_CALLS.inc(name, "error")
+            raise
+        TELEGRAM_API_CALLS.inc(name, "ok")
+        return response
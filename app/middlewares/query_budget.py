@@ -0,0 +1,45 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import TelegramObject
+
+from app.database.requests import trace_queries, QueryBudgetExceeded
+from app.middlewares.metrics import handler_label
+from app.utils.metrics import DB_STATEMENTS_PER_UPDATE
+
+
+class QueryBudgetMiddleware(BaseMiddleware):
+    """Считает SQL-выражения за обработку обновления и сверяет их с бюджетом обработчика,
+    объявленным флагом: @router.message(CommandStart(), flags={"query_budget": 6}).
+
+    Выражения хранилища FSM (state.get_data(), state.set_state() и т. п.) в бюджет не входят:
+    их число задает хранилище, а не обработчик (см. storage_queries в app/database/requests.py).
+
+    mode: off — только метрика, warn — сообщение в журнал, raise — QueryBudgetExceeded (для тестов).
+    Регистрируется как inner-middleware (dp.message.middleware(...)), чтобы флаги обработчика были доступны."""
+
+    def __init__(self, mode='warn'):
+        self.mode = mode
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        label = handler_label(event)
+        with trace_queries() as trace:
+            try:
+                result = await handler(event, data)
+            finally:
+                DB_STATEMENTS_PER_UPDATE.observe(trace.count, label)
+
+        budget = get_flag(data, "query_budget")
+        if budget is not None and trace.count > budget and self.mode != 'off':
+            message = (f"Обработчик {label} выполнил {trace.count} SQL-выражений при бюджете {budget} "
+                       f"({trace.elapsed * 1000:.0f} мс)")
+            if self.mode == 'raise':
+                raise QueryBudgetExceeded(message)
+            print(message)
+        return result
@@ -0,0 +1,73 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+
+class KeyedSchedulerMiddleware(BaseMiddleware):
+    """Обновления одного пользователя в одном чате обрабатываются строго по очереди
+    (нет гонок в FSM: select_question, handle_step_rating), а разных пользователей — параллельно,
+    но не более max_concurrency одновременно. Регистрируется как outer-middleware на dp.update
+    до FSM-middleware (Dispatcher(disable_fsm=True), затем dp.update.outer_middleware(dp.fsm)),
+    иначе состояние FSM читается еще до того, как подошла очередь обновления."""
+
+    def __init__(self, max_concurrency=64):
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._locks = {}  # ключ -> [Lock, число ожидающих и выполняющихся обновлений]
+        self.active = 0
+        self.processed = 0
+
+    @staticmethod
+    def get_key(data: Dict[str, Any]):
+        """Ключ очереди: (чат, пользователь). Обновления без пользователя и чата не упорядочиваются."""
+        user = data.get("event_from_user")
+        chat = data.get("event_chat")
+        if user is None and chat is None:
+            return None
+        return (chat.id if chat else None, user.id if user else None)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        key = self.get_key(data)
+        if key is None:
+            async with self._semaphore:
+                return await self._run(handler, event, data)
+
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # Сначала ждем своей очереди по ключу, и только потом занимаем общий слот
+            async with entry[0]:
+                async with self._semaphore:
+                    return await self._run(handler, event, data)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def _run(self, handler, event, data):
+        self.active += 1
+        try:
+            return await handler(event, data)
+        finally:
+            self.active -= 1
+            self.processed += 1
+
+    def stats(self):
+        """Метрики очереди: выполняется, ожидает, активных ключей и максимальная глубина очереди ключа."""
+        depths = [count for _, count in self._locks.values()]
+        waiting = sum(depths) - sum(1 for lock, _ in self._locks.values() if lock.locked())
+        return {
+            "active": self.active,
+            "waiting": waiting,
+            "keys": len(self._locks),
+            "max_key_depth": max(depths, default=0),
+            "processed": self.processed,
+            "max_concurrency": self.max_concurrency,
+        }
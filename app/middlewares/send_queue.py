@@ -0,0 +1,199 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import TelegramObject
+
+# Приоритеты исходящих сообщений: меньше — раньше
+HIGH, NORMAL, LOW = 0, 1, 2
+PRIORITIES = {"high": HIGH, "normal": NORMAL, "low": LOW}
+
+# Методы, на которые действуют ограничения Bot API по частоте сообщений
+LIMITED_PREFIXES = ("send", "edit", "copy", "forward")
+# Правки сообщения: ожидающие правки одного сообщения отправляются в порядке поступления,
+# а из нескольких правок одного вида отправляется только последняя
+COALESCED_METHODS = {"editMessageText", "editMessageReplyMarkup", "editMessageCaption"}
+
+current_priority = ContextVar('current_priority', default=NORMAL)
+
+
+@contextmanager
+def send_priority(priority):
+    """Приоритет исходящих вызовов внутри блока (например, уведомления об оплате из фоновых задач)."""
+    token = current_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+class PriorityRateLimiter:
+    """Не больше rate разрешений в секунду; ожидающие получают их в порядке приоритета."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_at = 0.0
+        self._waiters = []  # (приоритет, номер, future)
+        self._counter = itertools.count()
+        self._task = None
+
+    async def acquire(self, priority=NORMAL):
+        now = time.monotonic()
+        if not self._waiters and now >= self.next_at:
+            self.next_at = now + self.interval
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        if self._task is None:
+            self._task = asyncio.create_task(self._release())
+        await future
+
+    async def _release(self):
+        try:
+            while self._waiters:
+                delay = self.next_at - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                _, _, future = heapq.heappop(self._waiters)
+                if not future.done():
+                    future.set_result(None)
+                    self.next_at = time.monotonic() + self.interval
+        finally:
+            self._task = None
+
+
+class _Pending:
+    __slots__ = ("priority", "seq", "method", "make_request", "bot", "futures", "key", "cancelled")
+
+    def __init__(self, priority, seq, method, make_request, bot, key):
+        self.priority = priority
+        self.seq = seq
+        self.method = method
+        self.make_request = make_request
+        self.bot = bot
+        self.futures = []
+        self.key = key
+        self.cancelled = False  # Заменена более новой правкой: из очереди не отправляется
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Очередь исходящих вызовов Bot API: общий лимит в секунду, интервал между сообщениями в одном чате,
+    повтор после 429 (retry_after), замена устаревших правок сообщения более новыми и приоритеты.
+    Регистрируется первым через bot.session.middleware(...)."""
+
+    def __init__(self, global_rate=30, private_chat_rate=1.0, group_chat_rate=20 / 60, max_retries=3):
+        self.limiter = PriorityRateLimiter(global_rate)
+        self.private_interval = 1 / private_chat_rate
+        self.group_interval = 1 / group_chat_rate
+        self.max_retries = max_retries
+        self._chats = {}  # chat_id -> [куча _Pending, время следующей отправки, задача-отправитель]
+        self._edits = {}  # (chat_id, message_id) -> последняя ожидающая правка сообщения
+        self._counter = itertools.count()
+        self.coalesced = 0
+        self.retried = 0
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        chat_id = getattr(method, "chat_id", None)
+        if not name.startswith(LIMITED_PREFIXES) or not isinstance(chat_id, int):
+            return await self._send(make_request, bot, method)
+
+        future = asyncio.get_running_loop().create_future()
+        priority = current_priority.get()
+        key = (chat_id, getattr(method, "message_id", None)) if name in COALESCED_METHODS else None
+        chat = self._chats.setdefault(chat_id, [[], 0.0, None])
+        pending = _Pending(priority, next(self._counter), method, make_request, bot, key)
+        previous = self._edits.get(key) if key else None
+        if previous is not None:
+            # Правки одного сообщения уходят в порядке поступления: приоритет не должен поставить
+            # более новую правку раньше старой, иначе старая затрет ее
+            pending.priority = min(priority, previous.priority)
+            if previous.method.__api_method__ == name:
+                # Правка того же вида еще не отправлена и устарела: снимаем ее, оба вызова получат ответ новой
+                previous.cancelled = True
+                pending.futures.extend(previous.futures)
+                self.coalesced += 1
+            elif pending.priority < previous.priority:
+                previous.priority = pending.priority
+                heapq.heapify(chat[0])
+        heapq.heappush(chat[0], pending)
+        if key:
+            self._edits[key] = pending
+        if chat[2] is None:
+            chat[2] = asyncio.create_task(self._drain(chat_id))
+        pending.futures.append(future)
+        return await future
+
+    async def _drain(self, chat_id):
+        """Отправляет вызовы одного чата по очереди с интервалом, положенным для этого чата."""
+        chat = self._chats[chat_id]
+        interval = self.private_interval if chat_id > 0 else self.group_interval
+        while chat[0]:
+            delay = chat[1] - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            pending = heapq.heappop(chat[0])
+            if pending.cancelled:
+                continue
+            if pending.key and self._edits.get(pending.key) is pending:
+                del self._edits[pending.key]
+            await self.limiter.acquire(pending.priority)
+            try:
+                result = await self._send(pending.make_request, pending.bot, pending.method)
+            except Exception as e:
+                for future in pending.futures:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for future in pending.futures:
+                    if not future.done():
+                        future.set_result(result)
+            chat[1] = time.monotonic() + interval
+        del self._chats[chat_id]
+
+    async def _send(self, make_request, bot, method):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retried += 1
+                await asyncio.sleep(e.retry_after)
+
+    def stats(self):
+        return {
+            "chats": len(self._chats),
+            "queued": sum(not pending.cancelled for chat in self._chats.values() for pending in chat[0]),
+            "waiting_global": len(self.limiter._waiters),
+            "coalesced": self.coalesced,
+            "retried": self.retried,
+        }
+
+
+class SendPriorityMiddleware(BaseMiddleware):
+    """Берет приоритет исходящих сообщений из флага обработчика: flags={"send_priority": "high"}.
+    Регистрируется как inner-middleware (dp.callback_query.middleware(...))."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        priority = get_flag(data, "send_priority")
+        if priority is None:
+            return await handler(event, data)
+        with send_priority(PRIORITIES[priority]):
+            return await handler(event, data)
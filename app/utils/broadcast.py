@@ -0,0 +1,126 @@
+import os
+import time
+import asyncio
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
+
+import app.database.requests as rq
+import app.keyboards.keyboard as kb
+from app.middlewares.send_queue import send_priority, LOW
+
+# Настройки рассылок
+broadcast_config = {
+    'concurrency': int(os.getenv('BROADCAST_CONCURRENCY', 10)),  # Одновременно отправляемых сообщений
+    'page_size': int(os.getenv('BROADCAST_PAGE_SIZE', 200)),  # Получателей на страницу (и на контрольную точку)
+    'progress_interval': float(os.getenv('BROADCAST_PROGRESS_INTERVAL', 5)),  # Обновлять ход раз в N секунд
+}
+
+# Рассылки, которые выполняет этот процесс: id -> задача
+running = {}
+
+
+def progress_text(broadcast, delivered, failed, status='running'):
+    title = {
+        'running': "📢 Рассылка идет",
+        'done': "✅ Рассылка завершена",
+        'cancelled': "⛔ Рассылка остановлена",
+    }[status]
+    return f"{title}\nДоставлено: {delivered}\nОшибок: {failed}\nВсего получателей: {broadcast['total']}"
+
+
+async def deliver(bot: Bot, tg_id, text, semaphore):
+    """Отправляет одно сообщение. Ожидание лимитов и повтор после 429 делает OutboundScheduler."""
+    async with semaphore:
+        try:
+            await bot.send_message(tg_id, text)
+            return True
+        except TelegramAPIError:
+            # Бот заблокирован, чат удален и т. п. — такого получателя пропускаем
+            return False
+
+
+async def show_progress(bot: Bot, broadcast, delivered, failed, status='running'):
+    if not broadcast['progress_message_id']:
+        return
+    try:
+        await bot.edit_message_text(
+            progress_text(broadcast, delivered, failed, status),
+            chat_id=broadcast['admin_id'],
+            message_id=broadcast['progress_message_id'],
+            reply_markup=kb.generate_broadcast_keyboard(broadcast['id']) if status == 'running' else None,
+        )
+    except TelegramAPIError:
+        pass  # Сообщение удалено или текст не изменился
+
+
+async def run_broadcast(bot: Bot, broadcast):
+    """Рассылает текст всем пользователям, начиная с контрольной точки broadcast['last_user_id'].
+
+    Получатели читаются страницами по users.id; после каждой страницы прогресс сохраняется в БД,
+    поэтому после перезапуска повторно может уйти не больше одной страницы. Рассылку выполняет
+    только процесс, захвативший ее блокировку, — остальные процессы ее пропускают."""
+    async with rq.claim_broadcast(broadcast['id']) as claimed:
+        if claimed is None:
+            return  # Рассылку уже выполняет другой процесс или она завершена
+        await send_broadcast(bot, claimed)
+
+
+async def send_broadcast(bot: Bot, broadcast):
+    last_user_id = broadcast['last_user_id']
+    delivered, failed = broadcast['delivered'], broadcast['failed']
+    semaphore = asyncio.Semaphore(broadcast_config['concurrency'])
+    shown_at = time.monotonic()
+
+    # Рассылка уступает очередь ответам пользователям
+    with send_priority(LOW):
+        while True:
+            page = await rq.get_broadcast_recipients(last_user_id, broadcast_config['page_size'])
+            if not page:
+                break
+            results = await asyncio.gather(*(deliver(bot, row['tg_id'], broadcast['text'], semaphore) for row in page))
+            delivered += sum(results)
+            failed += len(results) - sum(results)
+            last_user_id = page[-1]['id']
+
+            if not await rq.save_broadcast_progress(broadcast['id'], last_user_id, delivered, failed):
+                return  # Рассылку остановили (возможно, из другого процесса)
+            if time.monotonic() - shown_at >= broadcast_config['progress_interval']:
+                await show_progress(bot, broadcast, delivered, failed)
+                shown_at = time.monotonic()
+
+        await rq.save_broadcast_progress(broadcast['id'], last_user_id, delivered, failed, status='done')
+        await show_progress(bot, broadcast, delivered, failed, status='done')
+
+
+def start_broadcast(bot: Bot, broadcast):
+    """Запускает рассылку в фоне; обработка обновлений при этом не ждет."""
+    task = asyncio.create_task(run_broadcast(bot, broadcast))
+    running[broadcast['id']] = task
+    task.add_done_callback(lambda _: running.pop(broadcast['id'], None))
+    return task
+
+
+async def resume_broadcasts(bot: Bot):
+    """Продолжает рассылки, прерванные остановкой бота (если их не выполняет другой процесс)."""
+    for broadcast in await rq.get_running_broadcasts():
+        if broadcast['id'] not in running:
+            start_broadcast(bot, broadcast)
+
+
+async def stop_broadcast(broadcast_id):
+    """Останавливает рассылку. Возвращает False, если она уже завершена."""
+    if not await rq.cancel_broadcast(broadcast_id):
+        return False
+    task = running.pop(broadcast_id, None)
+    if task is not None:
+        task.cancel()
+    return True
+
+
+async def close_broadcasts():
+    """Прерывает рассылки при остановке бота; они продолжатся с последней контрольной точки."""
+    tasks = list(running.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,35 @@
+import os
+import csv
+import tempfile
+from contextlib import aclosing
+
+import app.database.requests as rq
+
+# Столбцы файла выгрузки
+EXPORT_COLUMNS = ('kind', 'created_at', 'rater_id', 'username', 'first_name', 'question', 'score')
+
+# Пользователи, для которых выгрузка уже идет: не занимаем второе подключение повторным нажатием
+exporting = set()
+
+
+async def export_ratings_csv(user_id):
+    """Записывает все оценки пользователя во временный CSV-файл и возвращает путь к нему
+    (или None, если оценок нет). Строки пишутся пачками по мере чтения, файл удаляет вызывающий."""
+    fd, path = tempfile.mkstemp(prefix=f"ratings_{user_id}_", suffix=".csv")
+    written = 0
+    try:
+        # utf-8-sig — чтобы Excel правильно показал кириллицу
+        with os.fdopen(fd, 'w', encoding='utf-8-sig', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(EXPORT_COLUMNS)
+            async with aclosing(rq.iter_ratings_export(user_id)) as chunks:
+                async for rows in chunks:
+                    writer.writerows([row[column] for column in EXPORT_COLUMNS] for row in rows)
+                    written += len(rows)
+    except BaseException:
+        os.remove(path)
+        raise
+    if not written:
+        os.remove(path)
+        return None
+    return path
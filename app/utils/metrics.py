@@ -0,0 +1,188 @@
+import time
+import inspect
+import functools
+from contextlib import aclosing
+from bisect import bisect_left
+
+from aiohttp import web
+
+# Минимальный реестр метрик в текстовом формате Prometheus.
+# Горячий путь — только обращение к словарю и сложение, без блокировок (все в одном цикле событий).
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROWS_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000)
+STATEMENTS_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 50)
+
+registry = []
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for label_values, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Gauge:
+    """Значение вычисляется при каждом запросе /metrics функцией collect() -> {label_values: value}."""
+
+    def __init__(self, name, documentation, labels=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.collect = collect
+        registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for label_values, value in (self.collect() if self.collect else {}).items():
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # label_values -> [счетчики по корзинам..., сумма, количество]
+        registry.append(self)
+
+    def observe(self, value, *label_values):
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [0] * (len(self.buckets) + 2)
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                labels = _format_labels(self.labels, label_values, ("le", bound))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values, ("le", "+Inf"))
+            lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {series[-2]}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+def render_metrics():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Метрики бота
+HANDLER_LATENCY = Histogram("ratebot_handler_seconds", "Время обработки обновления", ("handler",))
+HANDLER_ERRORS = Counter("ratebot_handler_errors_total", "Ошибки в обработчиках", ("handler",))
+DB_QUERY_LATENCY = Histogram("ratebot_db_query_seconds", "Время выполнения функции requests.py", ("function",))
+DB_QUERY_ROWS = Histogram("ratebot_db_query_rows", "Строк возвращено функцией requests.py", ("function",),
+                          buckets=ROWS_BUCKETS)
+DB_STATEMENTS_PER_UPDATE = Histogram("ratebot_db_statements_per_update", "SQL-выражений за обработку обновления",
+                                     ("handler",), buckets=STATEMENTS_BUCKETS)
+DB_POOL_WAIT = Histogram("ratebot_db_pool_wait_seconds", "Ожидание свободного подключения в пуле")
+PAYMENT_PROVIDER_CALLS = Counter("ratebot_payment_provider_calls_total", "Обращения к ЮMoney", ("method", "outcome"))
+PAYMENT_PROVIDER_LATENCY = Histogram("ratebot_payment_provider_seconds", "Время обращения к ЮMoney", ("method",))
+TELEGRAM_API_CALLS = Counter("ratebot_telegram_api_calls_total", "Вызовы Telegram Bot API", ("method", "outcome"))
+
+
+def count_rows(result):
+    """Сколько строк вернула функция: длина списка, 1 для одной строки, 0 для None."""
+    if result is None:
+        return 0
+    if isinstance(result, (list, tuple)) and (not result or isinstance(result[0], (dict, list, tuple))):
+        return len(result)
+    return 1
+
+
+def track_query(func):
+    """Декоратор для функций requests.py: время выполнения и число возвращенных строк."""
+    name = func.__name__
+
+    if inspect.isasyncgenfunction(func):
+        @functools.wraps(func)
+        async def generator_wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            rows = 0
+            try:
+                async with aclosing(func(*args, **kwargs)) as items:
+                    async for item in items:
+                        rows += 1
+                        yield item
+            finally:
+                DB_QUERY_LATENCY.observe(time.perf_counter() - started, name)
+                DB_QUERY_ROWS.observe(rows, name)
+        return generator_wrapper
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        result = None
+        try:
+            result = await func(*args, **kwargs)
+            return result
+        finally:
+            DB_QUERY_LATENCY.observe(time.perf_counter() - started, name)
+            DB_QUERY_ROWS.observe(count_rows(result), name)
+    return wrapper
+
+
+class TimedAcquire:
+    """Обертка над pool.acquire(), которая замеряет ожидание подключения."""
+
+    def __init__(self, acquire_context):
+        self._context = acquire_context
+
+    async def __aenter__(self):
+        started = time.perf_counter()
+        connection = await self._context.__aenter__()
+        DB_POOL_WAIT.observe(time.perf_counter() - started)
+        return connection
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return await self._context.__aexit__(exc_type, exc, tb)
+
+
+async def metrics_handler(request: web.Request):
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(host='127.0.0.1', port=9100):
+    """Запускает отдельный локальный HTTP-сервер с /metrics (в режимах polling и webhook)."""
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
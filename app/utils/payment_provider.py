@@ -0,0 +1,186 @@
+import os
+import time
+import asyncio
+import aiohttp
+from datetime import datetime
+from dotenv import load_dotenv
+from yoomoney import Quickpay
+
+from app.utils.metrics import PAYMENT_PROVIDER_CALLS, PAYMENT_PROVIDER_LATENCY
+
+# Загружаем переменные окружения
+load_dotenv()
+
+YOOMONEY_TOKEN = os.getenv('YOOMONEY')
+
+# Настройки обращения к платежному провайдеру
+provider_config = {
+    'timeout': float(os.getenv('PAYMENT_TIMEOUT', 10)),  # Таймаут одного запроса в секундах
+    'max_concurrency': int(os.getenv('PAYMENT_MAX_CONCURRENCY', 5)),  # Максимум одновременных запросов
+}
+
+
+class PaymentProviderError(Exception):
+    """Ошибка при обращении к платежному провайдеру."""
+
+
+class YooMoneyProvider:
+    """Асинхронный клиент ЮMoney: одна HTTP-сессия с keep-alive, таймаут и ограничение параллельных запросов."""
+
+    API_URL = "https://yoomoney.ru/api/operation-history"
+
+    def __init__(self, token, timeout=10, max_concurrency=5):
+        self.token = token
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self._session = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def start(self):
+        """Открывает HTTP-сессию (переиспользуется для всех запросов)."""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"Authorization": f"Bearer {self.token}"},
+            )
+
+    async def close(self):
+        """Закрывает HTTP-сессию."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def operation_history(self, label=None, records=100, from_time=None):
+        """Возвращает список операций (словари в формате API ЮMoney)."""
+        operations, _ = await self.operation_history_page(label, records, from_time)
+        return operations
+
+    async def operation_history_page(self, label=None, records=100, from_time=None, start_record=None):
+        """Возвращает страницу истории: (операции, next_record). next_record — None на последней странице."""
+        await self.start()
+        params = {"records": records}
+        if label is not None:
+            params["label"] = label
+        if from_time is not None:
+            params["from"] = from_time.strftime("%Y-%m-%dT%H:%M:%S")
+        if start_record is not None:
+            params["start_record"] = start_record
+
+        async with self._semaphore:
+            started = time.perf_counter()
+            try:
+                async with self._session.post(self.API_URL, data=params) as response:
+                    response.raise_for_status()
+                    data = await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                PAYMENT_PROVIDER_CALLS.inc("operation_history", "error")
+                raise PaymentProviderError(f"Ошибка запроса к ЮMoney: {e!r}") from e
+            finally:
+                PAYMENT_PROVIDER_LATENCY.observe(time.perf_counter() - started, "operation_history")
+
+        if "error" in data:
+            PAYMENT_PROVIDER_CALLS.inc("operation_history", "error")
+            raise PaymentProviderError(f"ЮMoney вернул ошибку: {data['error']}")
+        PAYMENT_PROVIDER_CALLS.inc("operation_history", "ok")
+        return data.get("operations", []), data.get("next_record")
+
+    async def create_payment_url(self, receiver, description, amount, label):
+        """Создает ссылку на оплату (Quickpay делает синхронный HTTP-запрос, поэтому выносим его в поток)."""
+        async with self._semaphore:
+            started = time.perf_counter()
+            try:
+                quickpay = await asyncio.wait_for(
+                    asyncio.to_thread(
+                        Quickpay,
+                        receiver=receiver,
+                        quickpay_form="shop",
+                        targets=description,
+                        paymentType="SB",
+                        sum=amount,
+                        label=label,
+                    ),
+                    timeout=self.timeout,
+                )
+            except asyncio.TimeoutError as e:
+                PAYMENT_PROVIDER_CALLS.inc("quickpay", "error")
+                raise PaymentProviderError("Таймаут при создании ссылки на оплату") from e
+            finally:
+                PAYMENT_PROVIDER_LATENCY.observe(time.perf_counter() - started, "quickpay")
+        PAYMENT_PROVIDER_CALLS.inc("quickpay", "ok")
+        return quickpay.base_url
+
+
+class FakePaymentProvider:
+    """Локальный провайдер для тестов: хранит операции в памяти и не ходит в сеть."""
+
+    def __init__(self, delay=0):
+        self.delay = delay  # Искусственная задержка ответа в секундах
+        self.operations = []
+        self.calls = 0
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def add_operation(self, label, amount, status='success'):
+        """Добавляет операцию, как если бы пользователь оплатил счет."""
+        self.operations.append({
+            "operation_id": str(len(self.operations) + 1),
+            "status": status,
+            "datetime": datetime.now(),
+            "title": "Тестовый платеж",
+            "direction": "in",
+            "amount": amount,
+            "label": label,
+            "type": "deposition",
+        })
+
+    async def operation_history(self, label=None, records=100, from_time=None):
+        operations, _ = await self.operation_history_page(label, records, from_time)
+        return operations
+
+    async def operation_history_page(self, label=None, records=100, from_time=None, start_record=None):
+        self.calls += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        # Как в API ЮMoney: сначала новые операции, страницы по records штук
+        operations = [
+            op for op in reversed(self.operations)
+            if (label is None or op["label"] == label)
+            and (from_time is None or op["datetime"] >= from_time)
+        ]
+        start = int(start_record or 0)
+        next_record = str(start + records) if start + records < len(operations) else None
+        return operations[start:start + records], next_record
+
+    async def create_payment_url(self, receiver, description, amount, label):
+        return f"https://yoomoney.test/quickpay?receiver={receiver}&sum={amount}&label={label}"
+
+
+# Общий провайдер процесса
+provider = None
+
+def get_payment_provider():
+    """Возвращает провайдер, выбранный переменной окружения PAYMENT_PROVIDER (yoomoney или fake)."""
+    global provider
+    if provider is None:
+        if os.getenv('PAYMENT_PROVIDER', 'yoomoney') == 'fake':
+            provider = FakePaymentProvider()
+        else:
+            provider = YooMoneyProvider(YOOMONEY_TOKEN, **provider_config)
+    return provider
+
+def set_payment_provider(new_provider):
+    """Подменяет провайдер (например, на FakePaymentProvider в тестах)."""
+    global provider
+    provider = new_provider
+
+async def close_payment_provider():
+    """Закрывает HTTP-сессию провайдера."""
+    global provider
+    if provider is not None:
+        await provider.close()
+        provider = None
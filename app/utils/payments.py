@@ -1,67 +1,49 @@
-import os
-from dotenv import load_dotenv
-from yoomoney import Quickpay
-from yoomoney import Client
-import random
-import string
+from app.database.requests import get_pending_payments, update_payments_status_bulk
+from app.utils.payment_provider import get_payment_provider
+from app.utils.tokens import new_token
 
-from app.database.requests import get_db_connection
-from app.database.requests import update_payment_status
+YOOMONEY_RECEIVER = "4100118730636948"
 
-# Загружаем переменные окружения
-load_dotenv()
-
-YOOMONEY_TOKEN = os.getenv('YOOMONEY')
+# Длина метки платежа: 20 символов (~119 бит случайности) — совпадение практически невозможно,
+# а UNIQUE-индекс на payments.transaction_id не даст записать дубликат при сохранении платежа
+PAYMENT_LABEL_LENGTH = 20
 
 async def create_payment(amount, description):
     """Создание платежа через ЮMoney."""
-    payment_url = ''.join(random.choices(string.ascii_letters + string.digits, k=10))
-
-    connection = await get_db_connection()
-    cursor = await connection.cursor()
-
-    while True:
-            await cursor.execute("SELECT * FROM payments WHERE transaction_id = %s", (payment_url))
-            existing_user = await cursor.fetchone()
+    unique_label = new_token(PAYMENT_LABEL_LENGTH)
 
-            if not existing_user:
-                break  # Токен уникален, выходим из цикла
-            else:
-                # Генерируем новый токен, если текущий не уникален
-                payment_url = ''.join(random.choices(string.ascii_letters + string.digits, k=10))
-
-    unique_label = payment_url
-
-    quickpay = Quickpay(
-        receiver="4100118730636948",
-        quickpay_form="shop",
-        targets=description,
-        paymentType="SB",
-        sum=amount,
+    payment_link = await get_payment_provider().create_payment_url(
+        receiver=YOOMONEY_RECEIVER,
+        description=description,
+        amount=amount,
         label=unique_label  # Уникальная метка
     )
-    return quickpay.base_url, unique_label  # Возвращаем URL и метку
-
-async def check_payment_status(transaction_id: str):
-    """Проверка статуса платежа через ЮMoney."""
-    try:
-        client = Client(YOOMONEY_TOKEN)
-        history = client.operation_history(label=transaction_id)
-        for operation in history.operations:
-            print()
-            print("Operation:", operation.operation_id)
-            print("\tStatus     -->", operation.status)
-            print("\tDatetime   -->", operation.datetime)
-            print("\tTitle      -->", operation.title)
-            print("\tPattern id -->", operation.pattern_id)
-            print("\tDirection  -->", operation.direction)
-            print("\tAmount     -->", operation.amount)
-            print("\tLabel      -->", operation.label)
-            print("\tType       -->", operation.type)
-            if operation.status == 'success':
-                await update_payment_status(transaction_id, operation.status)
-                return True  # Возвращаем True, если платеж успешен
-        return False  # Если успешный платеж не найден
-    except Exception as e:
-        print(f"Ошибка при проверке статуса платежа: {e}")
-        return False  # Возвращаем False в случае ошибки
\ No newline at end of file
+    return payment_link, unique_label  # Возвращаем URL и метку
+
+async def reconcile_pending_payments():
+    """Сверяет все ожидающие платежи с историей ЮMoney (по 100 операций на запрос).
+    Возвращает список платежей, которые этот вызов перевел в статус success."""
+    pending = await get_pending_payments()
+    if not pending:
+        return []
+
+    # История операций начиная с самого старого ожидающего платежа — постранично, пока не найдены
+    # все ожидающие метки или история не закончилась
+    oldest = min(payment['created_at'] for payment in pending)
+    pending_labels = {payment['transaction_id'] for payment in pending}
+    paid_labels = set()
+    start_record = None
+    while True:
+        operations, start_record = await get_payment_provider().operation_history_page(
+            from_time=oldest, start_record=start_record
+        )
+        paid_labels.update(
+            op.get('label') for op in operations
+            if op.get('status') == 'success' and op.get('label') in pending_labels
+        )
+        if start_record is None or paid_labels == pending_labels:
+            break
+
+    # Уведомлять нужно только о платежах, которые перевел в success именно этот вызов:
+    # сверку выполняет каждый процесс, и другой мог обработать часть платежей раньше
+    return await update_payments_status_bulk(sorted(paid_labels), 'success')
\ No newline at end of file
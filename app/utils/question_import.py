@@ -0,0 +1,57 @@
+import os
+import io
+import csv
+import tempfile
+
+from aiogram import Bot
+from aiogram.types import Document
+
+import app.database.requests as rq
+
+# Настройки импорта вопросов из файла
+import_config = {
+    'max_file_size': int(os.getenv('QUESTION_IMPORT_MAX_SIZE', 1024 * 1024)),  # Максимальный размер файла в байтах
+    'spool_size': 256 * 1024,  # До этого размера файл держим в памяти, дальше — на диске
+}
+
+# Ограничение длины столбца questions.text
+MAX_QUESTION_LENGTH = 255
+# Принимаемые файлы: расширение или MIME-тип text/*
+IMPORT_EXTENSIONS = ('.txt', '.csv')
+
+
+def is_text_document(document: Document):
+    """Проверяет, что файл текстовый (.txt/.csv или text/*): остальное при декодировании превратится в мусор."""
+    file_name = (document.file_name or '').lower()
+    mime_type = (document.mime_type or '').lower()
+    return file_name.endswith(IMPORT_EXTENSIONS) or mime_type.startswith('text/')
+
+
+def read_questions(lines, is_csv=False):
+    """Построчно отдает тексты вопросов: из .csv — первый столбец, из текстового файла — строку целиком.
+    Пустые строки пропускаются; файл целиком в память не читается."""
+    rows = csv.reader(lines) if is_csv else ([line] for line in lines)
+    for row in rows:
+        if row and row[0].strip():
+            yield row[0].strip()
+
+
+async def import_questions_document(bot: Bot, document: Document):
+    """Скачивает присланный файл и добавляет вопросы из него одной пачкой.
+    Возвращает {'inserted', 'duplicates', 'too_long'}."""
+    is_csv = (document.file_name or '').lower().endswith('.csv')
+    with tempfile.SpooledTemporaryFile(max_size=import_config['spool_size']) as raw:
+        await bot.download(document, destination=raw)
+        raw.seek(0)
+        # utf-8-sig убирает BOM, который добавляют Excel и Блокнот
+        lines = io.TextIOWrapper(raw, encoding='utf-8-sig', errors='replace', newline='')
+        questions, too_long = [], 0
+        for question in read_questions(lines, is_csv):
+            if len(question) > MAX_QUESTION_LENGTH:
+                too_long += 1
+            else:
+                questions.append(question)
+        lines.detach()
+
+    inserted, duplicates = await rq.import_questions(questions)
+    return {'inserted': inserted, 'duplicates': duplicates, 'too_long': too_long}
@@ -0,0 +1,31 @@
+import secrets
+import string
+
+import aiomysql
+
+# Токены попадают в deep link (/start rate_<token>) и в callback_data, поэтому только буквы и цифры
+TOKEN_ALPHABET = string.ascii_letters + string.digits
+DUPLICATE_KEY_ERROR = 1062  # ER_DUP_ENTRY
+
+
+def new_token(length=16):
+    """Возвращает криптографически случайный токен."""
+    return ''.join(secrets.choice(TOKEN_ALPHABET) for _ in range(length))
+
+
+def is_duplicate_key(error):
+    return isinstance(error, aiomysql.IntegrityError) and error.args and error.args[0] == DUPLICATE_KEY_ERROR
+
+
+async def execute_with_unique_token(cursor, query, make_params, length=16, attempts=5):
+    """Выполняет INSERT/UPDATE с новым токеном, полагаясь на UNIQUE-индекс вместо предварительного SELECT.
+    make_params(token) возвращает параметры запроса. При конфликте токен генерируется заново.
+    Возвращает использованный токен."""
+    for attempt in range(attempts):
+        token = new_token(length)
+        try:
+            await cursor.execute(query, make_params(token))
+            return token
+        except aiomysql.IntegrityError as e:
+            if not is_duplicate_key(e) or attempt == attempts - 1:
+                raise
@@ -0,0 +1,174 @@
+import os
+import asyncio
+import hmac
+from collections import deque
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+# Настройки режима webhook
+webhook_config = {
+    'path': os.getenv('WEBHOOK_PATH', '/webhook'),  # Путь, на который Telegram присылает обновления
+    'secret': os.getenv('WEBHOOK_SECRET'),  # Секрет из заголовка X-Telegram-Bot-Api-Secret-Token
+    'max_concurrency': int(os.getenv('WEBHOOK_MAX_CONCURRENCY', 32)),  # Одновременно обрабатываемых обновлений
+    'backlog': int(os.getenv('WEBHOOK_BACKLOG', 1000)),  # Размер очереди; при переполнении отвечаем 429
+}
+
+
+def update_key(update: Update):
+    """Ключ очереди обновления: (чат, пользователь), как в KeyedSchedulerMiddleware; None — без пользователя и чата."""
+    try:
+        event = update.event
+    except Exception:
+        return None  # Неизвестный тип обновления
+    user = getattr(event, 'from_user', None)
+    chat = getattr(event, 'chat', None) or getattr(getattr(event, 'message', None), 'chat', None)
+    if user is None and chat is None:
+        return None
+    return (chat.id if chat else None, user.id if user else None)
+
+
+class WebhookServer:
+    """HTTP-сервер для приема обновлений: очереди по пользователям, фиксированное число обработчиков,
+    отказ с 429 при переполнении и эндпоинты /health и /ready.
+
+    Обновления одного пользователя ставятся в его очередь, а обработчик берет пользователя только тогда,
+    когда его предыдущее обновление обработано. Поэтому обработчик никогда не ждет чужой очереди,
+    и всплеск обновлений от одного пользователя не занимает все слоты."""
+
+    def __init__(self, dp: Dispatcher, bot: Bot, path='/webhook', secret=None, max_concurrency=32, backlog=1000,
+                 scheduler=None):
+        self.dp = dp
+        self.bot = bot
+        self.scheduler = scheduler  # KeyedSchedulerMiddleware — для метрик очередей по пользователям
+        self.path = path
+        self.secret = secret
+        self.max_concurrency = max_concurrency
+        self.backlog = backlog
+        self.pending = {}  # ключ -> deque обновлений; первое обрабатывается или ждет обработчика
+        self.ready_keys = asyncio.Queue()  # Ключи, готовые к обработке (каждый ключ — не больше одного раза)
+        self.queued = 0  # Обновлений в очередях, включая обрабатываемые
+        self.workers = []
+        self.runner = None
+        self.accepting = False
+        self.in_flight = 0
+        self.rejected = 0
+
+        self.app = web.Application()
+        self.app.router.add_post(path, self.handle_update)
+        self.app.router.add_get('/health', self.health)
+        self.app.router.add_get('/ready', self.ready)
+
+    async def handle_update(self, request: web.Request):
+        """Принимает обновление и сразу отвечает Telegram; обработка идет в фоне."""
+        if self.secret is not None:
+            token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(token, self.secret):
+                return web.Response(status=401)
+        if not self.accepting:
+            return web.Response(status=503)
+
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            print(f"Некорректное обновление: {e}")
+            return web.Response(status=400)
+
+        if self.queued >= self.backlog:
+            # Сбрасываем нагрузку: Telegram (или балансировщик) повторит запрос позже
+            self.rejected += 1
+            return web.Response(status=429, headers={'Retry-After': '1'})
+
+        key = update_key(update)
+        if key is None:
+            key = ('update', update.update_id)  # Без пользователя — порядок не важен
+        self.queued += 1
+        updates = self.pending.get(key)
+        if updates is None:
+            self.pending[key] = deque([update])
+            self.ready_keys.put_nowait(key)
+        else:
+            updates.append(update)  # Ключ уже в работе — обработчик возьмет обновление следом
+        return web.Response(status=200)
+
+    async def health(self, request: web.Request):
+        return web.json_response({"status": "ok"})
+
+    async def ready(self, request: web.Request):
+        """Готовность: принимаем обновления и очередь не переполнена."""
+        is_ready = self.accepting and self.queued < self.backlog
+        return web.json_response(
+            {
+                "ready": is_ready,
+                "queue": self.queued,
+                "keys": len(self.pending),
+                "backlog": self.backlog,
+                "in_flight": self.in_flight,
+                "rejected": self.rejected,
+                "scheduler": self.scheduler.stats() if self.scheduler else None,
+            },
+            status=200 if is_ready else 503
+        )
+
+    async def _worker(self):
+        while True:
+            key = await self.ready_keys.get()
+            updates = self.pending[key]
+            update = updates[0]
+            self.in_flight += 1
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                print(f"Ошибка при обработке обновления {update.update_id}: {e}")
+            finally:
+                self.in_flight -= 1
+                self.queued -= 1
+                updates.popleft()
+                if updates:
+                    self.ready_keys.put_nowait(key)  # Следующее обновление ключа — в конец общей очереди
+                else:
+                    del self.pending[key]
+                self.ready_keys.task_done()
+
+    async def start(self, host='0.0.0.0', port=8080):
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrency)]
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        self.accepting = True
+
+    async def stop(self):
+        """Перестает принимать обновления, дорабатывает очередь и останавливает сервер."""
+        self.accepting = False
+        await self.ready_keys.join()
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, scheduler=None):
+    """Запускает бота в режиме webhook (BOT_MODE=webhook) и работает до отмены."""
+    server = WebhookServer(dp, bot, scheduler=scheduler, **webhook_config)
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    await server.start(os.getenv('WEBHOOK_HOST', '0.0.0.0'), int(os.getenv('WEBHOOK_PORT', 8080)))
+
+    # Без WEBHOOK_URL сервер можно проверять локально, присылая JSON обновлений вручную
+    webhook_url = os.getenv('WEBHOOK_URL')
+    if webhook_url:
+        await bot.set_webhook(
+            webhook_url.rstrip('/') + webhook_config['path'],
+            secret_token=webhook_config['secret'],
+            max_connections=webhook_config['max_concurrency'],
+        )
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()
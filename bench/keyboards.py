@@ -0,0 +1,49 @@
+"""Микро-бенчмарк построения клавиатур: готовая разметка из кэша против сборки с нуля.
+
+Запуск: python -m bench.keyboards [--number 2000] [--questions 10]
+"""
+import argparse
+import timeit
+
+import app.keyboards.keyboard as kb
+
+
+def cases(questions_count):
+    questions = [{"id": i, "text": f"Вопрос {i}"} for i in range(1, questions_count + 1)]
+    question_ids = tuple(q["id"] for q in questions)
+    question_items = tuple((q["id"], q["text"]) for q in questions)
+    # (название, вызов через кэш, сборка без кэша)
+    return [
+        ("generate_main_menu", lambda: kb.generate_main_menu(True),
+         lambda: kb.generate_main_menu.__wrapped__(True)),
+        ("generate_back_button", kb.generate_back_button, kb.generate_back_button.__wrapped__),
+        ("generate_payment_period_keyboard", kb.generate_payment_period_keyboard,
+         kb.generate_payment_period_keyboard.__wrapped__),
+        ("generate_manage_prices_keyboard", kb.generate_manage_prices_keyboard,
+         kb.generate_manage_prices_keyboard.__wrapped__),
+        ("generate_single_question_keyboard", lambda: kb.generate_single_question_keyboard("token", 1),
+         lambda: kb.generate_single_question_keyboard.__wrapped__("token", 1)),
+        (f"generate_rate_keyboard_for_questions ({questions_count})",
+         lambda: kb.generate_rate_keyboard_for_questions("token", questions),
+         lambda: kb._rate_keyboard_for_questions.__wrapped__("token", question_ids)),
+        (f"generate_question_selection_keyboard ({questions_count})",
+         lambda: kb.generate_question_selection_keyboard(questions),
+         lambda: kb._question_selection_keyboard.__wrapped__(question_items)),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=2000)
+    parser.add_argument("--questions", type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{'клавиатура':<46} {'сборка, мкс':>12} {'кэш, мкс':>10}")
+    for name, cached, uncached in cases(args.questions):
+        build = timeit.timeit(uncached, number=args.number) / args.number * 1e6
+        hit = timeit.timeit(cached, number=args.number) / args.number * 1e6
+        print(f"{name:<46} {build:12.2f} {hit:10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,436 @@
+"""Нагрузочный прогон обработчиков: синтетические обновления Telegram через handlers.router без сети.
+
+Исходящие вызовы Bot API принимает поддельная сессия (запоминает метод и отвечает сразу или с задержкой),
+база данных — хранилище в памяти с функциями rq.* (по умолчанию) или отдельная MySQL-база BENCH_DB_NAME
+с настоящими запросами (--db mysql). Отчет: пропускная способность, p50/p95/p99 по обработчикам,
+вызовы Bot API, SQL-выражения обработчиков и хранилища FSM на обновление. С --db mysql состояния FSM
+хранятся в той же базе (MySQLStorage, как в боте), иначе — в памяти.
+
+Запуск: python -m bench.load_test [--sessions 2000] [--concurrency 100] [--db memory|mysql]
+                                  [--db-latency 0.5] [--api-latency 0]
+"""
+import os
+import time
+import random
+import asyncio
+import argparse
+from collections import defaultdict
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+
+import aiomysql
+from aiogram import Bot, Dispatcher, BaseMiddleware
+from aiogram.client.session.base import BaseSession
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Update, Message
+
+import app.database.requests as rq
+from app.database.fsm_storage import MySQLStorage
+from app.middlewares.metrics import handler_label
+from app.middlewares.scheduler import KeyedSchedulerMiddleware
+from app.utils.payment_provider import FakePaymentProvider, set_payment_provider
+
+BENCH_DB_NAME = os.getenv('BENCH_DB_NAME', 'ratebot_bench')
+BOT_TOKEN = "123456:BENCH"
+
+USER_BASE = 1_000_000  # Владельцы ссылок: USER_BASE + i
+RATER_BASE = 10_000_000  # Новые пользователи, приходящие по ссылкам
+PRICES = [("день", 50, False), ("неделю", 200, False), ("месяц", 500, False), ("vip", 1000, True)]
+QUESTIONS_PER_LINK = 5
+
+# Доля сценариев в смеси трафика
+SCENARIOS = {
+    "link_rating": 40,  # /start rate_<токен пользователя> -> rate_N_token=...
+    "question_poll": 25,  # /start rate_<токен опроса> -> rate_step_* по всем вопросам
+    "quick_poll": 10,  # rateq_* без FSM
+    "stats": 15,  # stat_day / stat_week / stat_month у оплативших пользователей
+    "payment": 10,  # pay_day -> check_payment
+}
+
+current_label = ContextVar('current_label', default='-')
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(p / 100 * (len(ordered) - 1)))]
+
+
+class RecordingSession(BaseSession):
+    """Сессия Bot API без сети: считает вызовы по обработчикам и методам."""
+
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = defaultdict(int)  # (обработчик, метод) -> число вызовов
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[(current_label.get(), method.__api_method__)] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method.__api_method__.startswith("send"):
+            chat_id = getattr(method, "chat_id", 0)
+            return Message.model_validate(
+                {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+                 "text": getattr(method, "text", None)},
+                context={"bot": bot},
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+class LoadStats(BaseMiddleware):
+    """Outer-middleware на message и callback_query: время, SQL-выражения и ошибки по обработчикам."""
+
+    def __init__(self):
+        self.latency = defaultdict(list)
+        self.statements = defaultdict(int)
+        self.storage_statements = defaultdict(int)
+        self.errors = defaultdict(int)
+
+    async def __call__(self, handler, event, data):
+        label = handler_label(event)
+        current_label.set(label)
+        started = time.perf_counter()
+        with rq.trace_queries() as trace:
+            try:
+                return await handler(event, data)
+            except Exception:
+                self.errors[label] += 1
+                raise
+            finally:
+                self.latency[label].append(time.perf_counter() - started)
+                self.statements[label] += trace.count
+                self.storage_statements[label] += len(trace.storage_statements)
+
+
+class MemoryDatabase:
+    """Хранилище в памяти с теми функциями rq.*, которые вызывают обработчики из сценариев.
+    Каждое обращение засчитывается как одно SQL-выражение и может ждать latency секунд (сетевой круг до БД)."""
+
+    PATCHED = (
+        "set_user", "is_admin", "resolve_link_token", "get_user_by_token",
+        "has_rated_token", "get_existing_rating", "save_rating", "save_question_rating",
+        "is_payment_successful", "has_active_access", "check_vip_status", "get_statistics",
+        "get_active_payment", "get_subscription_price", "save_payment", "get_last_payment",
+        "is_payment_expired", "delete_active_payment",
+    )
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.users = {}  # tg_id -> строка users
+        self.tokens = {}  # link_token -> tg_id
+        self.questions = {}  # id -> текст
+        self.links = {}  # токен опроса -> (владелец, [id вопросов])
+        self.ratings = {}  # (rater, rated) -> строка ratings
+        self.question_ratings = defaultdict(dict)  # (токен, rater) -> {id вопроса: оценка}
+        self.payments = []
+        self.prices = {}
+
+    def install(self):
+        for name in self.PATCHED:
+            setattr(rq, name, getattr(self, name))
+
+    async def _round_trip(self, name):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        rq.record_statement(name, None, self.latency)
+
+    def seed(self, owners, paid):
+        for qid in range(1, QUESTIONS_PER_LINK + 1):
+            self.questions[qid] = f"Вопрос {qid}"
+        now = datetime.now()
+        for i in range(owners):
+            tg_id = USER_BASE + i
+            self.users[tg_id] = {"tg_id": tg_id, "first_name": f"owner{i}", "username": f"owner{i}",
+                                 "link_token": f"u{i:07d}", "is_admin": False}
+            self.tokens[f"u{i:07d}"] = tg_id
+            self.links[f"q{i:07d}"] = (tg_id, list(self.questions))
+            if i < paid:
+                self.payments.append({"user_id": tg_id, "amount": 500, "transaction_id": f"seed{i}",
+                                      "payment_url": "", "access_start": now, "access_end": now + timedelta(weeks=4),
+                                      "period": "месяц", "is_vip": i % 2 == 0, "status": "success", "created_at": now})
+        for period, price, is_vip in PRICES:
+            self.prices[(period, is_vip)] = price
+
+    async def set_user(self, user_id, first_name, username=None):
+        await self._round_trip("set_user")
+        user = self.users.setdefault(user_id, {"tg_id": user_id, "link_token": None, "is_admin": False})
+        user.update(first_name=first_name, username=username)
+
+    async def is_admin(self, tg_id):
+        await self._round_trip("is_admin")
+        return self.users.get(tg_id, {}).get("is_admin", False)
+
+    async def resolve_link_token(self, token, rater_id):
+        await self._round_trip("resolve_link_token")
+        tg_id = self.tokens.get(token)
+        if tg_id:
+            return {"kind": "user", "owner_id": tg_id, "first_name": self.users[tg_id]["first_name"],
+                    "questions": [], "expires_at": None, "already_rated": (rater_id, tg_id) in self.ratings}
+        link = self.links.get(token)
+        if link:
+            return {"kind": "questions", "owner_id": link[0], "first_name": None,
+                    "questions": [{"id": qid, "text": self.questions[qid]} for qid in link[1]],
+                    "expires_at": None, "already_rated": (token, rater_id) in self.question_ratings}
+        return None
+
+    async def get_user_by_token(self, token):
+        await self._round_trip("get_user_by_token")
+        tg_id = self.tokens.get(token)
+        return dict(self.users[tg_id]) if tg_id else None
+
+    async def has_rated_token(self, token, user_id):
+        await self._round_trip("has_rated_token")
+        return (token, user_id) in self.question_ratings
+
+    async def get_existing_rating(self, rater_user_id, rated_user_id):
+        await self._round_trip("get_existing_rating")
+        return self.ratings.get((rater_user_id, rated_user_id))
+
+    async def save_rating(self, rater_user_id, rated_user_id, score):
+        await self._round_trip("save_rating")
+        self.ratings[(rater_user_id, rated_user_id)] = {
+            "rater_user_id": rater_user_id, "rated_user_id": rated_user_id, "score": score,
+            "created_at": datetime.now(),
+        }
+
+    async def save_question_rating(self, token, question_id, rater_id, score):
+        await self._round_trip("save_question_rating")
+        self.question_ratings[(token, rater_id)][question_id] = score
+
+    def _successful(self, user_id):
+        return [p for p in self.payments if p["user_id"] == user_id and p["status"] == "success"]
+
+    async def is_payment_successful(self, user_id):
+        await self._round_trip("is_payment_successful")
+        return bool(self._successful(user_id))
+
+    async def has_active_access(self, user_id):
+        await self._round_trip("has_active_access")
+        return any(p["access_end"] > datetime.now() for p in self._successful(user_id))
+
+    async def check_vip_status(self, user_id):
+        await self._round_trip("check_vip_status")
+        return any(p["is_vip"] and p["access_end"] > datetime.now() for p in self._successful(user_id))
+
+    async def get_statistics(self, user_id, period):
+        await self._round_trip("get_statistics")
+        since = datetime.now() - {"day": timedelta(days=1), "week": timedelta(weeks=1)}.get(period, timedelta(days=30))
+        scores = [r["score"] for r in self.ratings.values() if r["rated_user_id"] == user_id and r["created_at"] >= since]
+        return (sum(scores) / len(scores) if scores else 0), len(scores)
+
+    async def get_active_payment(self, user_id):
+        await self._round_trip("get_active_payment")
+        for p in self.payments:
+            if p["user_id"] == user_id and p["status"] == "pending":
+                return {"payment_url": p["payment_url"]}
+        return None
+
+    async def get_subscription_price(self, period, is_vip=False):
+        # Цены отдаются из каталога в памяти, без обращения к БД
+        return self.prices.get((period, bool(is_vip)))
+
+    async def save_payment(self, user_id, amount, transaction_id, payment_url, access_start, access_end, period,
+                           is_vip=False):
+        await self._round_trip("save_payment")
+        self.payments.append({"user_id": user_id, "amount": amount, "transaction_id": transaction_id,
+                              "payment_url": payment_url, "access_start": access_start, "access_end": access_end,
+                              "period": period, "is_vip": is_vip, "status": "pending", "created_at": datetime.now()})
+        return True
+
+    async def get_last_payment(self, user_id):
+        await self._round_trip("get_last_payment")
+        own = [p for p in self.payments if p["user_id"] == user_id]
+        return dict(own[-1]) if own else None
+
+    async def is_payment_expired(self, transaction_id):
+        await self._round_trip("is_payment_expired")
+        for p in self.payments:
+            if p["transaction_id"] == transaction_id:
+                return p["status"] == "pending" and datetime.now() - p["created_at"] > timedelta(minutes=10)
+        return False
+
+    async def delete_active_payment(self, user_id):
+        await self._round_trip("delete_active_payment")
+        self.payments = [p for p in self.payments if not (p["user_id"] == user_id and p["status"] == "pending")]
+
+
+async def seed_mysql(owners, paid):
+    """Пересоздает BENCH_DB_NAME, применяет миграции и заполняет те же данные, что MemoryDatabase.seed."""
+    from app.database.migrations import run_migrations
+
+    conn = await aiomysql.connect(**dict(rq.db_config, db=None), autocommit=True)
+    async with conn.cursor() as cur:
+        await cur.execute(f"DROP DATABASE IF EXISTS {BENCH_DB_NAME}")
+        await cur.execute(f"CREATE DATABASE {BENCH_DB_NAME}")
+    conn.close()
+
+    rq.db_config['db'] = BENCH_DB_NAME
+    await rq.create_db_pool()
+    await run_migrations()
+    now = datetime.now()
+    async with rq.get_db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.executemany(
+                "INSERT INTO questions (text) VALUES (%s)",
+                [(f"Вопрос {qid}",) for qid in range(1, QUESTIONS_PER_LINK + 1)]
+            )
+            await cur.executemany(
+                "INSERT INTO users (tg_id, first_name, username, link_token) VALUES (%s, %s, %s, %s)",
+                [(USER_BASE + i, f"owner{i}", f"owner{i}", f"u{i:07d}") for i in range(owners)]
+            )
+            await cur.executemany(
+                "INSERT INTO question_links (user_id, token) VALUES (%s, %s)",
+                [(USER_BASE + i, f"q{i:07d}") for i in range(owners)]
+            )
+            await cur.executemany(
+                "INSERT INTO question_link_items (link_id, question_id) VALUES (%s, %s)",
+                [(link_id, qid) for link_id in range(1, owners + 1) for qid in range(1, QUESTIONS_PER_LINK + 1)]
+            )
+            await cur.executemany(
+                """
+                INSERT INTO payments (user_id, amount, transaction_id, payment_url, access_start, access_end,
+                                      period, is_vip, status, created_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                """,
+                [(USER_BASE + i, 500, f"seed{i}", "", now, now + timedelta(weeks=4), "месяц", i % 2 == 0,
+                  "success", now) for i in range(paid)]
+            )
+            await cur.executemany(
+                "INSERT INTO subscription_prices (period, price, is_vip) VALUES (%s, %s, %s)", PRICES
+            )
+
+
+def message_update(update_id, user_id, text):
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+        "from": user, "text": text,
+    }}
+
+
+def callback_update(update_id, user_id, data):
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "chat_instance": str(user_id), "from": user, "data": data,
+        "message": {"message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+                    "text": "…"},
+    }}
+
+
+def make_session(index, scenario, owners, paid, rng):
+    """Последовательность обновлений одного пользователя: [(тип, user_id, текст или callback_data), ...]."""
+    owner = rng.randrange(owners)
+    rater = RATER_BASE + index
+    if scenario == "link_rating":
+        token = f"u{owner:07d}"
+        return [("message", rater, f"/start rate_{token}"),
+                ("callback", rater, f"rate_{rng.randint(1, 5)}_token={token}")]
+    if scenario == "question_poll":
+        token = f"q{owner:07d}"
+        return [("message", rater, f"/start rate_{token}")] + [
+            ("callback", rater, f"rate_step_{qid}_{rng.randint(1, 5)}_{token}")
+            for qid in range(1, QUESTIONS_PER_LINK + 1)
+        ]
+    if scenario == "quick_poll":
+        token = f"q{owner:07d}"
+        return [("callback", rater, f"rateq_{rng.randint(1, QUESTIONS_PER_LINK)}_{rng.randint(1, 5)}_{token}")]
+    if scenario == "stats":
+        user_id = USER_BASE + rng.randrange(max(paid, 1))
+        return [("callback", user_id, f"stat_{period}") for period in ("day", "week", "month")]
+    return [("callback", rater, "pay_day"), ("callback", rater, "check_payment")]
+
+
+async def run(args):
+    from handlers import router
+
+    rng = random.Random(args.seed)
+    if args.db == "mysql":
+        await seed_mysql(args.owners, args.paid)
+        rq.start_rating_buffers()
+    else:
+        database = MemoryDatabase(args.db_latency / 1000)
+        database.seed(args.owners, args.paid)
+        database.install()
+    set_payment_provider(FakePaymentProvider())
+
+    session = RecordingSession(args.api_latency / 1000)
+    bot = Bot(token=BOT_TOKEN, session=session)
+    storage = MySQLStorage() if args.db == "mysql" else MemoryStorage()
+    dp = Dispatcher(storage=storage, disable_fsm=True)
+    dp.update.outer_middleware(KeyedSchedulerMiddleware(args.concurrency))
+    dp.update.outer_middleware(dp.fsm)
+    stats = LoadStats()
+    dp.message.outer_middleware(stats)
+    dp.callback_query.outer_middleware(stats)
+    dp.include_router(router)
+
+    names, weights = zip(*SCENARIOS.items())
+    sessions = [make_session(i, rng.choices(names, weights)[0], args.owners, args.paid, rng)
+                for i in range(args.sessions)]
+    update_ids = iter(range(1, 10 ** 9))
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def play(steps):
+        async with semaphore:
+            for kind, user_id, payload in steps:
+                build = message_update if kind == "message" else callback_update
+                update = Update.model_validate(build(next(update_ids), user_id, payload), context={"bot": bot})
+                try:
+                    await dp.feed_update(bot, update)
+                except Exception:
+                    pass  # Уже учтено в LoadStats.errors
+
+    started = time.perf_counter()
+    await asyncio.gather(*(play(steps) for steps in sessions))
+    elapsed = time.perf_counter() - started
+
+    if args.db == "mysql":
+        await storage.close()
+        await rq.close_rating_buffers()
+        await rq.close_db_pool()
+
+    report(stats, session, elapsed)
+
+
+def report(stats, session, elapsed):
+    api_calls = defaultdict(int)
+    for (label, _), count in session.calls.items():
+        api_calls[label] += count
+    total = sum(len(values) for values in stats.latency.values())
+
+    print(f"Обновлений: {total}, время: {elapsed:.2f} с, пропускная способность: {total / elapsed:.0f} обновл./с")
+    print(f"{'обработчик':<26} {'обновл.':>8} {'p50, мс':>8} {'p95, мс':>8} {'p99, мс':>8} "
+          f"{'API/обн.':>9} {'SQL/обн.':>9} {'FSM/обн.':>9} {'ошибки':>7}")
+    for label, values in sorted(stats.latency.items()):
+        print(f"{label:<26} {len(values):>8} {percentile(values, 50) * 1000:>8.2f} "
+              f"{percentile(values, 95) * 1000:>8.2f} {percentile(values, 99) * 1000:>8.2f} "
+              f"{api_calls[label] / len(values):>9.2f} {stats.statements[label] / len(values):>9.2f} "
+              f"{stats.storage_statements[label] / len(values):>9.2f} {stats.errors[label]:>7}")
+
+    by_method = defaultdict(int)
+    for (_, method), count in session.calls.items():
+        by_method[method] += count
+    print("Вызовы Bot API: " + ", ".join(f"{method}={count}" for method, count in sorted(by_method.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=2000, help="Число синтетических пользователей")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--owners", type=int, default=500, help="Пользователей со ссылками")
+    parser.add_argument("--paid", type=int, default=200, help="Из них с оплаченной подпиской")
+    parser.add_argument("--db", choices=("memory", "mysql"), default="memory")
+    parser.add_argument("--db-latency", type=float, default=0.5, help="Задержка одного запроса в памяти, мс")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="Задержка вызова Bot API, мс")
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
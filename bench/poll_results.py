@@ -0,0 +1,140 @@
+"""Бенчмарк подробных результатов опросов (VIP «Результаты по вопросам»).
+
+Заполняет отдельную базу BENCH_DB_NAME синтетическими данными (по умолчанию 100 000 оценок)
+и сравнивает прежнюю реализацию (два запроса + декартово произведение в Python)
+с текущей iter_poll_results_detailed (один сгруппированный запрос, серверный курсор).
+
+Запуск: python -m bench.poll_results [--ratings 100000] [--questions 20]
+"""
+import os
+import time
+import random
+import asyncio
+import argparse
+
+import aiomysql
+
+import app.database.requests as rq
+
+BENCH_DB_NAME = os.getenv('BENCH_DB_NAME', 'ratebot_bench')
+OWNER_ID = 1
+
+SCHEMA = [
+    """CREATE TABLE users (
+        id INT AUTO_INCREMENT PRIMARY KEY, tg_id BIGINT UNIQUE, first_name VARCHAR(255),
+        username VARCHAR(255), is_admin BOOLEAN DEFAULT FALSE)""",
+    "CREATE TABLE questions (id INT AUTO_INCREMENT PRIMARY KEY, text VARCHAR(255))",
+    """CREATE TABLE question_links (
+        id INT AUTO_INCREMENT PRIMARY KEY, user_id BIGINT, token VARCHAR(32) UNIQUE)""",
+    "CREATE TABLE question_link_items (link_id INT, question_id INT, PRIMARY KEY (link_id, question_id))",
+    """CREATE TABLE question_ratings (
+        id INT AUTO_INCREMENT PRIMARY KEY, token VARCHAR(32), question_id INT, rater_id BIGINT, score INT,
+        KEY idx_question_ratings_token_rater (token, rater_id))""",
+]
+
+
+async def seed(ratings, questions):
+    """Пересоздает базу и заполняет ее: одна ссылка, questions вопросов, ratings / questions голосовавших."""
+    config = dict(rq.db_config, db=None)
+    conn = await aiomysql.connect(**config, autocommit=True)
+    async with conn.cursor() as cur:
+        await cur.execute(f"DROP DATABASE IF EXISTS {BENCH_DB_NAME}")
+        await cur.execute(f"CREATE DATABASE {BENCH_DB_NAME}")
+        await cur.execute(f"USE {BENCH_DB_NAME}")
+        for ddl in SCHEMA:
+            await cur.execute(ddl)
+
+        raters = ratings // questions
+        await cur.executemany("INSERT INTO questions (text) VALUES (%s)", [(f"Вопрос {i}",) for i in range(questions)])
+        await cur.execute("INSERT INTO question_links (user_id, token) VALUES (%s, 'benchtoken')", (OWNER_ID,))
+        await cur.executemany(
+            "INSERT INTO question_link_items (link_id, question_id) VALUES (1, %s)",
+            [(qid,) for qid in range(1, questions + 1)]
+        )
+        await cur.executemany(
+            "INSERT INTO users (tg_id, first_name, username) VALUES (%s, %s, %s)",
+            [(1000 + i, f"user{i}", f"user{i}") for i in range(raters)]
+        )
+        rows = [
+            ("benchtoken", qid, 1000 + rater, random.randint(1, 5))
+            for rater in range(raters) for qid in range(1, questions + 1)
+        ]
+        for i in range(0, len(rows), 5000):
+            await cur.executemany(
+                "INSERT INTO question_ratings (token, question_id, rater_id, score) VALUES (%s, %s, %s, %s)",
+                rows[i:i + 5000]
+            )
+    conn.close()
+
+
+async def legacy_detailed(user_id):
+    """Прежняя реализация get_poll_results(detailed=True) — для сравнения."""
+    async with rq.get_db_connection() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            await cur.execute("""
+                SELECT q.id, q.text, AVG(r.score) as avg_score
+                FROM question_ratings r
+                JOIN question_links l ON r.token = l.token
+                JOIN question_link_items qi ON qi.link_id = l.id
+                JOIN questions q ON r.question_id = q.id
+                WHERE l.user_id = %s
+                GROUP BY q.id
+                ORDER BY q.id
+            """, (user_id,))
+            questions = await cur.fetchall()
+            await cur.execute("""
+                SELECT DISTINCT r.rater_id, u.username
+                FROM question_ratings r
+                JOIN question_links l ON r.token = l.token
+                LEFT JOIN users u ON u.tg_id = r.rater_id
+                WHERE l.user_id = %s
+            """, (user_id,))
+            raters = await cur.fetchall()
+    return [
+        {"username": rater["username"],
+         "questions": [{"text": q["text"], "avg_score": q["avg_score"]} for q in questions]}
+        for rater in raters
+    ]
+
+
+async def streamed_detailed(user_id):
+    """Текущая реализация: считаем голосовавших, не держа весь результат в памяти."""
+    count = 0
+    async for _ in rq.iter_poll_results_detailed(user_id):
+        count += 1
+    return count
+
+
+async def measure(name, func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await func(OWNER_ID)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    print(f"{name:<10} min {timings[0] * 1000:8.1f} ms   median {timings[len(timings) // 2] * 1000:8.1f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ratings", type=int, default=100_000)
+    parser.add_argument("--questions", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--no-seed", action="store_true", help="использовать уже заполненную базу")
+    args = parser.parse_args()
+
+    if not args.no_seed:
+        print(f"Заполняем {BENCH_DB_NAME}: {args.ratings} оценок, {args.questions} вопросов...")
+        await seed(args.ratings, args.questions)
+
+    rq.db_config['db'] = BENCH_DB_NAME
+    await rq.create_db_pool()
+    try:
+        await measure("legacy", legacy_detailed, args.repeat)
+        await measure("streamed", streamed_detailed, args.repeat)
+    finally:
+        await rq.close_db_pool()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,6 +1,7 @@
-from asyncio import sleep
+import os
+from contextlib import aclosing
 from aiogram import F, Router
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import Message, CallbackQuery, FSInputFile
 from aiogram.filters import CommandStart, Command
 from datetime import timedelta, datetime
 from aiogram.fsm.context import FSMContext
@@ -9,7 +10,11 @@ from aiogram.filters.state import State, StatesGroup
 import app.keyboards.keyboard as kb
 from app.utils.link import generate_unique_link
 import app.database.requests as rq
-from app.utils.payments import create_payment, check_payment_status
+from app.database.write_buffer import BufferFull
+from app.utils.payments import create_payment
+from app.utils.broadcast import start_broadcast, stop_broadcast, progress_text
+from app.utils.export import export_ratings_csv, exporting
+from app.utils.question_import import import_questions_document, is_text_document, import_config, MAX_QUESTION_LENGTH
 
 class SetPriceState(StatesGroup):
     waiting_for_price = State()
@@ -23,6 +28,9 @@ class AddQuestions(StatesGroup):
 class AnsweringQuestions(StatesGroup):
     answering = State()
 
+class BroadcastState(StatesGroup):
+    waiting_for_text = State()
+
 
 router = Router()
 
@@ -34,13 +42,27 @@ PERIOD_TRANSLATION = {
     "vip": "месяц (VIP)"
 }
 
+# Максимальная длина сообщения Telegram (с запасом)
+MAX_MESSAGE_LENGTH = 4000
+
 @router.callback_query(F.data == "generate_custom_link")
 async def start_question_selection(callback: CallbackQuery, state: FSMContext):
     await state.set_state(QuestionLinkState.selecting_questions)
     await state.update_data(selected_questions=[])
-    questions = await rq.get_all_questions()
+    questions, page, pages = await rq.get_questions_page(0)
     await callback.message.edit_text("Выберите вопросы для оценки:",
-                                     reply_markup=kb.generate_question_selection_keyboard(questions))
+                                     reply_markup=kb.generate_question_selection_keyboard(questions, page, pages))
+
+@router.callback_query(QuestionLinkState.selecting_questions, F.data.startswith("qpage_"))
+async def question_selection_page(callback: CallbackQuery):
+    if not callback.data.split("_")[1].isdigit():
+        await callback.answer('')  # Кнопка с номером текущей страницы
+        return
+    questions, page, pages = await rq.get_questions_page(int(callback.data.split("_")[1]))
+    await callback.answer('')
+    await callback.message.edit_reply_markup(
+        reply_markup=kb.generate_question_selection_keyboard(questions, page, pages)
+    )
 
 @router.callback_query(F.data.startswith("select_q_"))
 async def select_question(callback: CallbackQuery, state: FSMContext):
@@ -64,23 +86,50 @@ async def finalize_link(callback: CallbackQuery, state: FSMContext):
                                      reply_markup=kb.generate_back_button())
     await state.clear()
 
-@router.callback_query(F.data.startswith("rateq_"))
+def parse_score(score, token):
+    """Проверяет оценку и токен из callback_data (его можно подделать): возвращает оценку 1–5 или None.
+    Строка, которую БД не примет, не должна попадать в буфер записи."""
+    try:
+        score = int(score)
+    except ValueError:
+        return None
+    if score not in rq.RATING_SCORES or not token or len(token) > rq.MAX_TOKEN_LENGTH:
+        return None
+    return score
+
+BUFFER_FULL_TEXT = "Сервис перегружен, оценка не сохранена. Попробуйте через минуту."
+
+@router.callback_query(F.data.startswith("rateq_"), flags={"query_budget": 1, "send_priority": "high"})
 async def handle_question_rating(callback: CallbackQuery):
     _, qid, score, token = callback.data.split("_", 3)
-    qid, score = int(qid), int(score)
-    await rq.save_question_rating(token, qid, callback.from_user.id, score)
+    score = parse_score(score, token)
+    if score is None or not qid.isdigit():
+        await callback.answer("Некорректная оценка", show_alert=True)
+        return
+    try:
+        await rq.save_question_rating(token, int(qid), callback.from_user.id, score)
+    except BufferFull:
+        await callback.answer(BUFFER_FULL_TEXT, show_alert=True)
+        return
     await callback.answer("Оценка записана")
 
-@router.callback_query(F.data.startswith("rate_step_"))
+@router.callback_query(F.data.startswith("rate_step_"), flags={"query_budget": 2, "send_priority": "high"})
 async def handle_step_rating(callback: CallbackQuery, state: FSMContext):
     try:
         # Распаковка callback_data
         payload = callback.data[len("rate_step_"):]  # удалить префикс
         qid_str, score_str, token = payload.split("_", 2)
-        qid, score = int(qid_str), int(score_str)
+        score = parse_score(score_str, token)
+        if score is None or not qid_str.isdigit():
+            await callback.answer("Некорректная оценка", show_alert=True)
+            return
 
         # Сохраняем оценку
-        await rq.save_question_rating(token, qid, callback.from_user.id, score)
+        try:
+            await rq.save_question_rating(token, int(qid_str), callback.from_user.id, score)
+        except BufferFull:
+            await callback.answer(BUFFER_FULL_TEXT, show_alert=True)
+            return
 
         # Проверяем наличие данных в FSM
         data = await state.get_data()
@@ -112,30 +161,40 @@ async def show_poll_results(callback: CallbackQuery):
     user_id = callback.from_user.id
 
     is_vip = await rq.check_vip_status(user_id)
-    results = await rq.get_poll_results(user_id, detailed=is_vip)
-
-    if not results:
-        await callback.message.edit_text("⛔️ За ваши вопросы пока никто не голосовал.", reply_markup=kb.generate_back_results())
-        return
 
     if is_vip:
-        # Подробные ответы (теперь с средними оценками)
+        # Подробные ответы: оценка каждого голосовавшего по каждому вопросу
         text = "📊 Результаты опросов (VIP):\n\n"
-        for rater in results:
-            text += f"@{rater['username'] or 'аноним'}:\n"
-            for q in rater['questions']:
-                text += f"• {q['text']} — {q['avg_score']:.1f}\n"
-            text += "–––\n"
+        has_results = False
+        # aclosing сразу возвращает подключение в пул, даже если отчет обрезан
+        async with aclosing(rq.iter_poll_results_detailed(user_id)) as raters:
+            async for rater in raters:
+                has_results = True
+                block = f"@{rater['username'] or 'аноним'}:\n"
+                for q in rater['questions']:
+                    block += f"• {q['text']} — {q['avg_score']:.1f}\n"
+                block += "–––\n"
+                if len(text) + len(block) > MAX_MESSAGE_LENGTH:
+                    text += "…"
+                    break
+                text += block
     else:
         # Только средние оценки
+        results = await rq.get_poll_results(user_id)
+        has_results = bool(results)
         text = "📊 Средние оценки по вопросам:\n\n"
         for row in results:
             text += f"{row['text']}: {row['avg']:.2f}\n"
 
+    if not has_results:
+        await callback.message.edit_text("⛔️ За ваши вопросы пока никто не голосовал.", reply_markup=kb.generate_back_results())
+        return
+
     await callback.message.edit_text(text, reply_markup=kb.generate_back_results())
 
 # Обработчик команды /start
-@router.message(CommandStart())
+# Бюджет — новый пользователь по ссылке rate_: set_user (вставка + счетчик панели), is_admin, resolve_link_token
+@router.message(CommandStart(), flags={"query_budget": 4})
 async def start_command(message: Message, state: FSMContext):
     # Сохраняем пользователя в БД
     await rq.set_user(message.from_user.id, message.from_user.first_name, message.from_user.username)
@@ -150,26 +209,37 @@ async def start_command(message: Message, state: FSMContext):
         if args.startswith("rate_"):
             token = args.split("rate_")[1]
 
-            # 1. Попытка найти пользователя (обычная ссылка)
-            user = await rq.get_user_by_token(token)
-            if user:
+            # Тип ссылки, владелец, вопросы и отметка «уже оценивал» — одним запросом
+            link = await rq.resolve_link_token(token, message.from_user.id)
+            if link is None:
+                await message.answer("Ссылка недействительна или пользователь/вопросы не найдены.", reply_markup=kb.generate_back_button())
+                return
+            if link['expires_at'] and link['expires_at'] < datetime.now():
+                await message.answer("Срок действия ссылки истек.", reply_markup=kb.generate_back_button())
+                return
+
+            # 1. Персональная ссылка пользователя
+            if link['kind'] == 'user':
+                if link['owner_id'] == message.from_user.id:
+                    await message.answer("Вы не можете оценить сами себя!", reply_markup=kb.generate_back_button())
+                    return
+                if link['already_rated']:
+                    await message.answer("Вы уже оценили этого пользователя!", reply_markup=kb.generate_back_button())
+                    return
                 await message.answer(
-                    f"Вы можете оставить отзыв для пользователя: {user['first_name']}.\nОцените его от 1 до 5.",
+                    f"Вы можете оставить отзыв для пользователя: {link['first_name']}.\nОцените его от 1 до 5.",
                     reply_markup=kb.generate_rate_keyboard(token)
                 )
                 return
 
-            # 2. Попытка найти вопросы (опрос по вопросам)
-            questions = await rq.get_questions_by_token(token)
-            # Получаем автора токена
-            author_id = await rq.get_token_owner(token)
-            if author_id == message.from_user.id:
+            # 2. Опрос по вопросам
+            questions = link['questions']
+            if link['owner_id'] == message.from_user.id:
                 await message.answer("⛔️ Вы не можете отвечать на собственные вопросы.", reply_markup=kb.generate_back_button())
                 return
 
             # Проверка: уже проходил?
-            already_rated = await rq.has_rated_token(token, message.from_user.id)
-            if already_rated:
+            if link['already_rated']:
                 await message.answer("✅ Вы уже прошли этот опрос.", reply_markup=kb.generate_back_button())
                 return
             
@@ -199,7 +269,7 @@ async def start_command(message: Message, state: FSMContext):
     )
 
 # Обработчик кнопки "Назад в меню"
-@router.callback_query(F.data == 'back_to_menu')
+@router.callback_query(F.data == 'back_to_menu', flags={"query_budget": 1})
 async def show_menu(callback: CallbackQuery):
     is_admin = await rq.is_admin(callback.from_user.id)
     # Отправляем меню с inline кнопками
@@ -218,12 +288,15 @@ async def generate_link(callback: CallbackQuery):
     )
 
 # Обработчик оставления оценки
-@router.callback_query(F.data.startswith('rate_'))
+@router.callback_query(F.data.startswith('rate_'), flags={"query_budget": 4, "send_priority": "high"})
 async def handle_rating(callback: CallbackQuery):
     # Разделяем callback_data по подчеркиваниям
     data_parts = callback.data.split('_')
-    score = int(data_parts[1])  # Оценка пользователя (должна быть в 2-й части)
-    token = callback.data.split('=')[1]  # Извлекаем токен после символа '='
+    token = callback.data.split('=')[-1]  # Извлекаем токен после символа '='
+    score = parse_score(data_parts[1], token)  # Оценка пользователя (должна быть в 2-й части)
+    if score is None:
+        await callback.answer("Некорректная оценка", show_alert=True)
+        return
     is_admin = await rq.is_admin(callback.from_user.id)
 
     user_id = callback.from_user.id
@@ -249,7 +322,11 @@ async def handle_rating(callback: CallbackQuery):
         return
 
     # Сохраняем рейтинг
-    await rq.save_rating(rater_user_id=user_id, rated_user_id=rated_user['tg_id'], score=score) #tg_id
+    try:
+        await rq.save_rating(rater_user_id=user_id, rated_user_id=rated_user['tg_id'], score=score) #tg_id
+    except BufferFull:
+        await callback.answer(BUFFER_FULL_TEXT, show_alert=True)
+        return
 
     # Отправляем сообщение о том, что оценка принята
     await callback.answer('')
@@ -258,7 +335,7 @@ async def handle_rating(callback: CallbackQuery):
         reply_markup=kb.generate_main_menu(is_admin)
     )
 
-@router.callback_query(F.data == "check_subscription")
+@router.callback_query(F.data == "check_subscription", flags={"query_budget": 2})
 async def check_subscription(callback: CallbackQuery):
     user_id = callback.from_user.id
 
@@ -340,7 +417,42 @@ async def view_voters(callback: CallbackQuery):
         reply_markup=kb.generate_back_results()
     )
 
-@router.callback_query(F.data.startswith('pay_'))
+async def send_ratings_export(message: Message, user_id):
+    """Отправляет VIP-пользователю все его оценки CSV-файлом."""
+    if not await rq.check_vip_status(user_id):
+        await message.answer("Выгрузка оценок доступна с VIP-подпиской.",
+                             reply_markup=kb.generate_payment_period_keyboard())
+        return
+    if user_id in exporting:
+        await message.answer("Выгрузка уже готовится, подождите.")
+        return
+
+    exporting.add(user_id)
+    path = None
+    try:
+        path = await export_ratings_csv(user_id)
+        if path is None:
+            await message.answer("За вас еще никто не голосовал.", reply_markup=kb.generate_back_button())
+            return
+        await message.answer_document(FSInputFile(path, filename="ratings.csv"), caption="📄 Все ваши оценки")
+    except Exception as e:
+        print(f"Ошибка при выгрузке оценок пользователя {user_id}: {e}")
+        await message.answer("❌ Не удалось подготовить выгрузку.", reply_markup=kb.generate_back_button())
+    finally:
+        exporting.discard(user_id)
+        if path is not None:
+            os.remove(path)
+
+@router.callback_query(F.data == "export_ratings")
+async def export_ratings(callback: CallbackQuery):
+    await callback.answer('')
+    await send_ratings_export(callback.message, callback.from_user.id)
+
+@router.message(Command("export"))
+async def export_command(message: Message):
+    await send_ratings_export(message, message.from_user.id)
+
+@router.callback_query(F.data.startswith('pay_'), flags={"send_priority": "high"})
 async def handle_payment(callback: CallbackQuery):
     user_id = callback.from_user.id
     period = callback.data.split('_')[1]  # Извлекаем период из callback_data
@@ -405,7 +517,7 @@ async def create_new_payment(user_id, period, callback, is_vip=False):
         reply_markup=kb.generate_payment_keyboard(payment_url, 'Проверить оплату')
     )
 
-@router.callback_query(F.data.startswith('confirm_new_payment_'))
+@router.callback_query(F.data.startswith('confirm_new_payment_'), flags={"send_priority": "high"})
 async def confirm_new_payment(callback: CallbackQuery):
     user_id = callback.from_user.id
     data_parts = callback.data.split('_')
@@ -418,7 +530,7 @@ async def confirm_new_payment(callback: CallbackQuery):
     # Создаем новый платеж для выбранного периода
     await create_new_payment(user_id, period, callback, is_vip)
 
-@router.callback_query(F.data == "buy_vip")
+@router.callback_query(F.data == "buy_vip", flags={"send_priority": "high"})
 async def buy_vip(callback: CallbackQuery):
     user_id = callback.from_user.id
 
@@ -437,7 +549,7 @@ async def buy_vip(callback: CallbackQuery):
     # Если активного платежа нет, создаем новый VIP-платеж
     await create_new_payment(user_id, "vip", callback, is_vip=True)
 
-@router.callback_query(F.data == "check_payment")
+@router.callback_query(F.data == "check_payment", flags={"send_priority": "high"})
 async def check_payment(callback: CallbackQuery):
     user_id = callback.from_user.id
 
@@ -475,42 +587,12 @@ async def check_payment(callback: CallbackQuery):
         )
         return
 
-    try:
-        # Проверяем статус платежа через API ЮMoney
-        if await check_payment_status(transaction_id):
-            # Если оплата прошла успешно, активируем подписку
-            await callback.answer('')
-            await callback.message.edit_text(
-                "Оплата прошла успешно. Вы можете просматривать статистику.",
-                reply_markup=kb.generate_stats_menu()
-            )
-            return
-
-        # Если оплата не прошла, начинаем отсчет
-        countdown_time = 10
-        for i in range(countdown_time, 0, -1):
-            # Обновляем кнопку с отсчетом
-            await callback.message.edit_reply_markup(
-                reply_markup=kb.generate_payment_keyboard(last_payment['payment_url'], f"Проверить через {i}...")
-            )
-            await sleep(1)
-
-        # После отсчета проверяем статус еще раз
-        if await check_payment_status(transaction_id):
-            await callback.message.edit_text(
-                "Оплата прошла успешно. Вы можете просматривать статистику.",
-                reply_markup=kb.generate_stats_menu()
-            )
-        else:
-            await callback.message.edit_text(
-                "Оплата не прошла. Перейдите по следующей ссылке для оплаты:",
-                reply_markup=kb.generate_payment_keyboard(last_payment['payment_url'], 'Проверить оплату')
-            )
-    except Exception as e:
-        await callback.message.edit_text(
-            "Произошла ошибка при проверке статуса платежа. Попробуйте позже.",
-            reply_markup=kb.generate_main_menu()
-        )
+    # Статус платежа обновляет фоновая сверка (periodic_reconcile в main.py),
+    # пользователь получит уведомление, как только оплата поступит
+    await callback.answer(
+        "Оплата еще не поступила. Как только платеж пройдет, мы пришлем уведомление.",
+        show_alert=True
+    )
 
 # Обработчик кнопки "Назад к выбору статистики"
 @router.callback_query(F.data == "back_to_stat_choice")
@@ -548,7 +630,7 @@ async def handle_statistics(callback: CallbackQuery):
             reply_markup=kb.generate_payment_period_keyboard()
         )
 
-@router.callback_query(F.data == "admin_stats")
+@router.callback_query(F.data == "admin_stats", flags={"query_budget": 2})
 async def admin_stats(callback: CallbackQuery):
     user_id = callback.from_user.id
 
@@ -557,23 +639,27 @@ async def admin_stats(callback: CallbackQuery):
         await callback.answer("У вас нет прав администратора.")
         return
 
-    # Получаем статистику
-    total_users = await rq.get_total_users()
-    users_with_links = await rq.get_users_with_links()
-    payment_stats = await rq.get_payment_stats()
-    total_spent = await rq.get_total_spent_on_subscriptions()
+    # Получаем статистику из счетчиков (один запрос независимо от размера таблиц)
+    dashboard = await rq.get_dashboard(days=7)
+    totals = dashboard['totals']
+    total_normal = totals.get('revenue_normal', 0)
+    total_vip = totals.get('revenue_vip', 0)
 
     # Формируем сообщение со статистикой
     stats_message = (
         f"📊 Статистика:\n"
-        f"👤 Всего пользователей: {total_users}\n"
-        f"🔗 Пользователей сгенерировало ссылку: {users_with_links}\n"
-        f"💳 Оплачено обычных подписок: {payment_stats['normal_payments']}\n"
-        f"🌟 Оплачено VIP-подписок: {payment_stats['vip_payments']}\n"
-        f"💰 Потрачено на обычные подписки: {total_spent['total_normal']:.2f} ₽\n"
-        f"💎 Потрачено на VIP-подписки: {total_spent['total_vip']:.2f} ₽\n"
-        f"💵 Всего потрачено: {total_spent['total']:.2f} ₽"
+        f"👤 Всего пользователей: {int(totals.get('users', 0))}\n"
+        f"🔗 Пользователей сгенерировало ссылку: {int(totals.get('payers', 0))}\n"
+        f"💳 Оплачено обычных подписок: {int(totals.get('payments_normal', 0))}\n"
+        f"🌟 Оплачено VIP-подписок: {int(totals.get('payments_vip', 0))}\n"
+        f"💰 Потрачено на обычные подписки: {total_normal:.2f} ₽\n"
+        f"💎 Потрачено на VIP-подписки: {total_vip:.2f} ₽\n"
+        f"💵 Всего потрачено: {total_normal + total_vip:.2f} ₽\n\n"
+        f"📈 По дням (новые пользователи / выручка):\n"
     )
+    for day, values in dashboard['days']:
+        revenue = values.get('revenue_normal', 0) + values.get('revenue_vip', 0)
+        stats_message += f"{day:%d.%m}: +{int(values.get('users', 0))} / {revenue:.2f} ₽\n"
 
     await callback.answer('')
     await callback.message.edit_text(stats_message, reply_markup=kb.generate_back_button())
@@ -583,22 +669,17 @@ async def manage_prices(callback: CallbackQuery):
     """Показывает меню управления ценами на подписки."""
     user_id = callback.from_user.id
 
-    period = callback.data.split('_')[1]  # Извлекаем период из callback_data
-
-    # Проверяем, является ли это VIP-тарифом
-    is_vip = "vip" in callback.data
-
     # Проверяем, является ли пользователь администратором
     if not await rq.is_admin(user_id):
         await callback.answer("У вас нет прав администратора.")
         return
 
-    # Получаем текущие цены на подписки
-    prices = await rq.get_subscription_price(period, is_vip)
+    # Все текущие цены на подписки (из каталога в памяти)
+    prices = await rq.get_all_prices()
 
     # Формируем сообщение с текущими ценами
     prices_message = "Текущие цены на подписки:\n"
-    if prices != None: 
+    if prices:
         for price in prices:
             prices_message += f"{price['period']} ({'VIP' if price['is_vip'] else 'Обычный'}): {price['price']} руб.\n"
     else:
@@ -696,7 +777,45 @@ async def add_questions(callback: CallbackQuery, state: FSMContext):
     
     await callback.answer('')
     await state.set_state(AddQuestions.add_questions)  # устанавливаем состояние
-    await callback.message.edit_text("Введите новый вопрос:", reply_markup=kb.generate_back_button())
+    await callback.message.edit_text(
+        "Введите новый вопрос или отправьте файл .txt/.csv — по одному вопросу в строке:",
+        reply_markup=kb.generate_back_button()
+    )
+
+@router.message(AddQuestions.add_questions, F.document)
+async def handle_questions_file(message: Message, state: FSMContext):
+    """Импортирует вопросы из присланного файла одной пачкой."""
+    if not await rq.is_admin(message.from_user.id):
+        await message.answer("У вас нет прав администратора.", reply_markup=kb.generate_back_button())
+        await state.clear()
+        return
+
+    document = message.document
+    if not is_text_document(document):
+        await message.answer("Поддерживаются только текстовые файлы .txt и .csv.",
+                             reply_markup=kb.generate_back_button())
+        return
+    if document.file_size and document.file_size > import_config['max_file_size']:
+        await message.answer(
+            f"Файл слишком большой (максимум {import_config['max_file_size'] // 1024} КБ).",
+            reply_markup=kb.generate_back_button()
+        )
+        return
+
+    try:
+        result = await import_questions_document(message.bot, document)
+        await message.answer(
+            f"✅ Импорт завершен\n"
+            f"Добавлено: {result['inserted']}\n"
+            f"Пропущено (уже есть): {result['duplicates']}\n"
+            f"Пропущено (длиннее {MAX_QUESTION_LENGTH} символов): {result['too_long']}",
+            reply_markup=kb.generate_back_button()
+        )
+    except Exception as e:
+        print(f"Ошибка при импорте вопросов: {e}")
+        await message.answer("❌ Ошибка при импорте вопросов.", reply_markup=kb.generate_back_button())
+    finally:
+        await state.clear()
 
 @router.message(AddQuestions.add_questions)
 async def handle_question_input(message: Message, state: FSMContext):
@@ -707,7 +826,7 @@ async def handle_question_input(message: Message, state: FSMContext):
         await state.clear()
         return
     
-    question = message.text.strip()
+    question = (message.text or "").strip()
     if not question:
         await message.answer("Вопрос не может быть пустым.", reply_markup=kb.generate_back_button())
         return
@@ -725,4 +844,51 @@ async def handle_question_input(message: Message, state: FSMContext):
     except Exception as e:
         await message.answer(f"⚠️ Критическая ошибка: {e}", reply_markup=kb.generate_back_button())
     finally:
-        await state.clear()
\ No newline at end of file
+        await state.clear()
+
+@router.callback_query(F.data == "broadcast")
+async def broadcast_menu(callback: CallbackQuery, state: FSMContext):
+    """Запрашивает у администратора текст рассылки."""
+    if not await rq.is_admin(callback.from_user.id):
+        await callback.answer("У вас нет прав администратора.")
+        return
+
+    await state.set_state(BroadcastState.waiting_for_text)
+    await callback.answer('')
+    await callback.message.edit_text("Введите текст рассылки для всех пользователей:",
+                                     reply_markup=kb.generate_back_button())
+
+@router.message(BroadcastState.waiting_for_text)
+async def handle_broadcast_text(message: Message, state: FSMContext):
+    """Создает рассылку и запускает ее в фоне; ход показывается в отдельном сообщении."""
+    if not await rq.is_admin(message.from_user.id):
+        await message.answer("У вас нет прав администратора.", reply_markup=kb.generate_back_button())
+        await state.clear()
+        return
+
+    text = (message.text or "").strip()
+    if not text:
+        await message.answer("Текст рассылки не может быть пустым.", reply_markup=kb.generate_back_button())
+        return
+    await state.clear()
+
+    broadcast = await rq.create_broadcast(message.from_user.id, text)
+    progress = await message.answer(progress_text(broadcast, 0, 0),
+                                    reply_markup=kb.generate_broadcast_keyboard(broadcast['id']))
+    await rq.set_broadcast_message(broadcast['id'], progress.message_id)
+    broadcast['progress_message_id'] = progress.message_id
+    start_broadcast(message.bot, broadcast)
+
+@router.callback_query(F.data.startswith("broadcast_cancel_"))
+async def cancel_broadcast(callback: CallbackQuery):
+    if not await rq.is_admin(callback.from_user.id):
+        await callback.answer("У вас нет прав администратора.")
+        return
+
+    broadcast_id = int(callback.data.split("_")[2])
+    if await stop_broadcast(broadcast_id):
+        await callback.answer("Рассылка остановлена")
+        await callback.message.edit_reply_markup(reply_markup=None)
+    else:
+        await callback.answer("Рассылка уже завершена")
+
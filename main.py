@@ -4,26 +4,132 @@ from aiogram import Bot, Dispatcher
 from dotenv import load_dotenv
 
 from handlers import router  # Импортируем роутер с обработчиками
-from app.database.requests import delete_expired_payments  # Импортируем функцию для удаления платежей
+from app.database.requests import sweep_expired_payments  # Очистка и архивирование платежей
+from app.database.requests import reconcile_dashboard  # Пересчет счетчиков панели администратора
+from app.database.requests import load_price_catalog  # Каталог цен подписок в памяти
+from app.database.requests import create_db_pool, close_db_pool, query_trace_config  # Пул подключений к базе данных
+from app.database.requests import start_rating_buffers, close_rating_buffers  # Буферы записи оценок
+from app.database.migrations import run_migrations  # Миграции схемы базы данных
+from app.database.fsm_storage import create_fsm_storage  # Хранилище состояний FSM
+from app.utils.webhook import run_webhook  # Режим webhook
+from app.middlewares.scheduler import KeyedSchedulerMiddleware  # Порядок обновлений по пользователю
+from app.middlewares.metrics import HandlerMetricsMiddleware, TelegramMetricsMiddleware  # Метрики
+from app.middlewares.query_budget import QueryBudgetMiddleware  # Число запросов к БД на обновление
+from app.middlewares.send_queue import OutboundScheduler, SendPriorityMiddleware, send_priority, HIGH  # Исходящие
+from app.utils.metrics import Gauge, start_metrics_server
+from app.utils.payment_provider import close_payment_provider  # HTTP-сессия платежного провайдера
+from app.utils.payments import reconcile_pending_payments  # Сверка ожидающих платежей
+from app.utils.broadcast import resume_broadcasts, close_broadcasts  # Рассылки администратора
+import app.keyboards.keyboard as kb
+
+async def wait_for_stop(stop_event: asyncio.Event, interval):
+    """Ждет interval секунд или остановки бота, смотря что наступит раньше."""
+    if stop_event is None:
+        await asyncio.sleep(interval)
+        return
+    try:
+        await asyncio.wait_for(stop_event.wait(), interval)
+    except asyncio.TimeoutError:
+        pass  # Обычное пробуждение по интервалу
 
 # Функция для периодического удаления старых платежей
 async def periodic_cleanup(interval: int = 300, stop_event: asyncio.Event = None):
-    """Периодически удаляет старые платежи."""
+    """Периодически удаляет неоплаченные платежи и архивирует оплаченные с истекшим доступом."""
     while not stop_event or not stop_event.is_set():
         try:
-            await delete_expired_payments()
+            result = await sweep_expired_payments()
+            if result and (result['deleted'] or result['archived']):
+                print(f"Очистка платежей: удалено {result['deleted']}, в архиве {result['archived']}, "
+                      f"пачек {result['batches']}, {result['seconds']} с")
         except Exception as e:
             print(f"Ошибка при удалении платежей: {e}")
-        await asyncio.sleep(interval)  # Интервал в секундах (например, 600 секунд = 10 минут)
+        await wait_for_stop(stop_event, interval)  # Интервал в секундах (например, 600 секунд = 10 минут)
+
+# Функция для периодического пересчета счетчиков панели администратора
+async def periodic_dashboard_reconcile(interval: int = 3600, stop_event: asyncio.Event = None):
+    """Пересчитывает счетчики по исходным таблицам: при запуске и затем раз в interval секунд."""
+    while not stop_event or not stop_event.is_set():
+        try:
+            await reconcile_dashboard()
+        except Exception as e:
+            print(f"Ошибка при пересчете счетчиков: {e}")
+        await wait_for_stop(stop_event, interval)
+
+# Функция для периодической сверки ожидающих платежей с ЮMoney
+async def periodic_reconcile(bot: Bot, interval: int = 15, stop_event: asyncio.Event = None):
+    """Периодически проверяет ожидающие платежи и уведомляет пользователей об успешной оплате."""
+    while not stop_event or not stop_event.is_set():
+        try:
+            settled = await reconcile_pending_payments()
+            # Уведомления об оплате отправляются вне очереди остальных сообщений
+            with send_priority(HIGH):
+                await asyncio.gather(*(notify_payment(bot, payment) for payment in settled))
+        except Exception as e:
+            print(f"Ошибка при сверке платежей: {e}")
+        await wait_for_stop(stop_event, interval)
+
+async def notify_payment(bot: Bot, payment):
+    """Сообщает пользователю об успешной оплате."""
+    try:
+        await bot.send_message(
+            payment['user_id'],
+            "Оплата прошла успешно. Вы можете просматривать статистику.",
+            reply_markup=kb.generate_stats_menu(bool(payment['is_vip']))
+        )
+    except Exception as e:
+        print(f"Не удалось уведомить пользователя {payment['user_id']}: {e}")
 
 # Основная асинхронная функция для запуска бота
 async def main():
     # Загружаем переменные окружения
     load_dotenv()
 
+    # Создаем общий пул подключений к базе данных
+    await create_db_pool()
+
+    # Применяем миграции схемы (таблицы, индексы, агрегаты)
+    await run_migrations()
+
+    # Загружаем цены подписок в память (дальше они сверяются по версии каталога)
+    await load_price_catalog()
+
+    # Запускаем буферы отложенной записи оценок
+    start_rating_buffers()
+
     # Инициализация бота и диспетчера
     bot = Bot(token=os.getenv('TOKEN'))  # Токен бота из переменных окружения
-    dp = Dispatcher()
+    # Исходящие вызовы идут через общую очередь с лимитами Bot API; метрики считают фактические запросы
+    outbound = OutboundScheduler(
+        global_rate=float(os.getenv('SEND_GLOBAL_RATE', 30)),  # Сообщений в секунду на бота
+        private_chat_rate=float(os.getenv('SEND_CHAT_RATE', 1)),  # Сообщений в секунду в личный чат
+        group_chat_rate=float(os.getenv('SEND_GROUP_RATE', 20)) / 60,  # Сообщений в минуту в группу
+    )
+    bot.session.middleware(outbound)
+    bot.session.middleware(TelegramMetricsMiddleware())  # Счетчик вызовов Bot API
+    Gauge("ratebot_outbound", "Очередь исходящих сообщений", ("metric",),
+          collect=lambda: {(name,): value for name, value in outbound.stats().items()})
+    # Состояния FSM хранятся вне процесса (FSM_STORAGE), чтобы их видели все процессы бота
+    # FSM-middleware регистрируем сами (disable_fsm), чтобы состояние читалось уже в очереди пользователя
+    dp = Dispatcher(storage=create_fsm_storage(), disable_fsm=True)
+
+    # Обновления одного пользователя — по очереди, разных пользователей — параллельно
+    scheduler = KeyedSchedulerMiddleware(int(os.getenv('UPDATE_MAX_CONCURRENCY', 64)))
+    dp.update.outer_middleware(scheduler)
+    dp.update.outer_middleware(dp.fsm)
+    Gauge("ratebot_scheduler", "Очереди обновлений по пользователям", ("metric",),
+          collect=lambda: {(name,): value for name, value in scheduler.stats().items()})
+
+    # Время обработки по обработчикам
+    dp.message.outer_middleware(HandlerMetricsMiddleware())
+    dp.callback_query.outer_middleware(HandlerMetricsMiddleware())
+
+    # Число SQL-выражений на обновление и бюджеты обработчиков (QUERY_BUDGET_MODE)
+    dp.message.middleware(QueryBudgetMiddleware(query_trace_config['budget_mode']))
+    dp.callback_query.middleware(QueryBudgetMiddleware(query_trace_config['budget_mode']))
+
+    # Приоритет исходящих сообщений по флагу обработчика (подтверждения оценок и оплат — вперед)
+    dp.message.middleware(SendPriorityMiddleware())
+    dp.callback_query.middleware(SendPriorityMiddleware())
 
     # Регистрируем обработчики
     dp.include_router(router)
@@ -34,13 +140,42 @@ async def main():
     # Запускаем периодическую задачу для удаления старых платежей
     cleanup_task = asyncio.create_task(periodic_cleanup(stop_event=stop_event))
 
+    # Запускаем фоновую сверку платежей
+    reconcile_interval = int(os.getenv('PAYMENT_RECONCILE_INTERVAL', 15))
+    reconcile_task = asyncio.create_task(periodic_reconcile(bot, reconcile_interval, stop_event=stop_event))
+
+    # Запускаем пересчет счетчиков панели администратора
+    dashboard_interval = int(os.getenv('DASHBOARD_RECONCILE_INTERVAL', 3600))
+    dashboard_task = asyncio.create_task(periodic_dashboard_reconcile(dashboard_interval, stop_event=stop_event))
+
+    # Продолжаем рассылки, прерванные прошлой остановкой
+    await resume_broadcasts(bot)
+
+    # /metrics отдает отдельный локальный сервер (METRICS_HOST/METRICS_PORT) в обоих режимах,
+    # чтобы метрики не были видны на публичном адресе webhook
+    metrics_runner = None
+    if os.getenv('METRICS_PORT'):
+        metrics_runner = await start_metrics_server(os.getenv('METRICS_HOST', '127.0.0.1'), int(os.getenv('METRICS_PORT')))
+
     try:
-        # Запуск опроса бота
-        await dp.start_polling(bot)
-    except asyncio.CancelledError:
-        # Останавливаем задачу при завершении работы бота
+        if os.getenv('BOT_MODE', 'polling') == 'webhook':
+            # Прием обновлений через webhook (несколько экземпляров за балансировщиком)
+            await run_webhook(dp, bot, scheduler=scheduler)
+        else:
+            # Запуск опроса бота
+            await dp.start_polling(bot)
+    finally:
+        # Останавливаем фоновые задачи при любом завершении (start_polling на SIGINT возвращается обычно)
+        # и дожидаемся их до закрытия буферов и пула, которыми они пользуются
         stop_event.set()
-        await cleanup_task
+        await asyncio.gather(cleanup_task, reconcile_task, dashboard_task, return_exceptions=True)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await close_broadcasts()
+        # Дописываем оценки из буферов, затем закрываем HTTP-сессию провайдера и пул подключений
+        await close_rating_buffers()
+        await close_payment_provider()
+        await close_db_pool()
 
 if __name__ == '__main__':
     try: